@@ -0,0 +1,159 @@
+"""
+Async versions of the Spotify proxy views, routed instead of the sync ones when
+ASYNC_SPOTIFY_VIEWS is on. Run the project under ASGI (see the README) for them to
+pay off: a request waiting on Spotify then holds neither a worker nor a thread.
+
+DRF's api_view is sync-only, so these are plain Django async views that authenticate
+with the configured DRF authentication classes and return the same JSON.
+"""
+import asyncio
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .models import Artist, CatalogSync
+from .serializers import CatalogAlbumSerializer
+from .catalog import aget_album_payload, crawl_discography, schedule_discography_crawl, NEW_RELEASES_SYNC
+from .search import asearch_spotify, asearch_many
+from .spotify_async import amake_spotify_request
+from .views import (
+    spotify_error, stale_headers, requested_view, search_params, search_response_data, prefetch_top_albums,
+    local_album_details, artist_albums, new_release_albums, new_releases_endpoint, INVALID_VIEW,
+)
+
+
+def json_response(data, status=200, headers=None):
+    return JsonResponse(data, status=status, headers=headers, safe=False)
+
+
+def spotify_json_response(payload, data=None):
+    return json_response(payload if data is None else data, headers=stale_headers(payload))
+
+
+def spotify_error_json(exc):
+    body, status, headers = spotify_error(exc)
+    return json_response(body, status, headers)
+
+
+def _authenticate(request):
+    user = request.user  # runs the authenticators
+    if user is None or not user.is_authenticated:
+        raise exceptions.NotAuthenticated()
+    return user
+
+
+def async_api_view(view):
+    """
+    Wrap an async GET view: authenticate like DRF's IsAuthenticated would and pass on a
+    DRF Request (for query_params and friends).
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != "GET":
+            return json_response({"detail": f'Method "{request.method}" not allowed.'}, 405)
+        authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+        drf_request = Request(request, authenticators=authenticators)
+        try:
+            await sync_to_async(_authenticate)(drf_request)
+        except exceptions.APIException as exc:
+            headers = {}
+            if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)) and authenticators:
+                headers["WWW-Authenticate"] = authenticators[0].authenticate_header(drf_request)
+                exc.status_code = 401
+            data = exc.detail if isinstance(exc.detail, (list, dict)) else {"detail": exc.detail}
+            return json_response(data, exc.status_code, headers)
+        return await view(drf_request, *args, **kwargs)
+    return wrapper
+
+
+@async_api_view
+async def spotify_search(request):
+    try:
+        query, search_type, limit, offset, view = search_params(request)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    types = search_type.split(",")
+    try:
+        if len(types) == 1:
+            results, ranked = await asearch_spotify(request.user, query, search_type, limit, offset, view), None
+        else:
+            results, ranked = await asearch_many(request.user, query, types, limit, offset, view)
+    except Exception as e:
+        return spotify_error_json(e)
+
+    prefetch_top_albums(request.user, results)
+    return spotify_json_response(results, search_response_data(request, results, ranked, limit, offset))
+
+
+@async_api_view
+async def spotify_album_details(request, spotify_id):
+    view = requested_view(request)
+    if view is None:
+        return json_response({"error": INVALID_VIEW}, 400)
+    try:
+        return spotify_json_response(await aget_album_payload(spotify_id, view))
+    except Exception as e:
+        return spotify_error_json(e)
+
+
+@async_api_view
+async def spotify_new_releases(request):
+    try:
+        limit = min(max(int(request.GET.get("limit", 20)), 1), 50)
+    except ValueError:
+        return json_response({"error": "limit must be an integer."}, 400)
+    view = requested_view(request)
+    if view is None:
+        return json_response({"error": INVALID_VIEW}, 400)
+
+    sync = await CatalogSync.objects.filter(name=NEW_RELEASES_SYNC).afirst()
+    if sync is not None:
+        albums = [album async for album in new_release_albums(limit)]
+        return json_response(CatalogAlbumSerializer(albums, many=True).data,
+                             headers={"X-Catalog-Synced-At": sync.synced_at.isoformat()})
+
+    try:
+        results = await amake_spotify_request(request.user, new_releases_endpoint(limit), view=view)
+        return spotify_json_response(results, results.get("albums", {}).get("items", []))
+    except Exception as e:
+        return spotify_error_json(e)
+
+
+@async_api_view
+async def get_combined_album_details(request, spotify_id):
+    view = requested_view(request)
+    if view is None:
+        return json_response({"error": INVALID_VIEW}, 400)
+    try:
+        spotify_data, local_data = await asyncio.gather(
+            aget_album_payload(spotify_id, view),
+            sync_to_async(local_album_details)(request, spotify_id),
+        )
+    except Exception as e:
+        return spotify_error_json(e)
+    return spotify_json_response(spotify_data, {"spotify_details": spotify_data, **local_data})
+
+
+@async_api_view
+async def get_artist_albums(request, artist_id):
+    synced_at = await (Artist.objects.filter(spotify_id=artist_id)
+                       .values_list("discography_synced_at", flat=True).afirst())
+    try:
+        if synced_at is None:
+            # the first crawl fans out on the sync client's thread pool; it happens once per artist
+            await sync_to_async(crawl_discography)(request.user, artist_id)
+        elif timezone.now() - synced_at > timedelta(seconds=settings.SPOTIFY_DISCOGRAPHY_TTL):
+            schedule_discography_crawl(request.user, artist_id)
+    except Exception as e:
+        return spotify_error_json(e)
+
+    albums = [album async for album in artist_albums(artist_id)]
+    return json_response(CatalogAlbumSerializer(albums, many=True).data)
@@ -0,0 +1,113 @@
+"""
+Thread pools for work that runs alongside a request (or after it).
+
+Background work (submit, submit_once) and fan-out a request waits on (fan_out) get
+separate pools. Background jobs may queue for a minute in the rate-limit governor,
+and must not hold up the threads a request is waiting for.
+"""
+import contextvars
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_POOL = "albums-bg"
+FAN_OUT_POOL = "albums-fan-out"
+
+_executors = {}
+_executor_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def get_executor(pool=BACKGROUND_POOL):
+    executor = _executors.get(pool)
+    if executor is None:
+        with _executor_lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                workers = settings.FAN_OUT_WORKERS if pool == FAN_OUT_POOL else settings.BACKGROUND_WORKERS
+                executor = _executors[pool] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=pool)
+    return executor
+
+
+def _reset_executor():
+    # Threads don't survive a fork, so each gunicorn worker builds its own pools.
+    global _executors, _executor_lock, _pending_lock
+    _executors = {}
+    _executor_lock = threading.Lock()
+    _pending.clear()
+    _pending_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_executor)
+
+
+def _run(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        # Any ORM access in the pool thread opened its own connection; don't leak it.
+        connections.close_all()
+
+
+def _submit(pool, fn, args, kwargs):
+    return get_executor(pool).submit(contextvars.copy_context().run, _run, fn, args, kwargs)
+
+
+def submit(fn, *args, **kwargs):
+    """
+    Run `fn` on the background pool and return its Future. It runs in a copy of the
+    caller's context, so context variables (e.g. the originating view) carry over.
+    """
+    return _submit(BACKGROUND_POOL, fn, args, kwargs)
+
+
+def on_pool():
+    """True when called from one of the pools' own threads."""
+    return threading.current_thread().name.startswith((BACKGROUND_POOL, FAN_OUT_POOL))
+
+
+def fan_out(fn, *args, **kwargs):
+    """
+    Run `fn` on the fan-out pool, for calls a request waits on; returns its Future.
+    A pool task that queued children and blocked on them could deadlock the pool
+    once every worker is doing the same, so on a pool `fn` runs right away in the
+    calling thread instead.
+    """
+    if not on_pool():
+        return _submit(FAN_OUT_POOL, fn, args, kwargs)
+    future = Future()
+    try:
+        future.set_result(fn(*args, **kwargs))
+    except Exception as exc:
+        future.set_exception(exc)
+    return future
+
+
+def _run_once(key, fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", key)
+    finally:
+        with _pending_lock:
+            _pending.discard(key)
+
+
+def submit_once(key, fn, *args, **kwargs):
+    """
+    Like submit(), but skipped while a task with the same key is still queued or
+    running in this worker. Failures are logged. Returns the Future, or None if skipped.
+    """
+    with _pending_lock:
+        if key in _pending:
+            return None
+        _pending.add(key)
+    return submit(_run_once, key, fn, args, kwargs)
@@ -0,0 +1,354 @@
+"""
+Bulk ingestion of Spotify catalog data into the local Artist/Album tables.
+"""
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Artist, Album, AlbumSnapshot, NewRelease, CatalogSync
+from .spotify import make_spotify_request, INTERACTIVE, BACKGROUND
+from .spotify_async import amake_spotify_request
+from .background import fan_out, submit_once
+from .spotify_cache import normalize_endpoint, cache_key, get_entry, store_stale
+from .projections import project, FULL, SLIM
+
+# Spotify's /v1/albums?ids= accepts at most 20 ids per call
+MULTI_ALBUM_BATCH_SIZE = 20
+NEW_RELEASES_PAGE_SIZE = 50
+NEW_RELEASES_SYNC = "new_releases"
+ARTIST_ALBUMS_PAGE_SIZE = 50
+# projection kept in AlbumSnapshot; it has every field upsert_albums() needs
+SNAPSHOT_VIEW = SLIM
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def relative_endpoint(url):
+    """Turn a Spotify paging link ("next") into an endpoint for make_spotify_request."""
+    if not url:
+        return None
+    parts = urlsplit(url)
+    return f"{parts.path}?{parts.query}" if parts.query else parts.path
+
+
+def album_row(album_json):
+    """Map a Spotify album object (full or simplified) to Album field values."""
+    release_date = album_json.get("release_date") or ""
+    images = album_json.get("images") or []
+    genres = album_json.get("genres") or []
+    return {
+        "spotify_id": album_json["id"],
+        "title": album_json["name"][:200],
+        "release_year": int(release_date[:4]) if release_date[:4].isdigit() else 0,
+        "genre": genres[0][:100] if genres else "Unknown",
+        "cover_url": images[0]["url"] if images else "",
+    }
+
+
+def _upsert_artists(artists_json):
+    """Upsert artists keyed on spotify_id; returns {spotify_id: Artist}."""
+    names = {a["id"]: a["name"][:100] for a in artists_json}
+    if not names:
+        return {}
+
+    # Artists created before we kept Spotify ids are matched by name and claimed
+    known = set(Artist.objects.filter(spotify_id__in=names).values_list("spotify_id", flat=True))
+    unclaimed = {a.name: a for a in Artist.objects.filter(spotify_id__isnull=True, name__in=names.values())}
+    claimed = []
+    for spotify_id, name in names.items():
+        if spotify_id not in known and name in unclaimed:
+            artist = unclaimed.pop(name)
+            artist.spotify_id = spotify_id
+            claimed.append(artist)
+    if claimed:
+        Artist.objects.bulk_update(claimed, ["spotify_id"])
+
+    Artist.objects.bulk_create(
+        [Artist(spotify_id=spotify_id, name=name) for spotify_id, name in names.items()],
+        update_conflicts=True,
+        unique_fields=["spotify_id"],
+        update_fields=["name"],
+    )
+    return {a.spotify_id: a for a in Artist.objects.filter(spotify_id__in=names)}
+
+
+@transaction.atomic
+def upsert_albums(albums_json):
+    """
+    Insert or update Album rows (and their artists) from Spotify album objects, keyed
+    on spotify_id, in a constant number of queries. Every artist on an album is added
+    to Album.artists; the first one is its primary artist.
+
+    Rows that would break the (title, artist) uniqueness are skipped: Spotify often
+    lists several editions of one album under the same title, and the first one wins.
+    Returns {spotify_id: Album} for every album that is now stored.
+    """
+    albums_json = [a for a in albums_json if a and a.get("artists")]
+    artists = _upsert_artists([artist for a in albums_json for artist in a["artists"]])
+
+    rows = {}
+    for album_json in albums_json:
+        row = album_row(album_json)
+        row["artist"] = artists[album_json["artists"][0]["id"]]
+        rows.setdefault(row["spotify_id"], row)
+    if not rows:
+        return {}
+
+    existing = {
+        (a.title, a.artist_id): a
+        for a in Album.objects.filter(
+            title__in={r["title"] for r in rows.values()},
+            artist__in={r["artist"].pk for r in rows.values()},
+        )
+    }
+    claimed, seen = [], set()
+    for spotify_id, row in list(rows.items()):
+        key = (row["title"], row["artist"].pk)
+        current = existing.get(key)
+        if key in seen or (current is not None and current.spotify_id not in (None, spotify_id)):
+            del rows[spotify_id]
+            continue
+        seen.add(key)
+        if current is not None and current.spotify_id is None:
+            current.spotify_id = spotify_id
+            claimed.append(current)
+    if claimed:
+        Album.objects.bulk_update(claimed, ["spotify_id"])
+
+    # Simplified album objects carry no genres, so don't let them erase a known genre
+    update_fields = ["title", "artist", "release_year", "cover_url"]
+    if all("genres" in a for a in albums_json):
+        update_fields.append("genre")
+    Album.objects.bulk_create(
+        [Album(**row) for row in rows.values()],
+        update_conflicts=True,
+        unique_fields=["spotify_id"],
+        update_fields=update_fields,
+    )
+    stored = {a.spotify_id: a for a in Album.objects.filter(spotify_id__in=rows).select_related("artist")}
+    Credit = Album.artists.through
+    Credit.objects.bulk_create(
+        [Credit(album_id=stored[a["id"]].pk, artist_id=artists[artist["id"]].pk)
+         for a in albums_json if a["id"] in stored for artist in a["artists"]],
+        ignore_conflicts=True,
+    )
+    return stored
+
+
+def fetch_albums(user, spotify_ids, priority=INTERACTIVE):
+    """Fetch full album objects, 20 ids per upstream call, with the calls in parallel."""
+    futures = [
+        fan_out(make_spotify_request, user, f"/v1/albums?ids={','.join(chunk)}", priority)
+        for chunk in chunked(list(spotify_ids), MULTI_ALBUM_BATCH_SIZE)
+    ]
+    albums_json = []
+    for future in futures:
+        # ids Spotify doesn't know come back as null entries
+        albums_json.extend(a for a in future.result().get("albums", []) if a)
+    return albums_json
+
+
+def save_snapshots(albums_json, etags=None):
+    """
+    Store (slim) album payloads as AlbumSnapshot rows, replacing older ones.
+    `etags` maps spotify_id to the ETag of a single-album response, where known.
+    """
+    now = timezone.now()
+    etags = etags or {}
+    AlbumSnapshot.objects.bulk_create(
+        [AlbumSnapshot(spotify_id=a["id"], payload=a, etag=etags.get(a["id"]) or "", fetched_at=now)
+         for a in albums_json if not getattr(a, "stale", False)],
+        update_conflicts=True,
+        unique_fields=["spotify_id"],
+        update_fields=["payload", "etag", "fetched_at"],
+    )
+
+
+def resolve_albums(user, spotify_ids, priority=INTERACTIVE):
+    """
+    Return {spotify_id: Album} for the given ids, creating the ones we don't have
+    yet from stored snapshots, or else from Spotify. Ids Spotify doesn't know are
+    left out of the result.
+    """
+    spotify_ids = list(dict.fromkeys(i for i in spotify_ids if i))
+    albums = {a.spotify_id: a for a in Album.objects.filter(spotify_id__in=spotify_ids).select_related("artist")}
+    missing = [i for i in spotify_ids if i not in albums]
+    if missing:
+        albums_json = list(AlbumSnapshot.objects.filter(spotify_id__in=missing).values_list("payload", flat=True))
+        stored = {a["id"] for a in albums_json}
+        fetched = fetch_albums(user, [i for i in missing if i not in stored], priority)
+        save_snapshots(fetched)
+        albums.update(upsert_albums(albums_json + fetched))
+    return albums
+
+
+def stored_edition(spotify_id):
+    """
+    The Album that upsert_albums() kept instead of this Spotify album: another edition
+    with the same title and primary artist, stored under a different spotify_id.
+    Judged from the album's snapshot; None if there is no such album.
+    """
+    payload = AlbumSnapshot.objects.filter(spotify_id=spotify_id).values_list("payload", flat=True).first()
+    if not payload or not payload.get("artists"):
+        return None
+    return (
+        Album.objects.filter(title=album_row(payload)["title"], artist__spotify_id=payload["artists"][0]["id"])
+        .exclude(spotify_id=spotify_id)
+        .select_related("artist")
+        .first()
+    )
+
+
+def refresh_album_snapshot(spotify_id, priority=BACKGROUND):
+    endpoint = normalize_endpoint(f"/v1/albums/{spotify_id}")
+    key = cache_key(endpoint, SNAPSHOT_VIEW)
+    if get_entry(key) is None:
+        # e.g. after a restart: revalidate the stored payload rather than download it again
+        snapshot = AlbumSnapshot.objects.filter(spotify_id=spotify_id).exclude(etag="").first()
+        if snapshot is not None:
+            store_stale(key, project("album", snapshot.payload, SNAPSHOT_VIEW), snapshot.etag)
+    payload = make_spotify_request(None, endpoint, priority, view=SNAPSHOT_VIEW)
+    entry = get_entry(key)
+    save_snapshots([payload], etags={spotify_id: entry.etag if entry is not None else None})
+    return payload
+
+
+def get_album_payload(spotify_id, view=SNAPSHOT_VIEW):
+    """
+    The Spotify payload for an album in the given projection, read from its snapshot
+    when there is one. Snapshots older than SPOTIFY_SNAPSHOT_TTL are returned as they
+    are while a background task refreshes them; unknown albums are fetched and stored
+    inline. Snapshots are slim, so the "full" view always goes to Spotify (or its cache).
+    """
+    if view == FULL:
+        return make_spotify_request(None, f"/v1/albums/{spotify_id}", INTERACTIVE, view=FULL)
+    snapshot = AlbumSnapshot.objects.filter(spotify_id=spotify_id).first()
+    if snapshot is None:
+        payload = refresh_album_snapshot(spotify_id, priority=INTERACTIVE)
+    else:
+        if timezone.now() - snapshot.fetched_at > timedelta(seconds=settings.SPOTIFY_SNAPSHOT_TTL):
+            submit_once(("album-snapshot", spotify_id), refresh_album_snapshot, spotify_id)
+        payload = snapshot.payload
+    return project("album", payload, view)
+
+
+async def arefresh_album_snapshot(spotify_id, priority=INTERACTIVE):
+    """refresh_album_snapshot() for async callers."""
+    payload = await amake_spotify_request(None, f"/v1/albums/{spotify_id}", priority, view=SNAPSHOT_VIEW)
+    entry = await sync_to_async(get_entry)(cache_key(normalize_endpoint(f"/v1/albums/{spotify_id}"), SNAPSHOT_VIEW))
+    await sync_to_async(save_snapshots)([payload], etags={spotify_id: entry.etag if entry is not None else None})
+    return payload
+
+
+async def aget_album_payload(spotify_id, view=SNAPSHOT_VIEW):
+    """get_album_payload() for async callers."""
+    if view == FULL:
+        return await amake_spotify_request(None, f"/v1/albums/{spotify_id}", INTERACTIVE, view=FULL)
+    snapshot = await AlbumSnapshot.objects.filter(spotify_id=spotify_id).afirst()
+    if snapshot is None:
+        payload = await arefresh_album_snapshot(spotify_id)
+    else:
+        if timezone.now() - snapshot.fetched_at > timedelta(seconds=settings.SPOTIFY_SNAPSHOT_TTL):
+            submit_once(("album-snapshot", spotify_id), refresh_album_snapshot, spotify_id)
+        payload = snapshot.payload
+    return project("album", payload, view)
+
+
+def _take_prefetch_budget(user_id, wanted):
+    """Claim up to `wanted` album prefetches from the user's budget; returns how many were granted."""
+    cache = caches[settings.SPOTIFY_CACHE_ALIAS]
+    key = f"spotify:prefetch-budget:{user_id}"
+    cache.add(key, 0, settings.SPOTIFY_SEARCH_PREFETCH_WINDOW)
+    try:
+        used = cache.incr(key, wanted)
+    except ValueError:  # the window expired in between
+        return 0
+    return max(min(wanted, settings.SPOTIFY_SEARCH_PREFETCH_BUDGET - (used - wanted)), 0)
+
+
+def prefetch_album_snapshots(user_id, spotify_ids):
+    """
+    Warm the snapshots of albums a user is likely to open next (e.g. top search results)
+    at background priority. Albums with a fresh snapshot or a refresh already queued
+    are skipped; the rest are limited by the user's prefetch budget.
+    """
+    fresh_since = timezone.now() - timedelta(seconds=settings.SPOTIFY_SNAPSHOT_TTL)
+    fresh = set(AlbumSnapshot.objects.filter(spotify_id__in=spotify_ids, fetched_at__gte=fresh_since)
+                .values_list("spotify_id", flat=True))
+    wanted = [i for i in dict.fromkeys(spotify_ids) if i not in fresh]
+    if not wanted:
+        return
+    for spotify_id in wanted[:_take_prefetch_budget(user_id, len(wanted))]:
+        # same key as get_album_payload's refresh, so an album is never fetched twice at once
+        submit_once(("album-snapshot", spotify_id), refresh_album_snapshot, spotify_id)
+
+
+def sync_new_releases(user, max_items=100, priority=BACKGROUND):
+    """
+    Page through Spotify's new releases, upsert the albums and replace the local
+    NewRelease list in one transaction, then record the sync watermark.
+    Returns the number of releases stored.
+    """
+    items = []
+    endpoint = f"/v1/browse/new-releases?limit={NEW_RELEASES_PAGE_SIZE}&offset=0"
+    while endpoint and len(items) < max_items:
+        page = make_spotify_request(user, endpoint, priority).get("albums", {})
+        items.extend(page.get("items", []))
+        endpoint = relative_endpoint(page.get("next"))
+    items = items[:max_items]
+
+    with transaction.atomic():
+        albums = upsert_albums(items)
+        ordered = list(dict.fromkeys(i["id"] for i in items if i["id"] in albums))
+        NewRelease.objects.all().delete()
+        NewRelease.objects.bulk_create(
+            [NewRelease(album=albums[spotify_id], position=pos) for pos, spotify_id in enumerate(ordered)]
+        )
+        CatalogSync.objects.update_or_create(
+            name=NEW_RELEASES_SYNC,
+            defaults={"synced_at": timezone.now(), "item_count": len(ordered)},
+        )
+    return len(ordered)
+
+
+def crawl_discography(user, artist_spotify_id, include_groups="album,single", priority=INTERACTIVE):
+    """
+    Fetch an artist's full discography and upsert it locally.
+    The first page tells us the total; the remaining pages are fetched by offset,
+    SPOTIFY_DISCOGRAPHY_CONCURRENCY at a time (one at a time when this is itself a
+    background crawl). The artist is stored first, so that it is marked as crawled
+    even when none of its albums name it as primary artist (or it has none).
+    Returns the number of albums stored.
+    """
+    def endpoint(offset):
+        return (f"/v1/artists/{artist_spotify_id}/albums?include_groups={include_groups}"
+                f"&limit={ARTIST_ALBUMS_PAGE_SIZE}&offset={offset}")
+
+    if not Artist.objects.filter(spotify_id=artist_spotify_id).exists():
+        _upsert_artists([make_spotify_request(user, f"/v1/artists/{artist_spotify_id}", priority)])
+
+    first = make_spotify_request(user, endpoint(0), priority)
+    items = list(first.get("items", []))
+    offsets = list(range(ARTIST_ALBUMS_PAGE_SIZE, first.get("total", 0), ARTIST_ALBUMS_PAGE_SIZE))
+    for window in chunked(offsets, settings.SPOTIFY_DISCOGRAPHY_CONCURRENCY):
+        futures = [fan_out(make_spotify_request, user, endpoint(offset), priority) for offset in window]
+        for future in futures:
+            items.extend(future.result().get("items", []))
+
+    albums = upsert_albums(items)
+    Artist.objects.filter(spotify_id=artist_spotify_id).update(discography_synced_at=timezone.now())
+    return len(albums)
+
+
+def schedule_discography_crawl(user, artist_spotify_id):
+    """Queue a background crawl unless one for this artist is already running here."""
+    submit_once(("discography", artist_spotify_id), crawl_discography, user, artist_spotify_id,
+                priority=BACKGROUND)
@@ -0,0 +1,365 @@
+"""
+A stand-in for the Spotify Web API, for load tests and local development.
+
+It serves a deterministic synthetic catalog (the same seed and size always give the
+same albums, artists and search results) on the endpoints the client uses:
+accounts token, search, albums, multi-album, artist albums and new releases.
+Latency, 429s and 5xx can be injected. Run it with `manage.py fake_spotify` and
+point SPOTIFY_API_BASE_URL and SPOTIFY_TOKEN_URL at it.
+"""
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+BASE62 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+ALBUM_PREFIX = "fA"
+ARTIST_PREFIX = "fR"
+TRACK_PREFIX = "fT"
+
+WORDS = (
+    "midnight", "echo", "river", "golden", "neon", "silent", "wild", "paper", "summer", "ghost",
+    "velvet", "fire", "ocean", "glass", "city", "dream", "electric", "blue", "storm", "honey",
+    "shadow", "crystal", "highway", "garden", "moon", "static", "winter", "sugar", "thunder", "satellite",
+)
+GENRES = ("rock", "pop", "indie", "jazz", "hip hop", "electronic", "folk", "soul", "metal", "ambient")
+MARKETS = ("AD", "AR", "AT", "AU", "BE", "BG", "BO", "BR", "CA", "CH", "CL", "CO", "CR", "CY", "CZ", "DE",
+           "DK", "DO", "EC", "EE", "ES", "FI", "FR", "GB", "GR", "GT", "HK", "HN", "HU", "ID", "IE", "IS",
+           "IT", "JP", "LT", "LU", "LV", "MX", "MY", "NI", "NL", "NO", "NZ", "PA", "PE", "PH", "PL", "PT",
+           "PY", "SE", "SG", "SK", "SV", "TR", "TW", "US", "UY", "ZA")
+NEW_RELEASES = 100
+SEARCH_TOTAL_MAX = 1000
+
+
+def spotify_id(prefix, n):
+    """A 22-character base62 id that encodes `n`, e.g. album_id(7) == "fA00000000000000000007"."""
+    digits = ""
+    while True:
+        n, rest = divmod(n, 62)
+        digits = BASE62[rest] + digits
+        if not n:
+            break
+    return prefix + digits.rjust(22 - len(prefix), "0")
+
+
+def parse_id(prefix, value):
+    """The number encoded in an id made by spotify_id(), or None if it isn't one of ours."""
+    if len(value) != 22 or not value.startswith(prefix):
+        return None
+    n = 0
+    for char in value[len(prefix):]:
+        digit = BASE62.find(char)
+        if digit < 0:
+            return None
+        n = n * 62 + digit
+    return n
+
+
+def album_id(n):
+    return spotify_id(ALBUM_PREFIX, n)
+
+
+def artist_id(n):
+    return spotify_id(ARTIST_PREFIX, n)
+
+
+def _title(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).title()
+
+
+class Catalog:
+    """`size` albums by size // 8 artists, generated on demand from `seed`."""
+
+    def __init__(self, size=5000, seed=0, base_url="http://127.0.0.1:8001/"):
+        self.size = size
+        self.artists = max(size // 8, 1)
+        self.seed = seed
+        self.base_url = base_url
+
+    def _rng(self, kind, n):
+        return random.Random(f"{self.seed}:{kind}:{n}")
+
+    def _images(self, kind, n):
+        url = f"https://i.scdn.co/image/{kind}{self.seed}{n:08d}"
+        return [{"url": f"{url}?s={size}", "height": size, "width": size} for size in (640, 300, 64)]
+
+    def artist(self, n):
+        rng = self._rng("artist", n)
+        return {
+            "id": artist_id(n),
+            "name": _title(rng, rng.randint(1, 2)),
+            "type": "artist",
+            "uri": f"spotify:artist:{artist_id(n)}",
+            "href": f"{self.base_url}v1/artists/{artist_id(n)}",
+            "external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id(n)}"},
+            "genres": rng.sample(GENRES, 2),
+            "popularity": rng.randint(0, 100),
+            "followers": {"href": None, "total": rng.randint(0, 10 ** 6)},
+            "images": self._images("ar", n),
+        }
+
+    def _artist_ref(self, n):
+        artist = self.artist(n)
+        return {key: artist[key] for key in ("id", "name", "type", "uri", "href", "external_urls")}
+
+    def simple_album(self, n):
+        rng = self._rng("album", n)
+        return {
+            "id": album_id(n),
+            "name": _title(rng, rng.randint(1, 3)),
+            "album_type": rng.choice(("album", "album", "single", "compilation")),
+            "type": "album",
+            "uri": f"spotify:album:{album_id(n)}",
+            "href": f"{self.base_url}v1/albums/{album_id(n)}",
+            "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id(n)}"},
+            "release_date": f"{1960 + n % 66}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "release_date_precision": "day",
+            "total_tracks": rng.randint(6, 16),
+            "available_markets": list(MARKETS),
+            "artists": [self._artist_ref(n % self.artists)],
+            "images": self._images("al", n),
+        }
+
+    def track(self, n, number, album=None):
+        rng = self._rng("track", n * 100 + number)
+        track = {
+            "id": spotify_id(TRACK_PREFIX, n * 100 + number),
+            "name": _title(rng, rng.randint(1, 4)),
+            "type": "track",
+            "track_number": number,
+            "disc_number": 1,
+            "duration_ms": rng.randint(90_000, 420_000),
+            "explicit": rng.random() < 0.1,
+            "preview_url": None,
+            "available_markets": list(MARKETS),
+            "artists": [self._artist_ref(n % self.artists)],
+        }
+        if album is not None:
+            track["album"] = album
+        return track
+
+    def album(self, n):
+        album = self.simple_album(n)
+        rng = self._rng("album-extra", n)
+        tracks = [self.track(n, number) for number in range(1, album["total_tracks"] + 1)]
+        album.update({
+            "genres": rng.sample(GENRES, rng.randint(0, 2)),
+            "label": _title(rng, 1) + " Records",
+            "popularity": rng.randint(0, 100),
+            "copyrights": [{"text": f"(C) {album['release_date'][:4]} {album['artists'][0]['name']}", "type": "C"}],
+            "external_ids": {"upc": f"{n:012d}"},
+            "tracks": self.page(f"v1/albums/{album['id']}/tracks", {}, tracks, len(tracks), 50, 0),
+        })
+        return album
+
+    def page(self, path, params, items, total, limit, offset):
+        def link(at):
+            return f"{self.base_url}{path}?{urlencode({**params, 'offset': at, 'limit': limit})}"
+        return {
+            "href": link(offset),
+            "items": items,
+            "limit": limit,
+            "offset": offset,
+            "total": total,
+            "next": link(offset + limit) if offset + limit < total else None,
+            "previous": link(max(offset - limit, 0)) if offset else None,
+        }
+
+    def artist_albums(self, n, params, limit, offset):
+        total = len(range(n, self.size, self.artists))
+        numbers = range(n + offset * self.artists, self.size, self.artists)[:limit]
+        return self.page(f"v1/artists/{artist_id(n)}/albums", params,
+                         [self.simple_album(i) for i in numbers], total, limit, offset)
+
+    def new_releases(self, params, limit, offset):
+        # the newest albums are the last ones in the catalog
+        total = min(NEW_RELEASES, self.size)
+        numbers = [self.size - 1 - i for i in range(offset, min(offset + limit, total))]
+        return {"albums": self.page("v1/browse/new-releases", params,
+                                    [self.simple_album(i) for i in numbers], total, limit, offset)}
+
+    def search(self, query, types, params, limit, offset):
+        # the same query always matches the same items, in the same order
+        digest = int(hashlib.sha1(query.lower().encode()).hexdigest(), 16)
+        total = 20 + digest % SEARCH_TOTAL_MAX
+        positions = range(offset, min(offset + limit, total))
+        numbers = [(digest + i * 7919) % self.size for i in positions]
+        results = {}
+        for item_type in types:
+            if item_type == "album":
+                items = [self.simple_album(n) for n in numbers]
+            elif item_type == "artist":
+                items = [self.artist(n % self.artists) for n in numbers]
+            elif item_type == "track":
+                items = [self.track(n, 1 + n % 6, album=self.simple_album(n)) for n in numbers]
+            else:
+                # playlists, shows... are not part of the catalog
+                results[item_type + "s"] = self.page("v1/search", params, [], 0, limit, offset)
+                continue
+            results[item_type + "s"] = self.page("v1/search", params, items, total, limit, offset)
+        return results
+
+
+def parse_latency(spec):
+    """
+    Turn a latency spec into a function returning seconds to wait:
+    "50" (fixed ms), "uniform:20:80" (ms) or "lognormal:40:0.6" (median ms, sigma).
+    """
+    name, _, args = (spec or "0").partition(":")
+    try:
+        values = [float(value) for value in args.split(":")] if args else []
+        if not args:
+            ms = float(name)
+            return lambda rng: ms / 1000
+        if name == "uniform":
+            low, high = values
+            return lambda rng: rng.uniform(low, high) / 1000
+        if name == "lognormal":
+            median, sigma = values
+            return lambda rng: rng.lognormvariate(math.log(median), sigma) / 1000
+    except ValueError:
+        pass
+    raise ValueError(f"bad latency spec {spec!r}: use MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA")
+
+
+class Faults:
+    """Injected latency and errors. Rates are probabilities per API request."""
+
+    def __init__(self, latency="0", throttle_rate=0.0, error_rate=0.0, retry_after=1, seed=None):
+        self.latency = parse_latency(latency)
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """(seconds to wait, status to fail with or None) for one request."""
+        with self._lock:
+            delay = self.latency(self._rng)
+            roll = self._rng.random()
+            error = self._rng.choice((500, 502, 503))
+        if roll < self.throttle_rate:
+            return delay, 429
+        if roll < self.throttle_rate + self.error_rate:
+            return delay, error
+        return delay, None
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeSpotify"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.server.count(status)  # before the client can see the response
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message, headers=None):
+        self._send(status, {"error": {"status": status, "message": message}}, headers)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = parse_qs(self.rfile.read(length).decode())
+        if urlsplit(self.path).path.rstrip("/") != "/api/token":
+            return self._error(404, "Not found")
+        time.sleep(self.server.faults.draw()[0])
+        grant_type = form.get("grant_type", [""])[0]
+        if grant_type not in ("client_credentials", "authorization_code", "refresh_token"):
+            return self._send(400, {"error": "unsupported_grant_type"})
+        token = {"access_token": f"fake-{grant_type}-{time.time_ns()}", "token_type": "Bearer",
+                 "expires_in": 3600, "scope": ""}
+        if grant_type == "authorization_code":
+            token["refresh_token"] = f"fake-refresh-{time.time_ns()}"
+        self._send(200, token)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self._error(401, "No token provided")
+
+        delay, fault = self.server.faults.draw()
+        time.sleep(delay)
+        if fault == 429:
+            return self._error(429, "API rate limit exceeded", {"Retry-After": str(self.server.faults.retry_after)})
+        if fault:
+            return self._error(fault, "Injected failure")
+
+        try:
+            body = self._route(parts, params)
+        except ValueError as exc:
+            return self._error(400, str(exc))
+        if body is None:
+            return self._error(404, "Non existing id")
+
+        if len(parts) == 3 and parts[1] == "albums":
+            etag = f'"{self.server.catalog.seed}-{parts[2]}"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, headers={"ETag": etag})
+            return self._send(200, body, {"ETag": etag})
+        self._send(200, body)
+
+    def _route(self, parts, params):
+        catalog = self.server.catalog
+        limit = int(params.get("limit", 20))
+        offset = int(params.get("offset", 0))
+        if not 1 <= limit <= 50 or offset < 0:
+            raise ValueError("Invalid limit or offset")
+
+        if parts == ["v1", "search"]:
+            if not params.get("q") or not params.get("type"):
+                raise ValueError("No search query")
+            return catalog.search(params["q"], params["type"].split(","), params, limit, offset)
+        if parts == ["v1", "albums"]:
+            numbers = [parse_id(ALBUM_PREFIX, value) for value in params.get("ids", "").split(",")]
+            if len(numbers) > 20:
+                raise ValueError("Too many ids requested")
+            return {"albums": [catalog.album(n) if n is not None and n < catalog.size else None for n in numbers]}
+        if len(parts) == 3 and parts[:2] == ["v1", "albums"]:
+            n = parse_id(ALBUM_PREFIX, parts[2])
+            return catalog.album(n) if n is not None and n < catalog.size else None
+        if len(parts) == 3 and parts[:2] == ["v1", "artists"]:
+            n = parse_id(ARTIST_PREFIX, parts[2])
+            return catalog.artist(n) if n is not None and n < catalog.artists else None
+        if len(parts) == 4 and parts[:2] == ["v1", "artists"] and parts[3] == "albums":
+            n = parse_id(ARTIST_PREFIX, parts[2])
+            if n is None or n >= catalog.artists:
+                return None
+            return catalog.artist_albums(n, params, limit, offset)
+        if parts == ["v1", "browse", "new-releases"]:
+            return catalog.new_releases(params, limit, offset)
+        return None
+
+
+class FakeSpotifyServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, catalog, faults, verbose=False):
+        super().__init__(address, FakeSpotifyHandler)
+        self.catalog = catalog
+        self.faults = faults
+        self.verbose = verbose
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, status):
+        with self._lock:
+            self.statuses[status] += 1
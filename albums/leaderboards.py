@@ -0,0 +1,139 @@
+"""
+Precomputed top-rated rankings: one global, one per genre and one per release year.
+
+Albums are ranked by a Bayesian average of their ratings,
+
+    score = (C * m + rating_sum) / (C + review_count)
+
+where m is the mean rating over all reviews and C is LEADERBOARD_PRIOR_WEIGHT: an
+album's score starts at m and moves towards its own average as reviews accumulate,
+so a single 5-star review no longer outranks hundreds of 4.8s.
+
+Each ranking keeps its top LEADERBOARD_SIZE albums as LeaderboardEntry rows, so a
+page of it is an index range read. When an album's rating changes, its rankings are
+recomputed in the background from the rating columns on Album (see ratings.py); a
+ranking that is already being refreshed is not queued again, so it may miss the
+latest review until the next one. `manage.py refresh_leaderboards` rebuilds them
+all, with a fresh m, and drops rankings that have become empty; run it on a schedule.
+"""
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import ExpressionWrapper, F, FloatField, Sum, Value
+from django.db.models.functions import Lower, Trim
+from django.utils import timezone
+
+from .models import Album, Leaderboard, LeaderboardEntry
+from .background import submit_once
+
+GLOBAL, GENRE, YEAR = Leaderboard.GLOBAL, Leaderboard.GENRE, Leaderboard.YEAR
+
+# one ranking written at a time per worker, however many reviews come in at once
+_refresh_lock = threading.Lock()
+
+
+def normalize_genre(genre):
+    return (genre or "").strip().lower()
+
+
+def global_mean():
+    """Mean rating over all reviews, from the rating columns."""
+    totals = Album.objects.aggregate(total=Sum("rating_sum"), count=Sum("review_count"))
+    return totals["total"] / totals["count"] if totals["count"] else 0.0
+
+
+def prior_mean():
+    """The m the current rankings were built with, so refreshed ones stay comparable."""
+    mean = Leaderboard.objects.filter(scope=GLOBAL, key="").values_list("prior_mean", flat=True).first()
+    return global_mean() if mean is None else mean
+
+
+def bayesian_score(mean):
+    weight = settings.LEADERBOARD_PRIOR_WEIGHT
+    return ExpressionWrapper(
+        (F("rating_sum") + Value(weight * mean)) / (F("review_count") + Value(weight)),
+        output_field=FloatField(),
+    )
+
+
+def ranked_albums(scope, key=""):
+    albums = Album.objects.filter(review_count__gte=max(settings.LEADERBOARD_MIN_REVIEWS, 1))
+    if scope == GENRE:
+        albums = albums.alias(genre_key=Lower(Trim("genre"))).filter(genre_key=key)
+    elif scope == YEAR:
+        albums = albums.filter(release_year=int(key))
+    return albums
+
+
+def refresh_leaderboard(scope, key="", mean=None):
+    """Recompute one ranking and return its Leaderboard."""
+    if mean is None:
+        mean = prior_mean()
+    # rank outside the transaction; only swapping the entries in needs it (and the lock)
+    ranked = list(
+        ranked_albums(scope, key).annotate(score=bayesian_score(mean))
+        .order_by("-score", "-review_count", "pk")
+        .values_list("pk", "score")[:settings.LEADERBOARD_SIZE]
+    )
+    with _refresh_lock, transaction.atomic():
+        board, _ = Leaderboard.objects.update_or_create(
+            scope=scope, key=key, defaults={"prior_mean": mean, "refreshed_at": timezone.now()},
+        )
+        board.entries.all().delete()
+        LeaderboardEntry.objects.bulk_create([
+            LeaderboardEntry(leaderboard=board, rank=rank, album_id=album_id, score=score)
+            for rank, (album_id, score) in enumerate(ranked, start=1)
+        ])
+    return board
+
+
+def rebuild_leaderboards():
+    """Recompute every ranking with a fresh mean rating. Returns the number of rankings."""
+    mean = global_mean()
+    albums = ranked_albums(GLOBAL)
+    genres = {normalize_genre(genre) for genre in albums.values_list("genre", flat=True).distinct()} - {""}
+    years = albums.values_list("release_year", flat=True).distinct()
+    slices = [(GLOBAL, "")] + [(GENRE, genre) for genre in sorted(genres)] + [(YEAR, str(year)) for year in years]
+
+    kept = [refresh_leaderboard(scope, key, mean).pk for scope, key in slices]
+    Leaderboard.objects.exclude(pk__in=kept).delete()
+    return len(kept)
+
+
+def album_slices(album_id):
+    """The rankings an album can appear in."""
+    album = Album.objects.filter(pk=album_id).values("genre", "release_year").first()
+    if album is None:
+        return [(GLOBAL, "")]
+    slices = [(GLOBAL, ""), (YEAR, str(album["release_year"]))]
+    genre = normalize_genre(album["genre"])
+    if genre:
+        slices.append((GENRE, genre))
+    return slices
+
+
+def _refresh_album_leaderboards(album_ids):
+    for scope, key in {s for album_id in album_ids for s in album_slices(album_id)}:
+        submit_once(("leaderboard", scope, key), refresh_leaderboard, scope, key)
+
+
+def schedule_refresh(album_ids):
+    """Re-rank the leaderboards of these albums in the background, once the current transaction commits."""
+    if album_ids and settings.LEADERBOARD_REFRESH_ON_REVIEW:
+        album_ids = list(album_ids)
+        transaction.on_commit(lambda: submit_once(
+            ("leaderboard-albums", *album_ids), _refresh_album_leaderboards, album_ids,
+        ))
+
+
+def get_leaderboard(scope, key=""):
+    """The stored ranking, built on first use; None for a genre or year without ranked albums."""
+    board = Leaderboard.objects.filter(scope=scope, key=key).first()
+    if board is None and (scope == GLOBAL or ranked_albums(scope, key).exists()):
+        board = refresh_leaderboard(scope, key)
+    return board
+
+
+def leaderboard_page(board, offset, limit):
+    return list(board.entries.select_related("album__artist")[offset:offset + limit])
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from albums.catalog import crawl_discography
+from albums.spotify import BACKGROUND
+
+
+class Command(BaseCommand):
+    help = "Crawl the full discography of one or more Spotify artists into the local catalog."
+
+    def add_arguments(self, parser):
+        parser.add_argument("artist_ids", nargs="+", help="Spotify artist ids.")
+        parser.add_argument("--include-groups", default="album,single")
+
+    def handle(self, *args, **options):
+        for artist_id in options["artist_ids"]:
+            count = crawl_discography(None, artist_id, include_groups=options["include_groups"],
+                                      priority=BACKGROUND)
+            self.stdout.write(f"{artist_id}: {count} albums stored")
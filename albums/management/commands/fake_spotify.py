@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from albums.fake_spotify import Catalog, Faults, FakeSpotifyServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve a fake Spotify API with a synthetic catalog, for load tests. Point the app at it with "
+        "SPOTIFY_API_BASE_URL=http://HOST:PORT/ and SPOTIFY_TOKEN_URL=http://HOST:PORT/api/token."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--catalog-size", type=int, default=5000, help="Number of albums (default 5000).")
+        parser.add_argument("--seed", type=int, default=0, help="Catalog seed; the same seed gives the same catalog.")
+        parser.add_argument("--latency", default="lognormal:40:0.5",
+                            help="Per-request latency: MS, uniform:LOW:HIGH or lognormal:MEDIAN:SIGMA "
+                                 "(default lognormal:40:0.5).")
+        parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of API requests answered 429.")
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of injected 429s (seconds).")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of API requests answered 5xx.")
+        parser.add_argument("--verbose", action="store_true", help="Log every request.")
+
+    def handle(self, *args, **options):
+        try:
+            faults = Faults(options["latency"], options["throttle_rate"], options["error_rate"],
+                            options["retry_after"], seed=options["seed"])
+        except ValueError as exc:
+            raise CommandError(exc)
+        base_url = f"http://{options['host']}:{options['port']}/"
+        catalog = Catalog(options["catalog_size"], options["seed"], base_url)
+        server = FakeSpotifyServer((options["host"], options["port"]), catalog, faults, options["verbose"])
+
+        self.stdout.write(f"fake Spotify serving {catalog.size} albums at {base_url} (Ctrl-C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write("responses: " + ", ".join(f"{status}: {count}"
+                                                         for status, count in sorted(server.statuses.items())))
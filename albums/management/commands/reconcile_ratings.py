@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from albums.ratings import reconcile_ratings
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Album.rating_sum, review_count and avg_rating from the reviews table where they "
+        "have drifted (e.g. after bulk imports or raw SQL). Safe to run at any time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="Only count the albums that drifted.")
+
+    def handle(self, *args, **options):
+        count = reconcile_ratings(batch_size=options["batch_size"], dry_run=options["dry_run"])
+        verb = "found" if options["dry_run"] else "fixed"
+        self.stdout.write(f"{verb} {count} albums with drifted ratings")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from albums.leaderboards import rebuild_leaderboards, global_mean
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the top-rated leaderboards (global, per genre and per release year) with a fresh "
+        "mean rating. Meant to run on a schedule (e.g. cron hourly)."
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild_leaderboards()
+        self.stdout.write(f"rebuilt {count} leaderboards (mean rating {global_mean():.3f})")
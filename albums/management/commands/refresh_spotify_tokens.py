@@ -0,0 +1,112 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Min, Q
+from django.utils import timezone
+
+from albums.models import SpotifyToken
+from albums.spotify import refresh_access_token, tokens_response_to_saved_fields, apply_token_fields
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh Spotify tokens that expire within the next N minutes, in batches, "
+        "so user requests never have to refresh inline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--within", type=int, default=10,
+                            help="Refresh tokens expiring within this many minutes (default 10).")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=8,
+                            help="Concurrent requests to Spotify's token endpoint.")
+        parser.add_argument("--loop", action="store_true",
+                            help="Keep running, sweeping every --interval seconds.")
+        parser.add_argument("--interval", type=int, default=60)
+
+    def handle(self, *args, **options):
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                self.sweep(executor, options)
+                if not options["loop"]:
+                    break
+                time.sleep(options["interval"])
+
+    def sweep(self, executor, options):
+        started = time.monotonic()
+        refreshed, failed, attempted = 0, [], set()
+        while True:
+            count, errors, ids = self.refresh_batch(executor, options, attempted)
+            if not ids:
+                break
+            attempted.update(ids)
+            refreshed += count
+            failed.extend(errors)
+        elapsed = time.monotonic() - started
+
+        for user_id, exc in failed:
+            self.stderr.write(f"user {user_id}: {exc}")
+        rate = refreshed / elapsed if elapsed else 0
+        self.stdout.write(
+            f"refreshed {refreshed}, failed {len(failed)} in {elapsed:.2f}s ({rate:.1f} tokens/s); "
+            f"{self.lead_report(options)}"
+        )
+
+    def refresh_batch(self, executor, options, attempted):
+        """
+        Refresh one batch of due tokens concurrently, then write them back with a single
+        bulk_update. No row is locked during the calls to Spotify; the write-back locks
+        the batch briefly and skips tokens a request refreshed in the meantime.
+        """
+        cutoff = timezone.now() + timedelta(minutes=options["within"])
+        tokens = list(
+            SpotifyToken.objects.filter(Q(expires_at__lte=cutoff) | Q(expires_at__isnull=True))
+            .exclude(pk__in=attempted)
+            .order_by("expires_at")[:options["batch_size"]]
+        )
+        if not tokens:
+            return 0, [], []
+
+        results = executor.map(self.fetch, [t.refresh_token for t in tokens])
+        fetched, errors = {}, []
+        for token_obj, (token_json, exc) in zip(tokens, results):
+            if exc is not None:
+                errors.append((token_obj.user_id, exc))
+            else:
+                fetched[token_obj.pk] = (token_obj.access_token, token_json)
+
+        updated, fields = [], set()
+        with transaction.atomic():
+            for token_obj in SpotifyToken.objects.select_for_update().filter(pk__in=fetched):
+                stale_access_token, token_json = fetched[token_obj.pk]
+                if token_obj.access_token != stale_access_token:
+                    continue  # refreshed by a request while we were fetching
+                changed = apply_token_fields(token_obj, tokens_response_to_saved_fields(token_json))
+                if changed:
+                    updated.append(token_obj)
+                    fields.update(changed)
+            if updated:
+                SpotifyToken.objects.bulk_update(updated, sorted(fields))
+        return len(updated), errors, [t.pk for t in tokens]
+
+    @staticmethod
+    def fetch(refresh_token):
+        # runs on the pool: HTTP only, no ORM access
+        try:
+            return refresh_access_token(refresh_token), None
+        except Exception as exc:
+            return None, exc
+
+    def lead_report(self, options):
+        """How far ahead of expiry the fleet is after the sweep."""
+        now = timezone.now()
+        cutoff = now + timedelta(minutes=options["within"])
+        earliest = SpotifyToken.objects.aggregate(earliest=Min("expires_at"))["earliest"]
+        still_due = SpotifyToken.objects.filter(Q(expires_at__lte=cutoff) | Q(expires_at__isnull=True)).count()
+        if earliest is None:
+            return f"{still_due} tokens still due"
+        lead = (earliest - now).total_seconds() / 60
+        return f"earliest expiry in {lead:.1f} min, {still_due} tokens still due"
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from albums.catalog import resolve_albums
+from albums.spotify import BACKGROUND
+
+
+class Command(BaseCommand):
+    help = "Create or update local albums for a list of Spotify album ids (20 ids per upstream call)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("ids", nargs="*", help="Spotify album ids.")
+        parser.add_argument("--file", help="Read ids from this file, one per line.")
+
+    def handle(self, *args, **options):
+        ids = list(options["ids"])
+        if options["file"]:
+            with open(options["file"]) as fh:
+                ids.extend(line.strip() for line in fh if line.strip())
+        if not ids:
+            raise CommandError("Give at least one Spotify album id, or --file.")
+
+        albums = resolve_albums(None, ids, priority=BACKGROUND)
+        missing = [i for i in dict.fromkeys(ids) if i not in albums]
+        for spotify_id in missing:
+            self.stderr.write(f"not found or skipped: {spotify_id}")
+        self.stdout.write(f"{len(albums)} albums resolved, {len(missing)} missing")
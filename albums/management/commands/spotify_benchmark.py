@@ -0,0 +1,151 @@
+import itertools
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from albums.fake_spotify import WORDS, album_id, artist_id
+from albums.spotify_ledger import percentile
+
+DEFAULT_MIX = "search=35,album=25,details=25,new_releases=10,artist=5"
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights of ranks 0..n-1 under a Zipf distribution: rank 0 is the most popular."""
+    return list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(n)))
+
+
+class Traffic:
+    """
+    Draws requests like the app's users make them: a few albums, artists and search
+    terms get most of the traffic, most searches are for albums on the first page.
+    Ids are from the fake_spotify catalog of the same size.
+    """
+
+    def __init__(self, mix, catalog_size, skew):
+        self.routes = list(mix)
+        self.route_weights = list(itertools.accumulate(mix.values()))
+        self.albums = zipf_weights(catalog_size, skew)
+        self.artists = zipf_weights(max(catalog_size // 8, 1), skew)
+        self.words = zipf_weights(len(WORDS), skew)
+
+    def _pick(self, rng, cum_weights):
+        return rng.choices(range(len(cum_weights)), cum_weights=cum_weights)[0]
+
+    def draw(self, rng):
+        """(route, path) of one request."""
+        route = rng.choices(self.routes, cum_weights=self.route_weights)[0]
+        if route == "search":
+            words = [WORDS[self._pick(rng, self.words)] for _ in range(rng.choice((1, 1, 2)))]
+            params = {"q": " ".join(words), "type": rng.choices(("album", "album,artist,track", "artist"),
+                                                                 weights=(60, 25, 15))[0]}
+            if rng.random() < 0.15:
+                params["offset"] = rng.choice((10, 20))
+            return route, "/api/spotify/search/?" + urlencode(params)
+        if route == "album":
+            return route, f"/api/spotify/albums/{album_id(self._pick(rng, self.albums))}/"
+        if route == "details":
+            return route, f"/api/album-details/{album_id(self._pick(rng, self.albums))}/"
+        if route == "new_releases":
+            return route, "/api/spotify/browse/new-releases/?limit=20"
+        return route, f"/api/spotify/artists/{artist_id(self._pick(rng, self.artists))}/albums/"
+
+
+def parse_mix(value):
+    try:
+        mix = {name: float(weight) for name, weight in (part.split("=") for part in value.split(","))}
+    except ValueError:
+        raise CommandError(f"bad --mix {value!r}: use route=weight,... e.g. {DEFAULT_MIX}")
+    unknown = set(mix) - {"search", "album", "details", "new_releases", "artist"}
+    if unknown:
+        raise CommandError(f"unknown routes in --mix: {', '.join(sorted(unknown))}")
+    return mix
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a realistic mix of requests against /api/spotify/* and /api/album-details/* of a running "
+        "server and report throughput and latency percentiles. Album and artist ids are from the "
+        "fake_spotify catalog, so run the server against `manage.py fake_spotify` with the same --catalog-size."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server to load (default %(default)s).")
+        parser.add_argument("--username", help="Mint an access token for this user (the server must share SECRET_KEY).")
+        parser.add_argument("--token", help="JWT access token to send instead.")
+        parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients (default 16).")
+        parser.add_argument("--duration", type=float, default=30, help="Seconds to run (default 30).")
+        parser.add_argument("--requests", type=int, help="Stop after this many requests.")
+        parser.add_argument("--mix", default=DEFAULT_MIX, help="Route weights (default %(default)s).")
+        parser.add_argument("--catalog-size", type=int, default=5000)
+        parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of album/artist/term popularity.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        token = options["token"]
+        if options["username"]:
+            try:
+                token = str(AccessToken.for_user(User.objects.get(username=options["username"])))
+            except User.DoesNotExist:
+                raise CommandError(f"no user {options['username']!r}")
+        if not token:
+            raise CommandError("pass --username or --token")
+
+        traffic = Traffic(parse_mix(options["mix"]), options["catalog_size"], options["skew"])
+        base_url = options["url"].rstrip("/")
+        deadline = time.monotonic() + options["duration"]
+        budget = itertools.count() if options["requests"] is None else iter(range(options["requests"]))
+        budget_lock = threading.Lock()
+        results = []  # (route, status, seconds)
+
+        def client(worker):
+            rng = random.Random(f"{options['seed']}:{worker}")
+            session = requests.Session()
+            session.headers["Authorization"] = f"Bearer {token}"
+            mine = []
+            while time.monotonic() < deadline:
+                with budget_lock:
+                    if next(budget, None) is None:
+                        break
+                route, path = traffic.draw(rng)
+                started = time.monotonic()
+                try:
+                    status = session.get(base_url + path, timeout=30).status_code
+                except requests.RequestException as exc:
+                    status = type(exc).__name__
+                mine.append((route, status, time.monotonic() - started))
+            results.extend(mine)
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            list(pool.map(client, range(options["concurrency"])))
+        self.report(results, time.monotonic() - started)
+
+    def report(self, results, elapsed):
+        if not results:
+            self.stdout.write("no requests made")
+            return
+        by_route = defaultdict(list)
+        for result in results:
+            by_route[result[0]].append(result)
+
+        table = [("route", "requests", "errors", "req/s", "p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        for route, rows in sorted(by_route.items(), key=lambda item: -len(item[1])) + [("total", results)]:
+            latencies = sorted(seconds * 1000 for _, _, seconds in rows)
+            errors = sum(1 for _, status, _ in rows if not (isinstance(status, int) and status < 400))
+            table.append((route, str(len(rows)), str(errors), f"{len(rows) / elapsed:.1f}",
+                          *(f"{percentile(latencies, pct):.1f}" for pct in (50, 95, 99)), f"{latencies[-1]:.1f}"))
+
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        self.stdout.write(f"{len(results)} requests in {elapsed:.1f}s")
+        for row in table:
+            self.stdout.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+        statuses = Counter(str(status) for _, status, _ in results)
+        self.stdout.write("statuses: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
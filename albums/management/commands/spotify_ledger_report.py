@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from albums.models import SpotifyCallRecord
+from albums.spotify_ledger import summarize, summarize_by
+
+FIELDS = ("endpoint", "view", "priority", "cache", "status", "upstream_calls", "upstream_ms",
+          "latency_ms", "bytes", "token_refresh", "error")
+COLUMNS = ("calls", "upstream_calls", "cache_hit_rate", "error_rate", "throttled_rate",
+           "token_refresh_rate", "p50_ms", "p95_ms", "p99_ms")
+
+
+def _format(column, value):
+    if value is None:
+        return "-"
+    if column.endswith("_rate"):
+        return f"{value:.3f}"
+    if column.endswith("_ms"):
+        return f"{value:.1f}"
+    return str(value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Report on the sampled Spotify client calls (SpotifyCallRecord): busiest endpoints or "
+        "views, upstream latency percentiles, cache hit, token refresh, error and 429 rates. "
+        "Counts are of sampled calls; divide by SPOTIFY_LEDGER_SAMPLE_RATE to estimate totals."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--minutes", type=int, default=60, help="Time window to report on (default 60).")
+        parser.add_argument("--by", choices=("endpoint", "view", "priority"), default="endpoint")
+        parser.add_argument("--top", type=int, default=10, help="Number of groups to list (default 10).")
+        parser.add_argument("--prune", type=int, metavar="DAYS",
+                            help="Delete records older than DAYS days instead of reporting.")
+
+    def handle(self, *args, **options):
+        if options["prune"] is not None:
+            cutoff = timezone.now() - timedelta(days=options["prune"])
+            deleted, _ = SpotifyCallRecord.objects.filter(created_at__lt=cutoff).delete()
+            self.stdout.write(f"deleted {deleted} records")
+            return
+
+        since = timezone.now() - timedelta(minutes=options["minutes"])
+        rows = list(SpotifyCallRecord.objects.filter(created_at__gte=since).values(*FIELDS))
+        if not rows:
+            self.stdout.write(f"no calls recorded in the last {options['minutes']} minutes")
+            return
+
+        by = options["by"]
+        groups = summarize_by(rows, by, top=options["top"])
+        table = [(by, *COLUMNS)]
+        table += [(str(group[by] or "-"), *(_format(c, group[c]) for c in COLUMNS)) for group in groups]
+        total = summarize(rows)
+        table.append(("total", *(_format(c, total[c]) for c in COLUMNS)))
+
+        widths = [max(len(row[i]) for row in table) for i in range(len(table[0]))]
+        self.stdout.write(f"{len(rows)} sampled calls in the last {options['minutes']} minutes")
+        for row in table:
+            self.stdout.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
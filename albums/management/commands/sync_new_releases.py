@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from albums.catalog import sync_new_releases
+
+
+class Command(BaseCommand):
+    help = (
+        "Mirror Spotify's new releases into the local Album table. "
+        "Meant to run on a schedule (e.g. cron every 15 minutes)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max", type=int, default=100, help="Maximum releases to mirror (default 100).")
+
+    def handle(self, *args, **options):
+        count = sync_new_releases(None, max_items=options["max"])
+        self.stdout.write(f"mirrored {count} new releases")
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0006_album_spotify_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='cover_url',
+            field=models.URLField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='artist',
+            name='spotify_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0007_artist_spotify_id_album_cover_url'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('synced_at', models.DateTimeField()),
+                ('item_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='NewRelease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField(db_index=True)),
+                ('album', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='new_release', to='albums.album')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0008_newrelease_catalogsync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='artist',
+            name='discography_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
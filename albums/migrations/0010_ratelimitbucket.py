@@ -0,0 +1,24 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0009_artist_discography_synced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('tokens', models.FloatField(default=0)),
+                ('refilled_at', models.FloatField(default=0)),
+                ('blocked_until', models.FloatField(default=0)),
+                ('throttle_events', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-17 23:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0010_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlbumSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spotify_id', models.CharField(max_length=255, unique=True)),
+                ('payload', models.JSONField()),
+                ('etag', models.CharField(blank=True, max_length=255)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+    ]
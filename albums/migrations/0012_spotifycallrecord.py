@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0011_albumsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpotifyCallRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(db_index=True)),
+                ('endpoint', models.CharField(max_length=100)),
+                ('view', models.CharField(blank=True, max_length=100)),
+                ('priority', models.CharField(max_length=20)),
+                ('cache', models.CharField(max_length=20)),
+                ('status', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('upstream_calls', models.PositiveSmallIntegerField(default=0)),
+                ('upstream_ms', models.FloatField(default=0)),
+                ('latency_ms', models.FloatField(default=0)),
+                ('bytes', models.PositiveIntegerField(default=0)),
+                ('token_refresh', models.BooleanField(default=False)),
+                ('error', models.CharField(blank=True, max_length=100)),
+            ],
+        ),
+    ]
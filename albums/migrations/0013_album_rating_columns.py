@@ -0,0 +1,45 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:17
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_rating_columns(apps, schema_editor):
+    Album = apps.get_model('albums', 'Album')
+    Review = apps.get_model('albums', 'Review')
+    reviews = Review.objects.filter(album=OuterRef('pk')).order_by().values('album')
+    Album.objects.update(
+        rating_sum=Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), 0),
+        review_count=Coalesce(Subquery(reviews.annotate(count=Count('pk')).values('count')), 0),
+    )
+    albums = list(Album.objects.filter(review_count__gt=0).only('pk', 'rating_sum', 'review_count'))
+    for album in albums:
+        album.avg_rating = album.rating_sum / album.review_count
+    Album.objects.bulk_update(albums, ['avg_rating'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0012_spotifycallrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='avg_rating',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='album',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_rating_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0013_album_rating_columns'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Leaderboard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(choices=[('global', 'Global'), ('genre', 'Genre'), ('year', 'Release year')], max_length=10)),
+                ('key', models.CharField(blank=True, max_length=100)),
+                ('prior_mean', models.FloatField()),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+            options={
+                'unique_together': {('scope', 'key')},
+            },
+        ),
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveIntegerField()),
+                ('score', models.FloatField()),
+                ('album', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='albums.album')),
+                ('leaderboard', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='albums.leaderboard')),
+            ],
+            options={
+                'ordering': ['rank'],
+                'indexes': [models.Index(fields=['leaderboard', 'rank'], name='albums_lead_leaderb_a9a5f1_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.5 on 2026-10-18 00:49
+
+from django.db import migrations, models
+
+
+def credit_primary_artists(apps, schema_editor):
+    Album = apps.get_model('albums', 'Album')
+    Credit = Album.artists.through
+    pairs = Album.objects.values_list('pk', 'artist_id').iterator(chunk_size=2000)
+    batch = []
+    for album_id, artist_id in pairs:
+        batch.append(Credit(album_id=album_id, artist_id=artist_id))
+        if len(batch) == 2000:
+            Credit.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    Credit.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('albums', '0014_leaderboards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='artists',
+            field=models.ManyToManyField(blank=True, related_name='credited_albums', to='albums.artist'),
+        ),
+        migrations.RunPython(credit_primary_artists, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,13 @@
-from django.db import models
-from django.db.models import Avg
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
+from datetime import timedelta
 
 class Artist(models.Model):
     name = models.CharField(max_length=100)
+    spotify_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    discography_synced_at = models.DateTimeField(null=True, blank=True)  # last full crawl of their albums
     
     def __str__(self):
         return self.name
@@ -13,10 +15,17 @@ class Artist(models.Model):
 class Album(models.Model):
     title = models.CharField(max_length=200)
     artist = models.ForeignKey(Artist, related_name='albums', on_delete=models.CASCADE)
+    # everyone Spotify credits on the album, the primary artist included
+    artists = models.ManyToManyField(Artist, related_name='credited_albums', blank=True)
     release_year = models.PositiveIntegerField()
     genre = models.CharField(max_length=100)
     cover_image = models.ImageField(upload_to='album_covers/', null=True, blank=True)
     spotify_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    cover_url = models.URLField(max_length=500, blank=True)  # Spotify-hosted cover art
+    # Kept in step with the album's reviews by albums/ratings.py; repair with `manage.py reconcile_ratings`
+    rating_sum = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
+    avg_rating = models.FloatField(null=True, blank=True, db_index=True)  # None until reviewed
 
     class Meta:
         unique_together = ('title', 'artist') 
@@ -25,7 +34,7 @@ class Album(models.Model):
         return self.title
 
     def average_rating(self):
-        return self.reviews.aggregate(avg=Avg('rating'))['avg'] or 0
+        return self.avg_rating or 0
 
 class Review(models.Model):
     album = models.ForeignKey(Album, related_name='reviews', on_delete=models.CASCADE)
@@ -39,6 +48,110 @@ class Review(models.Model):
     def __str__(self):
         return f'Review of {self.album} by {self.user}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        review = super().from_db(db, field_names, values)
+        review._stored = (review.__dict__.get('album_id'), review.__dict__.get('rating'))
+        return review
+
+    def save(self, *args, **kwargs):
+        # the album's rating columns are updated by the post_save signal, in this transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+class Leaderboard(models.Model):
+    """A precomputed top-rated ranking: global, or one genre or release year (see albums/leaderboards.py)."""
+    GLOBAL = 'global'
+    GENRE = 'genre'
+    YEAR = 'year'
+    SCOPES = [(GLOBAL, 'Global'), (GENRE, 'Genre'), (YEAR, 'Release year')]
+
+    scope = models.CharField(max_length=10, choices=SCOPES)
+    key = models.CharField(max_length=100, blank=True)  # normalized genre, or the year; "" for global
+    prior_mean = models.FloatField()  # mean rating the scores were shrunk towards
+    refreshed_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('scope', 'key')
+
+    def __str__(self):
+        return f'{self.scope}:{self.key}' if self.key else self.scope
+
+class LeaderboardEntry(models.Model):
+    leaderboard = models.ForeignKey(Leaderboard, related_name='entries', on_delete=models.CASCADE)
+    rank = models.PositiveIntegerField()
+    album = models.ForeignKey(Album, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        ordering = ['rank']
+        indexes = [models.Index(fields=['leaderboard', 'rank'])]
+
+    def __str__(self):
+        return f'#{self.rank} {self.album_id} ({self.leaderboard})'
+
+class AlbumSnapshot(models.Model):
+    """The (slim) Spotify album payload, kept so album pages can be served without calling Spotify."""
+    spotify_id = models.CharField(max_length=255, unique=True)
+    payload = models.JSONField()
+    etag = models.CharField(max_length=255, blank=True)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'AlbumSnapshot({self.spotify_id})'
+
+class NewRelease(models.Model):
+    """Local mirror of Spotify's new-releases list, in Spotify's order."""
+    album = models.OneToOneField(Album, related_name='new_release', on_delete=models.CASCADE)
+    position = models.PositiveIntegerField(db_index=True)
+
+    class Meta:
+        ordering = ['position']
+
+    def __str__(self):
+        return f'#{self.position} {self.album}'
+
+class CatalogSync(models.Model):
+    """Watermark for a catalog ingestion job: when it last completed and what it stored."""
+    name = models.CharField(max_length=100, unique=True)
+    synced_at = models.DateTimeField()
+    item_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name} @ {self.synced_at}'
+
+class RateLimitBucket(models.Model):
+    """
+    Token bucket shared by every worker, used to pace calls to Spotify.
+    Times are epoch seconds so refill can be computed inside a single UPDATE.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    tokens = models.FloatField(default=0)
+    refilled_at = models.FloatField(default=0)
+    blocked_until = models.FloatField(default=0)  # set from Retry-After on a 429
+    throttle_events = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return self.name
+
+class SpotifyCallRecord(models.Model):
+    """A sampled call made through the Spotify client (see albums/spotify_ledger.py)."""
+    created_at = models.DateTimeField(db_index=True)
+    endpoint = models.CharField(max_length=100)  # template, e.g. "v1/albums/{id}"
+    view = models.CharField(max_length=100, blank=True)  # route name of the originating request
+    priority = models.CharField(max_length=20)
+    cache = models.CharField(max_length=20)  # hit, stale, coalesced, miss, revalidated, uncached, rejected
+    status = models.PositiveSmallIntegerField(null=True, blank=True)  # last upstream status
+    upstream_calls = models.PositiveSmallIntegerField(default=0)
+    upstream_ms = models.FloatField(default=0)
+    latency_ms = models.FloatField(default=0)
+    bytes = models.PositiveIntegerField(default=0)
+    token_refresh = models.BooleanField(default=False)  # a token was refreshed inline first
+    error = models.CharField(max_length=100, blank=True)
+
+    def __str__(self):
+        return f'{self.endpoint} {self.cache} {self.status}'
+
 class SpotifyToken(models.Model):
     user = models.OneToOneField(User, related_name='spotify_token', on_delete=models.CASCADE)
     access_token = models.CharField(max_length=1000)
@@ -52,5 +165,11 @@ class SpotifyToken(models.Model):
             return True
         return timezone.now() >= self.expires_at
 
+    def expires_within(self, seconds):
+        """True if the access token is expired or will be within `seconds`."""
+        if not self.expires_at:
+            return True
+        return timezone.now() + timedelta(seconds=seconds) >= self.expires_at
+
     def __str__(self):
         return f"SpotifyToken({self.user.username})"
\ No newline at end of file
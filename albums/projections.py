@@ -0,0 +1,91 @@
+"""
+Named projections of Spotify payloads.
+
+Spotify's objects carry much more than we render (available_markets, external_urls,
+copyrights, full track pages...). Views pick a projection with `?view=`: "slim" (the
+default) keeps what the app and the catalog ingestion use, "card" keeps just enough
+for a list entry and "full" is Spotify's payload unchanged. The Spotify client caches
+the projected form, so the response cache holds only the slim objects as well.
+"""
+FULL = "full"
+SLIM = "slim"
+CARD = "card"
+DEFAULT_VIEW = SLIM
+
+
+def fields(*names, **nested):
+    """Spec keeping `names` as they are and projecting `nested` fields with their own spec."""
+    spec = dict.fromkeys(names)
+    spec.update(nested)
+    return spec
+
+
+def paging(item):
+    """Spec for a Spotify paging object whose items follow `item`."""
+    return fields("next", "previous", "total", "limit", "offset", items=item)
+
+
+def first(items):
+    return items[:1]
+
+
+IMAGE = fields("url", "height", "width")
+ARTIST_REF = fields("id", "name")
+TRACK = fields("id", "name", "track_number", "disc_number", "duration_ms", "explicit", artists=ARTIST_REF)
+
+# album_row() and upsert_albums() read id, name, artists, release_date, images and genres
+SIMPLE_ALBUM = fields("id", "name", "album_type", "release_date", "total_tracks", artists=ARTIST_REF, images=IMAGE)
+ALBUM = fields(*SIMPLE_ALBUM, "genres", "label", artists=ARTIST_REF, images=IMAGE, tracks=paging(TRACK))
+ARTIST = fields("id", "name", "genres", "popularity", images=IMAGE)
+
+CARD_ALBUM = fields("id", "name", "release_date", artists=ARTIST_REF, images=first)
+CARD_ARTIST = fields("id", "name", images=first)
+CARD_TRACK = fields("id", "name", "duration_ms", artists=ARTIST_REF, album=CARD_ALBUM)
+
+# view -> payload kind (the cache policy name of the endpoint) -> spec
+PROJECTIONS = {
+    SLIM: {
+        "album": ALBUM,
+        "albums": fields(albums=ALBUM),
+        "artist_albums": paging(SIMPLE_ALBUM),
+        "new_releases": fields(albums=paging(SIMPLE_ALBUM)),
+        "search": fields(
+            albums=paging(SIMPLE_ALBUM),
+            artists=paging(ARTIST),
+            tracks=paging(fields(*TRACK, artists=ARTIST_REF, album=SIMPLE_ALBUM)),
+        ),
+    },
+    CARD: {
+        "album": CARD_ALBUM,
+        "albums": fields(albums=CARD_ALBUM),
+        "artist_albums": paging(CARD_ALBUM),
+        "new_releases": fields(albums=paging(CARD_ALBUM)),
+        "search": fields(albums=paging(CARD_ALBUM), artists=paging(CARD_ARTIST), tracks=paging(CARD_TRACK)),
+    },
+}
+
+VIEWS = (FULL, *PROJECTIONS)
+
+
+def _apply(value, spec):
+    if spec is None or value is None:
+        return value
+    if callable(spec):
+        return spec(value)
+    if isinstance(value, list):
+        return [_apply(item, spec) for item in value]
+    if isinstance(value, dict):
+        return {name: _apply(value[name], sub) for name, sub in spec.items() if name in value}
+    return value
+
+
+def project(kind, payload, view=DEFAULT_VIEW):
+    """
+    Return `payload` (a Spotify object of the given kind) reduced to `view`.
+    Payloads of kinds without a spec, and the "full" view, are returned unchanged.
+    Projecting an already projected payload again is harmless.
+    """
+    if view == FULL:
+        return payload
+    spec = PROJECTIONS[view].get(kind)
+    return payload if spec is None else _apply(payload, spec)
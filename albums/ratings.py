@@ -0,0 +1,93 @@
+"""
+Rating aggregates stored on Album (rating_sum, review_count, avg_rating).
+
+The review signals apply each create, update and delete to the album row with a
+single UPDATE inside the review's transaction, so the columns stay exact without
+re-aggregating the reviews table. Writes that skip signals (bulk_create, update(),
+raw SQL) can make them drift; reconcile_ratings() repairs that in bulk.
+"""
+from django.db.models import Count, F, FloatField, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf
+
+from .models import Album
+
+
+def average(rating_sum, review_count):
+    """SQL for rating_sum / review_count, NULL when there are no reviews."""
+    return Cast(rating_sum, FloatField()) / NullIf(review_count, Value(0))
+
+
+def apply_review_delta(album_id, rating_delta, count_delta):
+    """Add to an album's rating sum and review count, and recompute its average, atomically."""
+    rating_sum = F("rating_sum") + rating_delta
+    review_count = F("review_count") + count_delta
+    Album.objects.filter(pk=album_id).update(
+        rating_sum=rating_sum, review_count=review_count, avg_rating=average(rating_sum, review_count),
+    )
+
+
+def review_saved(review, created):
+    """Apply a saved review to its album's columns; returns the ids of the albums whose rating changed."""
+    album_id, rating = review.album_id, review.rating
+    old_album_id, old_rating = getattr(review, "_stored", (None, None))
+    changed = []
+    if created:
+        apply_review_delta(album_id, rating, 1)
+        changed = [album_id]
+    elif old_album_id is None or old_rating is None:
+        # saved from an instance we didn't load (or loaded with deferred fields)
+        recount_albums([album_id])
+        changed = [album_id]
+    elif old_album_id != album_id:
+        apply_review_delta(old_album_id, -old_rating, -1)
+        apply_review_delta(album_id, rating, 1)
+        changed = [old_album_id, album_id]
+    elif old_rating != rating:
+        apply_review_delta(album_id, rating - old_rating, 0)
+        changed = [album_id]
+    review._stored = (album_id, rating)
+    return changed
+
+
+def review_deleted(review):
+    """Take a deleted review off its album's columns; returns the album id."""
+    # the album may be going too (cascade); then this updates nothing
+    album_id, rating = getattr(review, "_stored", (review.album_id, review.rating))
+    apply_review_delta(album_id, -rating, -1)
+    return album_id
+
+
+def _actual_ratings(albums):
+    return albums.annotate(
+        actual_sum=Coalesce(Sum("reviews__rating"), 0),
+        actual_count=Count("reviews"),
+    )
+
+
+def recount_albums(album_ids):
+    """Recompute the rating columns of these albums from their reviews."""
+    for album in _actual_ratings(Album.objects.filter(pk__in=album_ids)).only("pk"):
+        Album.objects.filter(pk=album.pk).update(
+            rating_sum=album.actual_sum, review_count=album.actual_count,
+            avg_rating=album.actual_sum / album.actual_count if album.actual_count else None,
+        )
+
+
+def reconcile_ratings(batch_size=500, dry_run=False):
+    """
+    Find albums whose rating columns disagree with their reviews and fix them with
+    bulk updates of `batch_size` rows. Returns the number of albums that had drifted.
+    """
+    drifted = list(
+        _actual_ratings(Album.objects.all())
+        .exclude(rating_sum=F("actual_sum"), review_count=F("actual_count"))
+        .order_by("pk")
+        .values_list("pk", "actual_sum", "actual_count")
+    )
+    if not dry_run:
+        albums = [
+            Album(pk=pk, rating_sum=total, review_count=count, avg_rating=total / count if count else None)
+            for pk, total, count in drifted
+        ]
+        Album.objects.bulk_update(albums, ["rating_sum", "review_count", "avg_rating"], batch_size=batch_size)
+    return len(drifted)
@@ -0,0 +1,167 @@
+"""
+Spotify search, paginated and cached per normalized query, type and page.
+
+Searching several types at once issues one upstream call per type concurrently and
+merges the results, together with local albums that have reviews, into one ranked list.
+"""
+import asyncio
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Album
+from .spotify import make_spotify_request, StaleResponse, INTERACTIVE, BACKGROUND
+from .spotify_async import amake_spotify_request
+from .background import fan_out, submit_once
+from .projections import DEFAULT_VIEW
+from .serializers import CatalogAlbumSerializer
+
+SEARCH_TYPES = ("album", "artist", "track", "playlist", "show", "episode", "audiobook")
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_LIMIT = 50
+# Spotify refuses offsets past 1000
+SEARCH_MAX_OFFSET = 1000
+
+
+def normalize_query(query):
+    """Spotify search is case-insensitive, so "  Abbey  road" and "abbey road" share a cache entry."""
+    return " ".join((query or "").split()).lower()
+
+
+def normalize_types(types):
+    """Turn "track, album" into "album,track"."""
+    return ",".join(sorted({t.strip() for t in (types or "").split(",") if t.strip()}))
+
+
+def search_endpoint(query, types, limit, offset):
+    return "/v1/search?" + urlencode({"q": query, "type": types, "limit": limit, "offset": offset})
+
+
+def _prefetch_next_page(results, query, types, limit, offset, view):
+    next_offset = offset + limit
+    if settings.SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE and has_next_page(results) and next_offset < SEARCH_MAX_OFFSET:
+        submit_once(
+            ("spotify-search", query, types, limit, next_offset, view),
+            make_spotify_request, None, search_endpoint(query, types, limit, next_offset), BACKGROUND, view=view,
+        )
+
+
+def has_next_page(results):
+    """True if any of the per-type paging objects in a search response has more items."""
+    return any(isinstance(page, dict) and page.get("next") for page in results.values())
+
+
+def search_spotify(user, query, types, limit=SEARCH_PAGE_SIZE, offset=0, view=DEFAULT_VIEW, priority=INTERACTIVE):
+    """
+    One page of Spotify search results for a normalized query and types. With
+    SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE, the following page is fetched into the cache
+    in the background.
+    """
+    results = make_spotify_request(user, search_endpoint(query, types, limit, offset), priority, view=view)
+    _prefetch_next_page(results, query, types, limit, offset, view)
+    return results
+
+
+async def asearch_spotify(user, query, types, limit=SEARCH_PAGE_SIZE, offset=0, view=DEFAULT_VIEW,
+                          priority=INTERACTIVE):
+    """search_spotify() for async callers."""
+    results = await amake_spotify_request(user, search_endpoint(query, types, limit, offset), priority, view=view)
+    _prefetch_next_page(results, query, types, limit, offset, view)
+    return results
+
+
+def _local_album_queryset(query, limit):
+    return (
+        Album.objects.filter(Q(title__icontains=query) | Q(artist__name__icontains=query),
+                             spotify_id__isnull=False, review_count__gt=0)
+        .select_related("artist").order_by("-review_count", "title")[:limit]
+    )
+
+
+def local_album_matches(query, limit):
+    """Albums we hold reviews for whose title or artist matches `query`, most reviewed first."""
+    return CatalogAlbumSerializer(_local_album_queryset(query, limit), many=True).data
+
+
+async def alocal_album_matches(query, limit):
+    albums = [album async for album in _local_album_queryset(query, limit)]
+    return CatalogAlbumSerializer(albums, many=True).data
+
+
+def _score(query, item, position, local):
+    # Spotify's own relevance order counts most, then how well the name matches,
+    # then how much our users have reviewed it
+    score = 1 / (position + 1)
+    name = normalize_query(item.get("name"))
+    if name == query:
+        score += 1
+    elif name.startswith(query):
+        score += 0.5
+    if local is not None:
+        score += 0.25 + min(local["review_count"], 20) / 80
+    return score
+
+
+def rank_results(query, pages, local_albums):
+    """
+    Merge per-type Spotify pages ({"albums": {...}, "artists": {...}}) and local album
+    matches into one list, best first. Local albums that are also in the Spotify results
+    are attached to them rather than listed twice.
+    """
+    local = {album["id"]: album for album in local_albums}
+    ranked = []
+    for key, page in pages.items():
+        item_type = key[:-1]  # "albums" -> "album"
+        for position, item in enumerate((page or {}).get("items") or []):
+            if not item:
+                continue
+            match = local.pop(item["id"], None) if item_type == "album" else None
+            ranked.append((_score(query, item, position, match), item_type, item, match))
+    for position, album in enumerate(local.values()):
+        ranked.append((_score(query, album, position, album), "album", None, album))
+
+    ranked.sort(key=lambda entry: -entry[0])
+    return [
+        {
+            "type": item_type,
+            "id": (item or match)["id"],
+            "name": (item or match)["name"],
+            "score": round(score, 3),
+            "spotify": item,
+            "local": match,
+        }
+        for score, item_type, item, match in ranked
+    ]
+
+
+def search_many(user, query, types, limit=SEARCH_PAGE_SIZE, offset=0, view=DEFAULT_VIEW):
+    """
+    Search several types (a list) at once. Each type is its own cached call, and all of
+    them are in flight together, so this takes as long as the slowest one (raising
+    TimeoutError after BACKGROUND_RESULT_TIMEOUT). Local matches are added to the
+    first page only.
+    Returns (pages, ranked): the per-type pages merged into one dict (a StaleResponse if
+    any of them is stale) and the ranked list from rank_results().
+    """
+    futures = [fan_out(search_spotify, user, query, t, limit, offset, view) for t in types]
+    local = local_album_matches(query, limit) if "album" in types and offset == 0 else []
+    timeout = settings.BACKGROUND_RESULT_TIMEOUT
+    return _merge(query, [future.result(timeout=timeout) for future in futures], local)
+
+
+async def asearch_many(user, query, types, limit=SEARCH_PAGE_SIZE, offset=0, view=DEFAULT_VIEW):
+    """search_many() for async callers; the searches and the local lookup run concurrently."""
+    searches = [asearch_spotify(user, query, t, limit, offset, view) for t in types]
+    if "album" in types and offset == 0:
+        *results, local = await asyncio.gather(*searches, alocal_album_matches(query, limit))
+    else:
+        results, local = await asyncio.gather(*searches), []
+    return _merge(query, results, local)
+
+
+def _merge(query, results, local):
+    pages = StaleResponse() if any(getattr(r, "stale", False) for r in results) else {}
+    for result in results:
+        pages.update(result)
+    return pages, rank_results(query, pages, local)
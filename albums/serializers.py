@@ -1,8 +1,9 @@
 from rest_framework import serializers
 from rest_framework.validators import ValidationError, UniqueTogetherValidator
 from .models import Artist, Album, Review
-from .spotify import make_spotify_request
-from django.db import transaction
+from .catalog import resolve_albums, stored_edition
+from .spotify import SpotifyRateLimited
+from rest_framework.exceptions import Throttled
 
 
 class ArtistSerializer(serializers.ModelSerializer):
@@ -16,7 +17,7 @@ class AlbumSerializer(serializers.ModelSerializer):
     artist_id = serializers.PrimaryKeyRelatedField(
         queryset=Artist.objects.all(), source='artist', write_only=True)
     cover_image_url = serializers.SerializerMethodField() # read only
-    average_rating = serializers.FloatField(read_only=True)
+    average_rating = serializers.FloatField(source='avg_rating', read_only=True)
     review_count = serializers.IntegerField(read_only=True)
 
 
@@ -36,7 +37,58 @@ class AlbumSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         if obj.cover_image and request:
             return request.build_absolute_uri(obj.cover_image.url)
-        return None
+        return obj.cover_url or None
+
+
+class CatalogAlbumSerializer(serializers.ModelSerializer):
+    """
+    A locally mirrored album in the shape of a Spotify simplified album object,
+    so clients can use it in place of the proxied payload, plus local ratings.
+    """
+    id = serializers.CharField(source='spotify_id')
+    name = serializers.CharField(source='title')
+    artists = serializers.SerializerMethodField()
+    images = serializers.SerializerMethodField()
+    release_date = serializers.CharField(source='release_year')
+    average_rating = serializers.FloatField(source='avg_rating', read_only=True)
+    review_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Album
+        fields = ['id', 'name', 'artists', 'images', 'release_date', 'genre',
+                  'average_rating', 'review_count']
+
+    def get_artists(self, obj):
+        return [{'id': obj.artist.spotify_id, 'name': obj.artist.name}]
+
+    def get_images(self, obj):
+        return [{'url': obj.cover_url}] if obj.cover_url else []
+
+
+class ResolveAlbumsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.CharField(max_length=255), allow_empty=False, max_length=1000)
+
+
+class AlbumSummarySerializer(serializers.ModelSerializer):
+    """Compact album representation, sent once alongside a page of its reviews."""
+    artist = serializers.StringRelatedField()
+    average_rating = serializers.FloatField(source='avg_rating', read_only=True)
+    review_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Album
+        fields = ['id', 'spotify_id', 'title', 'artist', 'release_year', 'genre',
+                  'average_rating', 'review_count']
+
+
+class AlbumReviewSerializer(serializers.ModelSerializer):
+    """A review without its album, for listings that are already scoped to one album."""
+    user = serializers.StringRelatedField(read_only=True)
+
+    class Meta:
+        model = Review
+        fields = ['id', 'user', 'rating', 'comment', 'created_at']
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -48,34 +100,25 @@ class ReviewSerializer(serializers.ModelSerializer):
         model = Review
         fields = ['id', 'spotify_album_id', 'album', 'user', 'rating', 'comment', 'created_at']
 
-    @transaction.atomic
+    # Not atomic: the album lookup may call Spotify, and holding a transaction open
+    # across that call would also hold the shared rate-limit row. The album upsert
+    # and the review insert are each atomic on their own.
     def create(self, validated_data):
         spotify_id = validated_data.pop('spotify_album_id')
         user = self.context['request'].user
 
-        # Try to find the album in your local database
+        # Find the album locally, or fetch it from Spotify and store it
         try:
-            album = Album.objects.get(spotify_id=spotify_id)
-        except Album.DoesNotExist:
-            # If it doesn't exist, fetch its data from Spotify
-            try:
-                endpoint = f"/v1/albums/{spotify_id}"
-                album_data = make_spotify_request(user, endpoint)
-
-                # Find or create the artist based on Spotify data
-                artist_name = album_data['artists'][0]['name']
-                artist, _ = Artist.objects.get_or_create(name=artist_name)
-
-                # Create the new Album record in your database
-                album = Album.objects.create(
-                    spotify_id=spotify_id,
-                    title=album_data['name'],
-                    artist=artist,
-                    release_year=int(album_data['release_date'][:4]),
-                    genre=album_data['genres'][0] if album_data['genres'] else 'Unknown'
-                )
-            except Exception as e:
-                raise serializers.ValidationError(f"Could not fetch or create album from Spotify: {e}")
+            album = resolve_albums(user, [spotify_id]).get(spotify_id)
+        except SpotifyRateLimited as e:
+            raise Throttled(wait=e.retry_after)
+        except Exception as e:
+            raise serializers.ValidationError(f"Could not fetch or create album from Spotify: {e}")
+        if album is None:
+            # an edition of an album we already store under another id gets reviewed as that album
+            album = stored_edition(spotify_id)
+        if album is None:
+            raise serializers.ValidationError(f"Spotify has no album with id {spotify_id}.")
 
         # Create the review and link it to the local album record
         review = Review.objects.create(album=album, user=user, **validated_data)
@@ -0,0 +1,28 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import leaderboards, ratings
+from .models import Review, SpotifyToken
+from .spotify import remember_token, forget_token
+
+
+@receiver(post_save, sender=SpotifyToken)
+def spotify_token_saved(sender, instance, **kwargs):
+    # callback, manual refresh and auto-refresh all save through the ORM
+    remember_token(instance)
+
+
+@receiver(post_delete, sender=SpotifyToken)
+def spotify_token_deleted(sender, instance, **kwargs):
+    forget_token(instance.user_id)
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance, created, raw=False, **kwargs):
+    if not raw:  # loaddata brings its own album rows
+        leaderboards.schedule_refresh(ratings.review_saved(instance, created))
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance, **kwargs):
+    leaderboards.schedule_refresh([ratings.review_deleted(instance)])
@@ -1,17 +1,138 @@
 import os
 import base64
+import logging
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
 from .models import SpotifyToken
+from .spotify_cache import normalize_endpoint, cache_policy, cache_key, get_entry, store, record_lookup
+from .projections import project, DEFAULT_VIEW
+from .background import submit, submit_once
+from . import spotify_governor as governor
+from . import spotify_ledger as ledger
+from .spotify_coalesce import coalesce
+from .spotify_breaker import breaker, SpotifyUnavailable, REJECT, PROBE
+from .spotify_governor import SpotifyRateLimited, INTERACTIVE, BACKGROUND  # noqa: F401
 
-SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
-SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
-SPOTIFY_API_BASE_URL = "https://api.spotify.com/"
+logger = logging.getLogger(__name__)
+
+SPOTIFY_AUTH_URL = settings.SPOTIFY_AUTH_URL
+SPOTIFY_TOKEN_URL = settings.SPOTIFY_TOKEN_URL
+SPOTIFY_API_BASE_URL = settings.SPOTIFY_API_BASE_URL.rstrip("/") + "/"
 
 SCOPES = "user-read-email user-read-private"
 
+# Upstream statuses worth retrying. 429 is left to the caller on purpose, so the
+# governor sees it and every retry goes through it.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _build_session():
+    """Create a keep-alive session with a bounded pool and retry policy."""
+    retry = Retry(
+        total=settings.SPOTIFY_HTTP_MAX_RETRIES,
+        connect=settings.SPOTIFY_HTTP_MAX_RETRIES,
+        read=settings.SPOTIFY_HTTP_MAX_RETRIES,
+        status=settings.SPOTIFY_HTTP_MAX_RETRIES,
+        backoff_factor=settings.SPOTIFY_HTTP_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUSES,
+        # POSTs to the token endpoint only get connect retries, which are
+        # safe because nothing reached Spotify yet.
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+        # otherwise urllib3 sleeps through a 429's Retry-After and sends it again
+        respect_retry_after_header=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=settings.SPOTIFY_HTTP_POOL_SIZE,
+        pool_maxsize=settings.SPOTIFY_HTTP_POOL_SIZE,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """Return the shared session for this worker, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def _reset_session():
+    # Sockets must not be shared between a parent and a forked gunicorn worker.
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+def _timeout():
+    return (settings.SPOTIFY_HTTP_CONNECT_TIMEOUT, settings.SPOTIFY_HTTP_READ_TIMEOUT)
+
+
+def spotify_get(url, **kwargs):
+    kwargs.setdefault("timeout", _timeout())
+    return get_session().get(url, **kwargs)
+
+
+def spotify_post(url, **kwargs):
+    """POST to the token endpoint; recorded in the ledger, and flags any call waiting on it."""
+    kwargs.setdefault("timeout", _timeout())
+    waiting = ledger.current()
+    if waiting is not None:
+        waiting.token_refresh = True
+    grant_type = (kwargs.get("data") or {}).get("grant_type", "")
+    with ledger.track(f"api/token:{grant_type}", INTERACTIVE) as call:
+        started = time.monotonic()
+        response = get_session().post(url, **kwargs)
+        call.upstream(response.status_code, time.monotonic() - started, len(response.content))
+        return response
+
+
+def get_pool_stats():
+    """
+    Snapshot of the connection pools held by this worker's session, one entry per host.
+    `connections_opened` counts new TCP/TLS handshakes, so compare it with `requests`
+    to see how well keep-alive is working; `idle` near zero under load means the pool
+    is too small.
+    """
+    stats = {"pool_size": settings.SPOTIFY_HTTP_POOL_SIZE, "hosts": {}}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            queued = list(pool.pool.queue) if pool.pool is not None else []
+            stats["hosts"][f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": sum(1 for conn in queued if conn is not None),
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+            }
+    return stats
+
 def get_spotify_auth_url():
     return (
         f"{SPOTIFY_AUTH_URL}?response_type=code"
@@ -36,7 +157,7 @@ def get_tokens(code):
         "Content-Type": "application/x-www-form-urlencoded",
     }
 
-    response = requests.post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
+    response = spotify_post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
     return response.json()
 
 
@@ -67,7 +188,7 @@ def exchange_code_for_token(code):
         "redirect_uri": settings.SPOTIFY_REDIRECT_URI,
     }
     headers = _basic_auth_header()
-    resp = requests.post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
+    resp = spotify_post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
     resp.raise_for_status()
     return resp.json()
 
@@ -77,7 +198,7 @@ def refresh_access_token(refresh_token):
         "refresh_token": refresh_token,
     }
     headers = _basic_auth_header()
-    resp = requests.post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
+    resp = spotify_post(SPOTIFY_TOKEN_URL, data=payload, headers=headers)
     resp.raise_for_status()
     return resp.json()
 
@@ -106,27 +227,362 @@ def tokens_response_to_saved_fields(token_json):
         "expires_at": expires_at,
     }
 
-def make_spotify_request(user, endpoint):
+def apply_token_fields(token_obj, fields):
     """
-    Makes an authenticated request to the Spotify API.
-    Refreshes token if necessary.
+    Copy a parsed token response onto `token_obj` and return the names of the fields
+    that changed, for save(update_fields=...). Missing values (Spotify omits the
+    refresh token on refresh) leave the stored value alone.
+    """
+    changed = []
+    for name in ("access_token", "refresh_token", "token_type", "scope", "expires_at"):
+        value = fields.get(name)
+        if value is not None and getattr(token_obj, name) != value:
+            setattr(token_obj, name, value)
+            changed.append(name)
+    return changed
+
+
+# Striped so the number of locks stays fixed however many users refresh; users
+# sharing a stripe only wait on each other's refresh.
+_refresh_locks = [threading.Lock() for _ in range(64)]
+
+
+def _user_refresh_lock(user_id):
+    return _refresh_locks[hash(user_id) % len(_refresh_locks)]
+
+
+def save_refreshed_token(user_id, stale_access_token, token_json):
+    """
+    Write a token refresh back under a short row lock, unless the token was refreshed
+    concurrently (its access token is no longer `stale_access_token`), in which case
+    the stored one wins. Only the changed columns are written. Returns the stored row.
+    """
+    with transaction.atomic():
+        token_obj = SpotifyToken.objects.select_for_update().get(user_id=user_id)
+        if token_obj.access_token == stale_access_token:
+            changed = apply_token_fields(token_obj, tokens_response_to_saved_fields(token_json))
+            if changed:
+                token_obj.save(update_fields=changed)
+    return token_obj
+
+
+def refresh_user_token(user_id, force=False):
+    """
+    Refresh a user's Spotify token at most once per expiry.
+    Threads in this worker queue on a lock striped by user; whoever gets in second
+    re-checks the row and reuses the fresh token. The call to Spotify holds no row
+    lock, so a request reading the token never waits on it; if another worker
+    refreshed first, its token is kept.
+    """
+    with _user_refresh_lock(user_id):
+        token_obj = SpotifyToken.objects.get(user_id=user_id)
+        if not force and not token_obj.expires_within(settings.SPOTIFY_TOKEN_REFRESH_WINDOW):
+            return token_obj
+        token_resp = refresh_access_token(token_obj.refresh_token)
+        return save_refreshed_token(user_id, token_obj.access_token, token_resp)
+
+
+def schedule_token_refresh(user_id):
+    """Queue one background refresh for this user unless one is already pending."""
+    submit_once(("spotify-token", user_id), refresh_user_token, user_id)
+
+
+def get_valid_token(user):
+    """
+    Return a usable SpotifyToken for `user`.
+    Tokens inside the refresh window are used as-is while a background refresh
+    replaces them, so requests only wait when the token has already expired.
     """
     try:
         token_obj = user.spotify_token
     except SpotifyToken.DoesNotExist:
         raise Exception("User has no Spotify token.")
 
-    # Check if the token is expired and refresh if needed
     if token_obj.is_expired():
-        token_resp = refresh_access_token(token_obj.refresh_token)
-        fields = tokens_response_to_saved_fields(token_resp)
-        # Update and save the token object
-        token_obj.access_token = fields["access_token"]
-        token_obj.expires_at = fields["expires_at"]
-        token_obj.save()
+        token_obj = refresh_user_token(user.id)
+        user.spotify_token = token_obj
+    elif token_obj.expires_within(settings.SPOTIFY_TOKEN_REFRESH_WINDOW):
+        schedule_token_refresh(user.id)
+    return token_obj
+
+
+# user id -> (access_token, expires_at); lets warm requests skip the SpotifyToken query
+_token_cache = {}
+_token_cache_lock = threading.Lock()
+
+
+def remember_token(token_obj):
+    """Cache a token for this worker, unless it is already due for refresh."""
+    if token_obj.expires_within(settings.SPOTIFY_TOKEN_REFRESH_WINDOW):
+        forget_token(token_obj.user_id)
+        return
+    with _token_cache_lock:
+        _token_cache[token_obj.user_id] = (token_obj.access_token, token_obj.expires_at)
+
+
+def forget_token(user_id):
+    with _token_cache_lock:
+        _token_cache.pop(user_id, None)
+
+
+def get_access_token(user):
+    """
+    Return a usable access token for `user`, without a database query when this
+    worker already holds one that isn't close to expiring.
+    """
+    with _token_cache_lock:
+        cached = _token_cache.get(user.id)
+    if cached is not None:
+        access_token, expires_at = cached
+        if timezone.now() + timedelta(seconds=settings.SPOTIFY_TOKEN_REFRESH_WINDOW) < expires_at:
+            return access_token
+
+    token_obj = get_valid_token(user)
+    remember_token(token_obj)
+    return token_obj.access_token
+
+
+# Endpoints that act on behalf of a user and need their token; everything else is
+# catalog data, read with the app's client-credentials token.
+USER_SCOPED_PREFIXES = ("v1/me",)
+APP_TOKEN_CACHE_KEY = "spotify:app-token"
+
+
+def is_user_scoped(endpoint):
+    return endpoint.startswith(USER_SCOPED_PREFIXES)
+
+
+def request_app_token():
+    """Client-credentials grant: a token for catalog endpoints, not tied to any user."""
+    resp = spotify_post(SPOTIFY_TOKEN_URL, data={"grant_type": "client_credentials"}, headers=_basic_auth_header())
+    resp.raise_for_status()
+    return resp.json()
+
+
+_app_token = None  # (access_token, expires_at epoch seconds)
+_app_token_lock = threading.Lock()
+_app_token_refreshing = False
+
+
+def _load_app_token():
+    """Fetch a new app token and share it through the Django cache (cluster-wide if that cache is)."""
+    global _app_token
+    token_json = request_app_token()
+    expires_in = int(token_json.get("expires_in", 3600))
+    _app_token = (token_json["access_token"], time.time() + expires_in)
+    caches[settings.SPOTIFY_CACHE_ALIAS].set(
+        APP_TOKEN_CACHE_KEY, _app_token, max(expires_in - settings.SPOTIFY_TOKEN_REFRESH_WINDOW, 1))
+    return _app_token
+
+
+def _background_app_token_refresh():
+    global _app_token_refreshing
+    try:
+        with _app_token_lock:
+            _load_app_token()
+    except Exception:
+        logger.exception("Background refresh of the Spotify app token failed")
+    finally:
+        _app_token_refreshing = False
+
+
+def get_app_access_token():
+    """
+    Return the shared client-credentials access token.
+    It is held in memory (and in the Django cache for other workers) and replaced in
+    the background once inside SPOTIFY_TOKEN_REFRESH_WINDOW, so callers only wait
+    for the very first fetch or after it has actually expired.
+    """
+    global _app_token, _app_token_refreshing
+    window = settings.SPOTIFY_TOKEN_REFRESH_WINDOW
+    token = _app_token
+    if token is None or token[1] - window <= time.time():
+        token = caches[settings.SPOTIFY_CACHE_ALIAS].get(APP_TOKEN_CACHE_KEY) or token
+        _app_token = token
+    now = time.time()
+    if token is not None and now < token[1] - window:
+        return token[0]
+    if token is not None and now < token[1]:
+        with _app_token_lock:
+            start_refresh = not _app_token_refreshing
+            _app_token_refreshing = True
+        if start_refresh:
+            submit(_background_app_token_refresh)
+        return token[0]
+
+    with _app_token_lock:
+        # another thread may have fetched it while we waited for the lock
+        if _app_token is not None and time.time() < _app_token[1] - window:
+            return _app_token[0]
+        return _load_app_token()[0]
+
+
+def forget_app_token():
+    global _app_token
+    _app_token = None
+    caches[settings.SPOTIFY_CACHE_ALIAS].delete(APP_TOKEN_CACHE_KEY)
+
+
+def _retry_after(response):
+    try:
+        return max(float(response.headers.get("Retry-After", 1)), 0)
+    except ValueError:
+        return 1.0
+
+
+class StaleResponse(dict):
+    """A cached payload served past its TTL because Spotify could not be reached."""
+    stale = True
+
+
+def _serve_stale(entry):
+    record_lookup("stale")
+    return StaleResponse(entry.data)
+
+
+def _fresh_data(key):
+    entry = get_entry(key)
+    if entry is not None and entry.fresh_until > time.time():
+        return entry.data
+    return None
+
+
+def _is_upstream_failure(exc):
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def make_spotify_request(user, endpoint, priority=INTERACTIVE, view=DEFAULT_VIEW):
+    """
+    Makes an authenticated request to the Spotify API.
+    Payloads are returned (and cached) reduced to the named projection `view`; see
+    projections.py.
+    Catalog endpoints use the app's client-credentials token, so `user` may be None
+    for them; user-scoped endpoints (/v1/me...) use the user's token, refreshed if
+    necessary.
+    Catalog endpoints are answered from the shared response cache when possible;
+    cached payloads are shared between requests and must not be mutated.
+    Upstream calls draw from the cluster-wide rate budget at the given priority and
+    raise SpotifyRateLimited when it is exhausted or Spotify answers 429.
+    While Spotify is failing (circuit open) or a call fails, the last known good
+    catalog response is returned as a StaleResponse; without one, SpotifyUnavailable
+    is raised immediately.
+    Every call is recorded in the ledger (spotify_ledger.py).
+    """
+    with ledger.track(endpoint, priority) as call:
+        return _request(user, normalize_endpoint(endpoint), priority, view, call)
+
+
+def _request(user, endpoint, priority, view, call):
+    _, ttl = cache_policy(endpoint)
+    entry = get_entry(cache_key(endpoint, view)) if ttl else None
+    if entry is not None and entry.fresh_until > time.time():
+        record_lookup("hits")
+        call.cache = ledger.HIT
+        return entry.data
+
+    decision = breaker.allow()
+    if decision == REJECT:
+        if entry is not None:
+            call.cache = ledger.STALE
+            return _serve_stale(entry)
+        call.cache = ledger.REJECTED
+        raise SpotifyUnavailable("Spotify is unavailable right now, try again shortly.")
+    if decision == PROBE and entry is not None:
+        # answer from the stale copy; the probe revalidates it in the background
+        submit(_revalidate, user, endpoint, priority, ttl, entry, view)
+        call.cache = ledger.STALE
+        return _serve_stale(entry)
+
+    try:
+        return _load(user, endpoint, priority, ttl, entry, view)
+    except Exception as exc:
+        if entry is not None and _is_upstream_failure(exc):
+            call.cache = ledger.STALE
+            return _serve_stale(entry)
+        raise
+    finally:
+        if decision == PROBE:
+            breaker.release_probe()
+
+
+def _revalidate(user, endpoint, priority, ttl, entry, view):
+    try:
+        with ledger.track(endpoint, priority):
+            _load(user, endpoint, priority, ttl, entry, view)
+    except Exception:
+        logger.info("Background revalidation of %s failed", endpoint, exc_info=True)
+    finally:
+        breaker.release_probe()
+
+
+def _load(user, endpoint, priority, ttl, entry=None, view=DEFAULT_VIEW):
+    kind, _ = cache_policy(endpoint)
+    if not ttl:
+        return project(kind, _fetch(user, endpoint, priority)[0], view)
+    record_lookup("misses")
+    key = cache_key(endpoint, view)
+    call = ledger.current()
+    if call is not None:
+        call.cache = ledger.COALESCED  # unless we turn out to be the one fetching
+
+    def fetch_and_store():
+        etag = entry.etag if entry is not None else None
+        data, etag = _fetch(user, endpoint, priority, etag=etag)
+        if data is NOT_MODIFIED:
+            # our copy is still current: keep the already-parsed (and projected) payload
+            record_lookup("revalidated")
+            data, outcome = entry.data, ledger.REVALIDATED
+        else:
+            data, outcome = project(kind, data, view), ledger.MISS
+        if call is not None:
+            call.cache = outcome
+        store(key, data, ttl, etag)
+        return data
+
+    # Catalog responses are the same for everyone, so identical concurrent calls share one
+    return coalesce(key, fetch_and_store, lookup=lambda: _fresh_data(key))
+
+
+NOT_MODIFIED = object()
+
+
+def _fetch(user, endpoint, priority, etag=None, retry_auth=True):
+    """
+    One upstream GET for a normalized endpoint. Returns (payload, etag); with an
+    `etag` the request is conditional and the payload is NOT_MODIFIED on a 304.
+    """
+    user_scoped = is_user_scoped(endpoint)
+    access_token = get_access_token(user) if user_scoped else get_app_access_token()
 
     # Make the request to the Spotify API
-    headers = {"Authorization": f"Bearer {token_obj.access_token}"}
-    response = requests.get(f"{SPOTIFY_API_BASE_URL}{endpoint}", headers=headers)
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    governor.acquire(priority)
+    started = time.monotonic()
+    try:
+        response = spotify_get(f"{SPOTIFY_API_BASE_URL}{endpoint}", headers=headers)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+    call = ledger.current()
+    if call is not None:
+        call.upstream(response.status_code, time.monotonic() - started, len(response.content))
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success(time.monotonic() - started)
+    if response.status_code == 401 and not user_scoped and retry_auth:
+        # the app token was revoked or rotated early; get a new one and try once more
+        forget_app_token()
+        return _fetch(user, endpoint, priority, etag=etag, retry_auth=False)
+    if response.status_code == 429:
+        retry_after = _retry_after(response)
+        governor.record_throttle(retry_after)
+        raise SpotifyRateLimited(retry_after)
+    if response.status_code == 304:
+        return NOT_MODIFIED, etag
     response.raise_for_status()
-    return response.json()
\ No newline at end of file
+    return response.json(), response.headers.get("ETag")
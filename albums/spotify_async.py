@@ -0,0 +1,213 @@
+"""
+Async counterpart of make_spotify_request(), used by the async views under ASGI.
+
+Upstream calls go through a shared httpx.AsyncClient, so a waiting request holds no
+thread. It shares the response cache, projections, ETags, circuit breaker, rate budget
+and tokens with the sync client; their database and cache-backend work runs through
+sync_to_async. Identical concurrent calls are coalesced within the event loop.
+Background work (revalidation, token refresh) still runs on the shared thread pool.
+"""
+import asyncio
+import time
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import spotify
+from . import spotify_governor as governor
+from . import spotify_ledger as ledger
+from . import spotify_coalesce
+from .spotify import (
+    RETRY_STATUSES, NOT_MODIFIED, SpotifyRateLimited, INTERACTIVE,
+    is_user_scoped, get_access_token, get_app_access_token, forget_app_token,
+    _retry_after, _serve_stale, _revalidate,
+)
+from .spotify_cache import (
+    LocalCache, normalize_endpoint, cache_policy, cache_key, get_response_cache,
+    get_entry, store, record_lookup,
+)
+from .spotify_breaker import breaker, SpotifyUnavailable, REJECT, PROBE
+from .projections import project, DEFAULT_VIEW
+from .background import submit
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+_inflight = {}  # (event loop, cache key) -> asyncio.Future
+
+
+def get_async_client():
+    """Return the AsyncClient for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.SPOTIFY_HTTP_READ_TIMEOUT, connect=settings.SPOTIFY_HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.SPOTIFY_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.SPOTIFY_HTTP_POOL_SIZE,
+            ),
+            # connection errors only; 5xx are retried below like urllib3's Retry does
+            transport=httpx.AsyncHTTPTransport(retries=settings.SPOTIFY_HTTP_MAX_RETRIES),
+        )
+    return client
+
+
+async def spotify_aget(url, **kwargs):
+    client = get_async_client()
+    retries = settings.SPOTIFY_HTTP_MAX_RETRIES
+    for attempt in range(retries + 1):
+        response = await client.get(url, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+        await asyncio.sleep(settings.SPOTIFY_HTTP_BACKOFF_FACTOR * 2 ** attempt)
+
+
+async def _cache_call(fn, *args):
+    # the local cache is in memory; other backends may do network I/O
+    if isinstance(get_response_cache(), LocalCache):
+        return fn(*args)
+    return await sync_to_async(fn)(*args)
+
+
+async def _access_token(user, user_scoped):
+    if not user_scoped:
+        token = spotify._app_token
+        if token is not None and time.time() < token[1] - settings.SPOTIFY_TOKEN_REFRESH_WINDOW:
+            return token[0]
+        return await sync_to_async(get_app_access_token)()
+    return await sync_to_async(get_access_token)(user)
+
+
+def _is_upstream_failure(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+async def amake_spotify_request(user, endpoint, priority=INTERACTIVE, view=DEFAULT_VIEW):
+    """
+    make_spotify_request() for async callers; same arguments, results and exceptions,
+    except that HTTP errors are httpx's.
+    """
+    with ledger.track(endpoint, priority) as call:
+        return await _arequest(user, normalize_endpoint(endpoint), priority, view, call)
+
+
+async def _arequest(user, endpoint, priority, view, call):
+    _, ttl = cache_policy(endpoint)
+    entry = await _cache_call(get_entry, cache_key(endpoint, view)) if ttl else None
+    if entry is not None and entry.fresh_until > time.time():
+        record_lookup("hits")
+        call.cache = ledger.HIT
+        return entry.data
+
+    decision = breaker.allow()
+    if decision == REJECT:
+        if entry is not None:
+            call.cache = ledger.STALE
+            return _serve_stale(entry)
+        call.cache = ledger.REJECTED
+        raise SpotifyUnavailable("Spotify is unavailable right now, try again shortly.")
+    if decision == PROBE and entry is not None:
+        # answer from the stale copy; the probe revalidates it in the background
+        submit(_revalidate, user, endpoint, priority, ttl, entry, view)
+        call.cache = ledger.STALE
+        return _serve_stale(entry)
+
+    try:
+        return await _aload(user, endpoint, priority, ttl, entry, view)
+    except Exception as exc:
+        if entry is not None and _is_upstream_failure(exc):
+            call.cache = ledger.STALE
+            return _serve_stale(entry)
+        raise
+    finally:
+        if decision == PROBE:
+            breaker.release_probe()
+
+
+async def _aload(user, endpoint, priority, ttl, entry, view):
+    kind, _ = cache_policy(endpoint)
+    if not ttl:
+        return project(kind, (await _afetch(user, endpoint, priority))[0], view)
+    record_lookup("misses")
+    key = cache_key(endpoint, view)
+    call = ledger.current()
+    if call is not None:
+        call.cache = ledger.COALESCED  # unless we turn out to be the one fetching
+
+    async def fetch_and_store():
+        etag = entry.etag if entry is not None else None
+        data, etag = await _afetch(user, endpoint, priority, etag=etag)
+        if data is NOT_MODIFIED:
+            record_lookup("revalidated")
+            data, outcome = entry.data, ledger.REVALIDATED
+        else:
+            data, outcome = project(kind, data, view), ledger.MISS
+        if call is not None:
+            call.cache = outcome
+        await _cache_call(store, key, data, ttl, etag)
+        return data
+
+    return await _coalesce(key, fetch_and_store)
+
+
+async def _coalesce(key, fn):
+    """Share one fn() among all coroutines on this event loop that ask for `key` at once."""
+    loop = asyncio.get_running_loop()
+    future = _inflight.get((loop, key))
+    if future is not None:
+        result = await asyncio.shield(future)
+        spotify_coalesce._count("coalesced")
+        return result
+
+    future = _inflight[(loop, key)] = loop.create_future()
+    # nobody may be waiting; don't let an unretrieved exception be logged
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        spotify_coalesce._count("upstream")
+        result = await fn()
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        _inflight.pop((loop, key), None)
+
+
+async def _afetch(user, endpoint, priority, etag=None, retry_auth=True):
+    """One upstream GET, as spotify._fetch()."""
+    user_scoped = is_user_scoped(endpoint)
+    access_token = await _access_token(user, user_scoped)
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    await governor.aacquire(priority)
+    started = time.monotonic()
+    try:
+        response = await spotify_aget(f"{spotify.SPOTIFY_API_BASE_URL}{endpoint}", headers=headers)
+    except httpx.TransportError:
+        breaker.record_failure()
+        raise
+    call = ledger.current()
+    if call is not None:
+        call.upstream(response.status_code, time.monotonic() - started, len(response.content))
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success(time.monotonic() - started)
+    if response.status_code == 401 and not user_scoped and retry_auth:
+        await sync_to_async(forget_app_token)()
+        return await _afetch(user, endpoint, priority, etag=etag, retry_auth=False)
+    if response.status_code == 429:
+        retry_after = _retry_after(response)
+        await sync_to_async(governor.record_throttle)(retry_after)
+        raise SpotifyRateLimited(retry_after)
+    if response.status_code == 304:
+        return NOT_MODIFIED, etag
+    response.raise_for_status()
+    return response.json(), response.headers.get("ETag")
@@ -0,0 +1,96 @@
+"""
+Circuit breaker around upstream calls to Spotify.
+
+After SPOTIFY_BREAKER_FAILURE_THRESHOLD consecutive failures (connection errors,
+timeouts, 5xx) or SPOTIFY_BREAKER_SLOW_CALL_THRESHOLD consecutive calls slower than
+SPOTIFY_BREAKER_SLOW_CALL_SECONDS, the circuit opens and calls fail fast. After
+SPOTIFY_BREAKER_RESET_TIMEOUT it half-opens and lets a single probe through; the
+probe's outcome closes or re-opens it. State is per worker.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# what allow() tells the caller to do
+CALL = "call"
+PROBE = "probe"
+REJECT = "reject"
+
+
+class SpotifyUnavailable(Exception):
+    """Raised instead of calling Spotify while the circuit is open."""
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.slow_calls = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+
+    def allow(self):
+        """Return CALL, PROBE (the one trial call while half-open) or REJECT."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= settings.SPOTIFY_BREAKER_RESET_TIMEOUT:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return CALL
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return PROBE
+            self.rejected += 1
+            return REJECT
+
+    def record_success(self, latency):
+        with self._lock:
+            self.failures = 0
+            if latency > settings.SPOTIFY_BREAKER_SLOW_CALL_SECONDS:
+                self.slow_calls += 1
+                if self.state == HALF_OPEN or self.slow_calls >= settings.SPOTIFY_BREAKER_SLOW_CALL_THRESHOLD:
+                    self._open()
+                return
+            self.slow_calls = 0
+            self.state = CLOSED
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= settings.SPOTIFY_BREAKER_FAILURE_THRESHOLD:
+                self._open()
+
+    def release_probe(self):
+        """Let another probe through if the last one ended without a verdict."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def _open(self):
+        if self.state != OPEN:
+            self.times_opened += 1
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.failures = 0
+        self.slow_calls = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "consecutive_slow_calls": self.slow_calls,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+breaker = CircuitBreaker()
@@ -0,0 +1,222 @@
+"""
+Shared cache for Spotify catalog responses.
+
+Catalog data (albums, an artist's albums, new releases, search results) is the same
+for every user, so responses are keyed on the normalized endpoint only, never on the
+caller.
+Entries outlive their TTL by SPOTIFY_STALE_TTL so that a last known good response
+is still around when Spotify is unavailable.
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+# (policy name, path pattern); the policy name is looked up in SPOTIFY_CACHE_TTLS
+CATALOG_ENDPOINTS = [
+    ("album", re.compile(r"^v1/albums/[^/]+$")),
+    ("albums", re.compile(r"^v1/albums$")),
+    ("artist", re.compile(r"^v1/artists/[^/]+$")),
+    ("artist_albums", re.compile(r"^v1/artists/[^/]+/albums$")),
+    ("new_releases", re.compile(r"^v1/browse/new-releases$")),
+    # searched with the app token, so results don't depend on the user either
+    ("search", re.compile(r"^v1/search$")),
+]
+
+
+# `fresh_until` is an epoch timestamp; past it the entry is only served as stale, or
+# revalidated with If-None-Match when Spotify gave us an `etag` for it
+CacheEntry = namedtuple("CacheEntry", ["data", "fresh_until", "etag"], defaults=[None])
+
+_counters = {"hits": 0, "misses": 0, "stale": 0, "revalidated": 0}
+_counters_lock = threading.Lock()
+
+
+def record_lookup(outcome):
+    """
+    Count a lookup outcome: "hits", "misses", "stale" (served past its TTL) or
+    "revalidated" (a miss that Spotify answered with 304 Not Modified).
+    """
+    with _counters_lock:
+        _counters[outcome] += 1
+
+
+def normalize_endpoint(endpoint):
+    """
+    Return `endpoint` as "v1/path?sorted=query" so equivalent requests share a key.
+    Leading slashes and parameter order don't matter; blank parameters are dropped.
+    """
+    parts = urlsplit(endpoint)
+    path = parts.path.strip("/")
+    params = sorted((k, v) for k, v in parse_qsl(parts.query) if v != "")
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def cache_key(endpoint, view):
+    """Key for the `view` projection (see projections.py) of a normalized endpoint."""
+    return f"{endpoint}#{view}"
+
+
+def cache_policy(endpoint):
+    """Return (policy name, ttl seconds) for a normalized endpoint, or (None, 0)."""
+    path = endpoint.split("?", 1)[0]
+    for name, pattern in CATALOG_ENDPOINTS:
+        if pattern.match(path):
+            return name, settings.SPOTIFY_CACHE_TTLS.get(name, 0)
+    return None, 0
+
+
+class LocalCache:
+    """
+    In-process LRU cache with per-entry TTL, bounded by entry count and approximate bytes.
+    Values are shared between callers, so they must be treated as read-only.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries or settings.SPOTIFY_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or settings.SPOTIFY_CACHE_MAX_BYTES
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._discard(key)
+                return None
+            self._data.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, ttl):
+        size = len(json.dumps(value, separators=(",", ":")))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+            self._data[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._discard(next(iter(self._data)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _discard(self, key):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "local",
+                "evictions": self.evictions,
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class DjangoCache:
+    """
+    Stores responses in one of Django's configured caches (settings.CACHES), which
+    makes them shareable between workers when that cache is. Size limits and eviction
+    are whatever the chosen Django backend does.
+    """
+
+    key_prefix = "spotify:"
+
+    def __init__(self, alias=None):
+        self.alias = alias or settings.SPOTIFY_CACHE_ALIAS
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(self.key_prefix + key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(self.key_prefix + key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.key_prefix + key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return {"backend": "django", "alias": self.alias}
+
+
+BACKENDS = {
+    "local": LocalCache,
+    "django": DjangoCache,
+}
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """
+    Return this worker's response cache. SPOTIFY_CACHE_BACKEND is "local", "django"
+    or a dotted path to a class with the same get/set/delete/clear/stats interface.
+    """
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                backend = settings.SPOTIFY_CACHE_BACKEND
+                cls = BACKENDS[backend] if backend in BACKENDS else import_string(backend)
+                _response_cache = cls()
+    return _response_cache
+
+
+def reset_response_cache():
+    global _response_cache
+    _response_cache = None
+
+
+def get_entry(key):
+    """Return the CacheEntry for `key`, fresh or stale, or None."""
+    return get_response_cache().get(key)
+
+
+def store(key, data, ttl, etag=None):
+    """Cache `data` as fresh for `ttl` seconds and keep it as stale for SPOTIFY_STALE_TTL more."""
+    entry = CacheEntry(data, time.time() + ttl, etag)
+    get_response_cache().set(key, entry, ttl + settings.SPOTIFY_STALE_TTL)
+
+
+def store_stale(key, data, etag):
+    """
+    Seed the cache with an already-stale copy (e.g. from the database), so the next
+    request revalidates it with If-None-Match instead of downloading it again.
+    """
+    get_response_cache().set(key, CacheEntry(data, 0, etag), settings.SPOTIFY_STALE_TTL)
+
+
+def get_cache_stats():
+    with _counters_lock:
+        stats = dict(_counters)
+    stats.update(get_response_cache().stats())
+    return stats
@@ -0,0 +1,101 @@
+"""
+Single-flight coalescing of identical Spotify catalog GETs.
+
+Concurrent callers for the same normalized endpoint wait on one in-flight upstream
+request and share its result. Within a worker this uses a Future per key. With
+SPOTIFY_COALESCE_ACROSS_WORKERS, a lock in the Django cache elects one worker to
+fetch while the others poll the shared response cache for its result; that only
+helps when SPOTIFY_CACHE_BACKEND is "django" and the cache is shared.
+"""
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from django.conf import settings
+from django.core.cache import caches
+
+LOCK_PREFIX = "spotify:inflight:"
+POLL_INTERVAL = 0.05
+
+_inflight = {}
+_lock = threading.Lock()
+_counters = {"upstream": 0, "coalesced": 0, "coalesced_across_workers": 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def _wait_for_other_worker(key, lookup):
+    """Poll `lookup` while another worker holds the lock for `key`; None if it never lands."""
+    cache = caches[settings.SPOTIFY_CACHE_ALIAS]
+    deadline = time.monotonic() + settings.SPOTIFY_COALESCE_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        value = lookup()
+        if value is not None:
+            return value
+        if cache.get(LOCK_PREFIX + key) is None:
+            return lookup()
+    return None
+
+
+def _fetch(key, fn, lookup):
+    if not settings.SPOTIFY_COALESCE_ACROSS_WORKERS:
+        _count("upstream")
+        return fn()
+
+    cache = caches[settings.SPOTIFY_CACHE_ALIAS]
+    if not cache.add(LOCK_PREFIX + key, 1, settings.SPOTIFY_COALESCE_TIMEOUT):
+        value = _wait_for_other_worker(key, lookup)
+        if value is not None:
+            _count("coalesced_across_workers")
+            return value
+    try:
+        _count("upstream")
+        return fn()
+    finally:
+        cache.delete(LOCK_PREFIX + key)
+
+
+def coalesce(key, fn, lookup=lambda: None):
+    """
+    Return fn(), sharing one call among all threads that ask for `key` at the same time.
+    `lookup` reads a finished result from the shared cache (used across workers).
+    If the leading call takes longer than SPOTIFY_COALESCE_TIMEOUT, followers stop
+    waiting and make their own call.
+    """
+    with _lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+
+    if not leader:
+        try:
+            result = future.result(timeout=settings.SPOTIFY_COALESCE_TIMEOUT)
+        except TimeoutError:
+            return fn()
+        _count("coalesced")
+        return result
+
+    try:
+        result = _fetch(key, fn, lookup)
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+
+
+def get_coalesce_stats():
+    with _lock:
+        stats = dict(_counters)
+        stats["in_flight"] = len(_inflight)
+    stats["saved"] = stats["coalesced"] + stats["coalesced_across_workers"]
+    return stats
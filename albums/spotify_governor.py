@@ -0,0 +1,192 @@
+"""
+Cluster-wide pacing of calls to the Spotify Web API.
+
+Every worker draws from one token bucket stored in RateLimitBucket. Refill and
+withdrawal happen in a single conditional UPDATE, so the budget stays exact across
+processes; that is one write to the same row per upstream call. A 429 from Spotify
+blocks the bucket until its Retry-After has passed.
+
+Interactive (user) traffic may use the whole bucket and only queues briefly before
+being shed; background jobs leave a reserve untouched and queue for longer.
+"""
+import asyncio
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Least, Greatest
+from django.db.models.lookups import GreaterThanOrEqual
+
+from .models import RateLimitBucket
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+BUCKET_NAME = "spotify-api"
+
+
+class SpotifyRateLimited(Exception):
+    """Raised when there is no budget for a call within the caller's wait limit."""
+
+    def __init__(self, retry_after):
+        self.retry_after = max(int(retry_after + 0.999), 1)
+        super().__init__(f"Spotify rate limit reached, retry in {self.retry_after}s.")
+
+
+_lock = threading.Lock()
+_blocked_until = 0.0  # latest Retry-After seen by this worker; avoids queries while blocked
+_counters = {"granted": 0, "waited": 0, "shed": 0, "throttled": 0}
+
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+
+def _create_bucket():
+    RateLimitBucket.objects.get_or_create(
+        name=BUCKET_NAME,
+        defaults={"tokens": settings.SPOTIFY_RATE_LIMIT_BURST, "refilled_at": time.time()},
+    )
+
+
+def _reserve(priority):
+    if priority == BACKGROUND:
+        return settings.SPOTIFY_RATE_LIMIT_BURST * settings.SPOTIFY_RATE_LIMIT_BACKGROUND_RESERVE
+    return 0.0
+
+
+def _available(now):
+    """SQL expression for the bucket's token count at `now`, refill included."""
+    elapsed = Greatest(Value(now) - F("refilled_at"), Value(0.0))
+    return Least(
+        Value(float(settings.SPOTIFY_RATE_LIMIT_BURST)),
+        F("tokens") + elapsed * Value(float(settings.SPOTIFY_RATE_LIMIT_PER_SECOND)),
+    )
+
+
+def _try_take(priority, now):
+    available = _available(now)
+    return RateLimitBucket.objects.filter(
+        GreaterThanOrEqual(available, Value(1 + _reserve(priority))),
+        name=BUCKET_NAME,
+        blocked_until__lte=now,
+    ).update(tokens=available - 1, refilled_at=Greatest(F("refilled_at"), Value(now))) == 1
+
+
+def _wait_time(bucket, priority, now):
+    """Seconds until a take could succeed, judging from the bucket as stored."""
+    if bucket.blocked_until > now:
+        return bucket.blocked_until - now
+    rate = settings.SPOTIFY_RATE_LIMIT_PER_SECOND
+    tokens = min(settings.SPOTIFY_RATE_LIMIT_BURST, bucket.tokens + max(now - bucket.refilled_at, 0) * rate)
+    return max(1 + _reserve(priority) - tokens, 0) / rate + 0.01
+
+
+def _max_wait(priority):
+    if priority == BACKGROUND:
+        return settings.SPOTIFY_RATE_LIMIT_BACKGROUND_MAX_WAIT
+    return settings.SPOTIFY_RATE_LIMIT_MAX_WAIT
+
+
+def _attempt(priority):
+    """Try to take a token: None if we got one, otherwise how long to wait before trying again."""
+    now = time.time()
+    if _blocked_until > now:
+        return _blocked_until - now
+    if _try_take(priority, now):
+        return None
+    bucket = RateLimitBucket.objects.filter(name=BUCKET_NAME).first()
+    if bucket is None:
+        # first call against this database (or it was flushed)
+        _create_bucket()
+        if _try_take(priority, now):
+            return None
+        bucket = RateLimitBucket.objects.get(name=BUCKET_NAME)
+    return _wait_time(bucket, priority, now)
+
+
+def _granted(waited):
+    _count("granted")
+    if waited:
+        _count("waited")
+
+
+def _check_deadline(wait, deadline):
+    if time.monotonic() + wait > deadline:
+        _count("shed")
+        raise SpotifyRateLimited(wait)
+
+
+def acquire(priority=INTERACTIVE):
+    """
+    Take one call's worth of budget, queueing up to the priority's wait limit.
+    Raises SpotifyRateLimited if the budget can't be had in time.
+    """
+    if not settings.SPOTIFY_RATE_LIMIT_ENABLED:
+        return
+    deadline = time.monotonic() + _max_wait(priority)
+    waited = False
+    while True:
+        wait = _attempt(priority)
+        if wait is None:
+            return _granted(waited)
+        _check_deadline(wait, deadline)
+        waited = True
+        time.sleep(wait)
+
+
+async def aacquire(priority=INTERACTIVE):
+    """acquire() for async callers: the queries run in a thread, and waiting doesn't hold one."""
+    if not settings.SPOTIFY_RATE_LIMIT_ENABLED:
+        return
+    deadline = time.monotonic() + _max_wait(priority)
+    waited = False
+    while True:
+        wait = await sync_to_async(_attempt)(priority)
+        if wait is None:
+            return _granted(waited)
+        _check_deadline(wait, deadline)
+        waited = True
+        await asyncio.sleep(wait)
+
+
+def _block_bucket(until):
+    return RateLimitBucket.objects.filter(name=BUCKET_NAME).update(
+        blocked_until=Greatest(F("blocked_until"), Value(until)),
+        throttle_events=F("throttle_events") + 1,
+    )
+
+
+def record_throttle(retry_after):
+    """Block the bucket for every worker after Spotify answered 429."""
+    global _blocked_until
+    until = time.time() + retry_after
+    with _lock:
+        _blocked_until = max(_blocked_until, until)
+        _counters["throttled"] += 1
+    if settings.SPOTIFY_RATE_LIMIT_ENABLED:
+        if not _block_bucket(until):
+            _create_bucket()
+            _block_bucket(until)
+
+
+def get_governor_stats():
+    """Current cluster budget plus this worker's grant/queue/shed counters."""
+    with _lock:
+        stats = {"enabled": settings.SPOTIFY_RATE_LIMIT_ENABLED, "worker": dict(_counters)}
+    bucket = RateLimitBucket.objects.filter(name=BUCKET_NAME).first()
+    if bucket is not None:
+        now = time.time()
+        rate = settings.SPOTIFY_RATE_LIMIT_PER_SECOND
+        stats.update({
+            "tokens_available": min(settings.SPOTIFY_RATE_LIMIT_BURST,
+                                    bucket.tokens + max(now - bucket.refilled_at, 0) * rate),
+            "burst": settings.SPOTIFY_RATE_LIMIT_BURST,
+            "per_second": rate,
+            "blocked_for": max(bucket.blocked_until - now, 0),
+            "throttle_events": bucket.throttle_events,
+        })
+    return stats
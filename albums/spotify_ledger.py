@@ -0,0 +1,241 @@
+"""
+Ledger of calls made through the Spotify client.
+
+Every make_spotify_request() and token request leaves a record with:
+- the endpoint template (ids replaced by {id}) and the cache outcome
+- the upstream status, latency and response size
+- whether a token had to be refreshed inline first
+- the priority and the view that caused it (set by SpotifyLedgerMiddleware)
+
+The last SPOTIFY_LEDGER_SIZE records are kept in memory per worker (see spotify_stats).
+A SPOTIFY_LEDGER_SAMPLE_RATE share of them is written to SpotifyCallRecord in batches,
+for `manage.py spotify_ledger_report`.
+"""
+import math
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils import timezone
+
+from .models import SpotifyCallRecord
+from .background import submit
+
+# cache outcomes
+HIT = "hit"              # fresh entry in the response cache
+STALE = "stale"          # past its TTL, served because Spotify failed or the circuit is open
+COALESCED = "coalesced"  # shared an identical in-flight call
+MISS = "miss"            # fetched from Spotify
+REVALIDATED = "revalidated"  # Spotify answered 304 to If-None-Match
+UNCACHED = "uncached"    # endpoint without a cache policy, or a token request
+REJECTED = "rejected"    # circuit open and nothing cached
+
+# path segments that are followed by an id
+ID_PARENTS = {"albums", "artists", "tracks", "playlists", "users", "shows", "episodes", "audiobooks"}
+
+_current = ContextVar("spotify_ledger_call", default=None)
+_request = ContextVar("spotify_ledger_request", default=None)
+
+_lock = threading.Lock()
+_recent = None
+_pending = []
+_last_flush = time.monotonic()
+
+
+def endpoint_template(endpoint):
+    """"/v1/albums/4aawyAB9vmqN3uQ7FjRGTy?market=US" -> "v1/albums/{id}"."""
+    parts = endpoint.split("?", 1)[0].strip("/").split("/")
+    for i in range(1, len(parts)):
+        if parts[i - 1] in ID_PARENTS:
+            parts[i] = "{id}"
+    return "/".join(parts)
+
+
+def origin():
+    """Name of the view whose request we're serving (also inside its background tasks), or ""."""
+    request = _request.get()
+    match = getattr(request, "resolver_match", None)
+    if match is not None:
+        return match.view_name
+    return request.path if request is not None else ""
+
+
+class Call:
+    __slots__ = ("endpoint", "view", "priority", "cache", "status", "upstream_calls", "upstream_ms",
+                 "bytes", "token_refresh", "error", "started", "done")
+
+    def __init__(self, endpoint, priority):
+        self.endpoint = endpoint_template(endpoint)
+        self.view = origin()
+        self.priority = priority
+        self.cache = UNCACHED
+        self.status = None
+        self.upstream_calls = 0
+        self.upstream_ms = 0.0
+        self.bytes = 0
+        self.token_refresh = False
+        self.error = ""
+        self.started = time.monotonic()
+        self.done = False
+
+    def upstream(self, status, seconds, size):
+        """Note one HTTP round trip made for this call."""
+        self.status = status
+        self.upstream_calls += 1
+        self.upstream_ms += seconds * 1000
+        self.bytes += size
+
+    def as_row(self):
+        return {
+            "created_at": timezone.now(),
+            "endpoint": self.endpoint[:100],
+            "view": self.view[:100],
+            "priority": self.priority,
+            "cache": self.cache,
+            "status": self.status,
+            "upstream_calls": self.upstream_calls,
+            "upstream_ms": round(self.upstream_ms, 2),
+            "latency_ms": round((time.monotonic() - self.started) * 1000, 2),
+            "bytes": self.bytes,
+            "token_refresh": self.token_refresh,
+            "error": self.error[:100],
+        }
+
+
+def current():
+    """The call being tracked in this context, if any."""
+    call = _current.get()
+    return call if call is not None and not call.done else None
+
+
+@contextmanager
+def track(endpoint, priority):
+    """Record one client call; the body fills in the cache outcome and upstream details."""
+    call = Call(endpoint, priority)
+    token = _current.set(call)
+    try:
+        yield call
+    except Exception as exc:
+        call.error = type(exc).__name__
+        raise
+    finally:
+        _current.reset(token)
+        call.done = True
+        _record(call.as_row())
+
+
+def _record(row):
+    global _recent, _last_flush
+    batch = None
+    with _lock:
+        if _recent is None:
+            _recent = deque(maxlen=settings.SPOTIFY_LEDGER_SIZE)
+        _recent.append(row)
+        if random.random() < settings.SPOTIFY_LEDGER_SAMPLE_RATE:
+            _pending.append(row)
+        now = time.monotonic()
+        if _pending and (len(_pending) >= settings.SPOTIFY_LEDGER_FLUSH_SIZE
+                         or now - _last_flush >= settings.SPOTIFY_LEDGER_FLUSH_INTERVAL):
+            batch = list(_pending)
+            _pending.clear()
+            _last_flush = now
+    if batch:
+        submit(_flush, batch)
+
+
+def _flush(rows):
+    SpotifyCallRecord.objects.bulk_create([SpotifyCallRecord(**row) for row in rows])
+
+
+def recent():
+    """This worker's most recent records, oldest first."""
+    with _lock:
+        return list(_recent or ())
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (None if it's empty)."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+def summarize(rows):
+    """Totals, rates and upstream latency percentiles for a list of records."""
+    calls = len(rows)
+    upstream = [r for r in rows if r["upstream_calls"]]
+    cacheable = [r for r in rows if r["cache"] != UNCACHED]
+    latencies = sorted(r["upstream_ms"] for r in upstream)
+
+    def rate(count, total):
+        return round(count / total, 4) if total else None
+
+    return {
+        "calls": calls,
+        "upstream_calls": sum(r["upstream_calls"] for r in rows),
+        "cache_hit_rate": rate(sum(1 for r in cacheable if r["cache"] in (HIT, COALESCED, STALE)), len(cacheable)),
+        "error_rate": rate(sum(1 for r in rows if (r["status"] or 0) >= 500
+                               or (r["error"] and r["status"] is None)), calls),
+        "throttled_rate": rate(sum(1 for r in rows if r["status"] == 429 or r["error"] == "SpotifyRateLimited"),
+                               calls),
+        "token_refresh_rate": rate(sum(1 for r in rows if r["token_refresh"]), calls),
+        "bytes": sum(r["bytes"] for r in rows),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def summarize_by(rows, field, top=10):
+    """summarize() per value of `field`, the groups with most upstream calls first."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[field], []).append(row)
+    summaries = [dict(summarize(group), **{field: key}) for key, group in groups.items()]
+    summaries.sort(key=lambda s: (-s["upstream_calls"], -s["calls"]))
+    return summaries[:top]
+
+
+def get_ledger_stats():
+    rows = recent()
+    return {
+        "records": len(rows),
+        "sample_rate": settings.SPOTIFY_LEDGER_SAMPLE_RATE,
+        "summary": summarize(rows),
+        "endpoints": summarize_by(rows, "endpoint", top=5),
+        "views": summarize_by(rows, "view", top=5),
+    }
+
+
+class SpotifyLedgerMiddleware:
+    """Lets the ledger attribute Spotify calls to the view (route name) that made them."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _request.reset(token)
+
+    async def __acall__(self, request):
+        token = _request.set(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            _request.reset(token)
@@ -1,3 +1,942 @@
-from django.test import TestCase
+"""
+Tests for the albums app.
 
-# Create your tests here.
+QueryBudgetTests holds the query budgets for every route in albums/urls.py. Each endpoint is called against the same data seeded at several sizes, with Spotify
+replaced by the in-process fake (albums/fake_spotify.py) and background work run
+inline so its queries are counted too. An endpoint fails if it runs more queries
+than its budget at any size, or a different number at different sizes; the failure
+lists the queries it ran, with the app frames that issued the repeated ones. The
+Spotify proxy routes are measured again with their async views, against ASYNC_BUDGETS.
+"""
+import asyncio
+import importlib
+import json
+import re
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from io import StringIO
+from concurrent.futures import Future
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import URLPattern, URLResolver, clear_url_caches
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import async_views, background, catalog, spotify, spotify_async, spotify_breaker as breakers
+from . import leaderboards, spotify_governor as governor, spotify_ledger as ledger, urls
+from .catalog import NEW_RELEASES_SYNC, SNAPSHOT_VIEW
+from .fake_spotify import Catalog, Faults, FakeSpotifyServer, album_id, artist_id
+from .leaderboards import GLOBAL, YEAR, rebuild_leaderboards
+from .models import (
+    Artist, Album, Review, AlbumSnapshot, NewRelease, CatalogSync, RateLimitBucket, SpotifyToken,
+)
+from .projections import DEFAULT_VIEW, project
+from .spotify_coalesce import LOCK_PREFIX, coalesce, get_coalesce_stats
+from .ratings import reconcile_ratings
+from .spotify_breaker import CircuitBreaker, SpotifyUnavailable
+from .spotify_cache import cache_key, get_entry, get_response_cache, normalize_endpoint, store_stale
+from .spotify_governor import SpotifyRateLimited
+from .views import SIGNING_SALT, spotify_error
+
+SIZES = (3, 12, 40)
+
+# route name -> most queries one call may run, whatever the number of rows
+BUDGETS = {
+    "api-root": 0,
+    "artist-list": 1,
+    "artist-detail": 1,
+    "album-list": 1,
+    "album-detail": 1,
+    "album-top-rated": 2,
+    "review-list": 1,
+    "review-detail": 1,
+    "review-create": 6,
+    "review-update": 6,
+    "review-delete": 3,
+    "spotify-connect": 0,
+    "spotify-callback": 3,
+    "spotify-refresh": 6,
+    "spotify-search": 1,
+    "spotify-albums-resolve": 13,
+    "spotify-album-details": 1,
+    "spotify-album-details-upstream": 0,
+    "spotify-new-releases": 2,
+    "combined-album-details": 4,
+    "spotify-artist-albums": 2,
+    "spotify-stats": 1,
+}
+
+# the same for the Spotify proxy routes served by the async views (ASYNC_SPOTIFY_VIEWS);
+# they authenticate with a JWT, which looks the user up where force_authenticate doesn't
+ASYNC_BUDGETS = {
+    "spotify-search": 2,
+    "spotify-album-details": 2,
+    "spotify-album-details-upstream": 1,
+    "spotify-new-releases": 3,
+    "combined-album-details": 5,
+    "spotify-artist-albums": 3,
+}
+
+
+def route_names(patterns):
+    """Names of all the routes under `patterns`, through includes."""
+    names = set()
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            names |= route_names(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            names.add(pattern.name)
+    return names
+
+
+class QueryLog:
+    """Records every query run on the default connection, with the stack that ran it."""
+
+    def __init__(self):
+        self.queries = []  # (sql, stack)
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append((sql, traceback.extract_stack()[:-1]))
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def report(self):
+        shapes = Counter(re.sub(r"\d+", "N", sql) for sql, _ in self.queries)
+        lines = []
+        for number, (sql, stack) in enumerate(self.queries, start=1):
+            lines.append(f"  {number}. {sql[:300]}")
+            if shapes[re.sub(r"\d+", "N", sql)] > 1:
+                app_frames = [frame for frame in stack if "/albums/" in frame.filename and "tests.py" not in frame.filename]
+                lines += [f"       {frame.filename}:{frame.lineno} in {frame.name}" for frame in app_frames[-4:]]
+        return "\n".join(lines)
+
+
+@contextmanager
+def inline_background():
+    """Run work handed to the thread pools on the calling thread, and so on its connection."""
+    def run_inline(fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    real = {"submit": background.submit, "fan_out": background.fan_out}
+    with ExitStack() as stack:
+        for name, module in list(sys.modules.items()):
+            for attr, fn in real.items():
+                if name.startswith("albums.") and getattr(module, attr, None) is fn:
+                    stack.enter_context(mock.patch.object(module, attr, run_inline))
+        yield
+
+
+@contextmanager
+def spotify_proxy_views(use_async):
+    """Route the Spotify proxy endpoints to the async (or the sync) views, as ASYNC_SPOTIFY_VIEWS does."""
+    def reroute():
+        # albums/urls.py picks the views when it is imported
+        importlib.reload(urls)
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    try:
+        with override_settings(ASYNC_SPOTIFY_VIEWS=use_async):
+            reroute()
+            yield
+    finally:
+        reroute()
+
+
+def start_fake_spotify(add_cleanup, faults, catalog_size=1000):
+    """Serve a fake Spotify catalog until the cleanups registered with `add_cleanup` run."""
+    server = FakeSpotifyServer(("127.0.0.1", 0), Catalog(catalog_size), faults)
+    server.catalog.base_url = f"http://127.0.0.1:{server.server_port}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    add_cleanup(server.server_close)
+    add_cleanup(server.shutdown)
+    return server
+
+
+def point_spotify_at(test, server):
+    """Send the Spotify client's calls to `server` for the rest of `test`."""
+    for name, url in (("SPOTIFY_API_BASE_URL", server.catalog.base_url),
+                      ("SPOTIFY_TOKEN_URL", server.catalog.base_url + "api/token")):
+        patcher = mock.patch.object(spotify, name, url)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+@override_settings(SPOTIFY_HTTP_MAX_RETRIES=2, SPOTIFY_HTTP_BACKOFF_FACTOR=0)
+class SpotifySessionTests(SimpleTestCase):
+    """The shared keep-alive session, and the retries it does under the Spotify client's own handling."""
+
+    def get(self, faults, times=1):
+        server = start_fake_spotify(self.addCleanup, faults)
+        spotify._reset_session()
+        self.addCleanup(spotify._reset_session)
+        for _ in range(times):
+            response = spotify.spotify_get(server.catalog.base_url + f"v1/albums/{album_id(0)}",
+                                           headers={"Authorization": "Bearer a"})
+        return response, server.statuses
+
+    def test_connections_are_reused(self):
+        response, statuses = self.get(Faults("0"), times=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertIs(spotify.get_session(), spotify.get_session())
+        [host] = spotify.get_pool_stats()["hosts"].values()
+        self.assertEqual((host["connections_opened"], host["requests"], host["idle"]), (1, 5, 1))
+
+    def test_429_reaches_the_caller_at_once(self):
+        started = time.monotonic()
+        response, statuses = self.get(Faults("0", throttle_rate=1, retry_after=1))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(sum(statuses.values()), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_server_errors_are_retried(self):
+        response, statuses = self.get(Faults("0", error_rate=1))
+        self.assertGreaterEqual(response.status_code, 500)
+        self.assertEqual(sum(statuses.values()), 3)
+
+
+@override_settings(BACKGROUND_WORKERS=1, FAN_OUT_WORKERS=1)
+class ThreadPoolTests(SimpleTestCase):
+    """Background work and the fan-out requests wait on run on separate pools."""
+
+    def setUp(self):
+        background._reset_executor()
+        self.addCleanup(background._reset_executor)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_fan_out_is_not_queued_behind_background_work(self):
+        background.submit(self.release.wait, 10)
+        background.submit(self.release.wait, 10)
+        self.assertEqual(background.fan_out(str.upper, "done").result(timeout=5), "DONE")
+
+    def test_fan_out_runs_inline_on_a_pool(self):
+        def nested():
+            return background.fan_out(lambda: threading.current_thread().name).result(timeout=5)
+
+        self.assertTrue(background.submit(nested).result(timeout=5).startswith(background.BACKGROUND_POOL))
+        self.assertTrue(background.fan_out(nested).result(timeout=5).startswith(background.FAN_OUT_POOL))
+
+
+def fake_token_endpoint(posts, during=None):
+    """Patch Spotify's token endpoint to hand out new{n} tokens, recording each form posted to it."""
+    def post(url, **kwargs):
+        posts.append(kwargs["data"])
+        if during is not None:
+            during()
+        time.sleep(0.1)
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"access_token": f"new{len(posts)}", "token_type": "Bearer", "expires_in": 3600}
+        return response
+    return mock.patch.object(spotify, "spotify_post", post)
+
+
+class TokenRefreshTests(TransactionTestCase):
+    """Refreshing a user's Spotify token, with the call to Spotify's token endpoint faked."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("listener", password="x")
+        self.token = SpotifyToken.objects.create(user=self.user, access_token="old", refresh_token="r",
+                                                 expires_at=timezone.now() - timedelta(minutes=1))
+        self.posts = []
+
+    def fake_post(self, during=None):
+        return fake_token_endpoint(self.posts, during)
+
+    def test_concurrent_callers_refresh_once(self):
+        results = []
+
+        def refresh():
+            try:
+                results.append(spotify.refresh_user_token(self.user.pk).access_token)
+            finally:
+                connection.close()
+
+        with self.fake_post():
+            threads = [threading.Thread(target=refresh) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(self.posts), 1)
+        self.assertEqual(results, ["new1"] * 5)
+        self.token.refresh_from_db()
+        self.assertEqual((self.token.access_token, self.token.refresh_token), ("new1", "r"))
+
+    def test_a_concurrent_refresh_elsewhere_wins(self):
+        def other_worker():
+            SpotifyToken.objects.filter(pk=self.token.pk).update(
+                access_token="theirs", expires_at=timezone.now() + timedelta(hours=1))
+
+        with self.fake_post(during=other_worker):
+            self.assertEqual(spotify.refresh_user_token(self.user.pk).access_token, "theirs")
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.access_token, "theirs")
+
+    def test_fresh_tokens_are_not_refreshed(self):
+        SpotifyToken.objects.filter(pk=self.token.pk).update(expires_at=timezone.now() + timedelta(hours=1))
+        with self.fake_post():
+            self.assertEqual(spotify.refresh_user_token(self.user.pk).access_token, "old")
+        self.assertEqual(self.posts, [])
+
+
+class RefreshTokensCommandTests(TransactionTestCase):
+    """manage.py refresh_spotify_tokens, with Spotify's token endpoint faked."""
+
+    def setUp(self):
+        now = timezone.now()
+        self.users = [User.objects.create_user(f"listener{i}", password="x") for i in range(4)]
+        for i, user in enumerate(self.users):
+            SpotifyToken.objects.create(user=user, access_token=f"old{i}", refresh_token=f"r{i}",
+                                        expires_at=now + timedelta(minutes=(1, 2, 3, 60)[i]))
+        self.posts = []
+
+    def tokens(self):
+        return dict(SpotifyToken.objects.order_by("user_id").values_list("refresh_token", "access_token"))
+
+    def test_refreshes_only_the_due_tokens(self):
+        with fake_token_endpoint(self.posts):
+            call_command("refresh_spotify_tokens", within=10, batch_size=2, workers=2, stdout=StringIO())
+        self.assertEqual(sorted(post["refresh_token"] for post in self.posts), ["r0", "r1", "r2"])
+        tokens = self.tokens()
+        self.assertTrue(all(tokens[f"r{i}"].startswith("new") for i in range(3)))
+        self.assertEqual(tokens["r3"], "old3")
+
+    def test_keeps_tokens_a_request_refreshed_meanwhile(self):
+        def request_refreshes():
+            SpotifyToken.objects.filter(refresh_token="r0").update(access_token="by-request")
+            connection.close()
+
+        with fake_token_endpoint(self.posts, during=request_refreshes):
+            call_command("refresh_spotify_tokens", within=10, workers=1, stdout=StringIO())
+        self.assertEqual(self.tokens()["r0"], "by-request")
+        self.assertTrue(self.tokens()["r1"].startswith("new"))
+
+    def test_token_rows_are_not_locked_while_spotify_is_called(self):
+        def request_writes():
+            # would wait on the batch's row locks (or fail as locked) if they were held here
+            with transaction.atomic():
+                SpotifyToken.objects.select_for_update().filter(refresh_token="r1").update(scope="x")
+            connection.close()
+
+        with fake_token_endpoint(self.posts, during=request_writes):
+            call_command("refresh_spotify_tokens", within=10, workers=1, stdout=StringIO())
+        self.assertEqual(len(self.posts), 3)
+
+
+class DiscographyTests(APITestCase):
+    """GET /api/spotify/artists/<id>/albums/, with the artist's Spotify pages faked."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("listener", password="x")
+        self.client.force_authenticate(self.user)
+        self.endpoints = []
+
+    def fake_spotify(self, albums):
+        def request(user, endpoint, priority=None, view=None):
+            self.endpoints.append(endpoint.split("?")[0])
+            if endpoint == f"/v1/artists/{artist_id(1)}":
+                return {"id": artist_id(1), "name": "Guest"}
+            return {"items": albums, "total": len(albums)}
+        return mock.patch.object(catalog, "make_spotify_request", request)
+
+    def get_albums(self):
+        response = self.client.get(f"/api/spotify/artists/{artist_id(1)}/albums/")
+        self.assertEqual(response.status_code, 200, response.content)
+        return [album["id"] for album in response.data]
+
+    def test_albums_the_artist_is_credited_on_are_listed(self):
+        collaboration = {"id": album_id(0), "name": "Duets", "release_date": "2010", "images": [],
+                         "artists": [{"id": artist_id(0), "name": "Host"}, {"id": artist_id(1), "name": "Guest"}]}
+        with self.fake_spotify([collaboration]):
+            self.assertEqual(self.get_albums(), [album_id(0)])
+            self.assertEqual(self.get_albums(), [album_id(0)])
+        self.assertEqual(Album.objects.get(spotify_id=album_id(0)).artist.spotify_id, artist_id(0))
+        self.assertEqual(self.endpoints, [f"/v1/artists/{artist_id(1)}", f"/v1/artists/{artist_id(1)}/albums"])
+
+    def test_an_artist_without_albums_is_crawled_once(self):
+        with self.fake_spotify([]):
+            self.assertEqual(self.get_albums(), [])
+            self.assertEqual(self.get_albums(), [])
+        self.assertEqual(len(self.endpoints), 2)
+        self.assertIsNotNone(Artist.objects.get(spotify_id=artist_id(1)).discography_synced_at)
+
+
+@override_settings(SPOTIFY_RATE_LIMIT_ENABLED=False)
+class ConditionalRequestTests(TestCase):
+    """A stale cached album is revalidated with If-None-Match rather than downloaded again."""
+
+    endpoint = f"/v1/albums/{album_id(0)}"
+
+    def setUp(self):
+        self.server = start_fake_spotify(self.addCleanup, Faults("0"))
+        point_spotify_at(self, self.server)
+        get_response_cache().clear()
+        caches["default"].clear()
+        spotify._app_token = None
+        self.key = cache_key(normalize_endpoint(self.endpoint), DEFAULT_VIEW)
+
+    def refetch(self):
+        """Fetch the album again, returning (data, If-None-Match header sent)."""
+        with mock.patch.object(spotify, "spotify_get", wraps=spotify.spotify_get) as get:
+            data = spotify.make_spotify_request(None, self.endpoint)
+        [call] = [call for call in get.call_args_list if "/v1/albums/" in call.args[0]]
+        return data, call.kwargs["headers"].get("If-None-Match")
+
+    def test_a_304_keeps_the_cached_payload_and_freshens_it(self):
+        cached = spotify.make_spotify_request(None, self.endpoint)
+        etag = get_entry(self.key).etag
+        self.assertEqual(etag, f'"{self.server.catalog.seed}-{album_id(0)}"')
+        store_stale(self.key, cached, etag)
+
+        data, sent = self.refetch()
+        self.assertEqual(sent, etag)
+        self.assertEqual(self.server.statuses[304], 1)
+        self.assertIs(data, cached)
+        entry = get_entry(self.key)
+        self.assertEqual(entry.etag, etag)
+        self.assertGreater(entry.fresh_until, time.time())
+
+    def test_a_200_replaces_the_payload_and_the_etag(self):
+        store_stale(self.key, {"name": "old"}, '"old"')
+
+        data, sent = self.refetch()
+        self.assertEqual(sent, '"old"')
+        self.assertEqual(self.server.statuses[304], 0)
+        self.assertEqual(data["id"], album_id(0))
+        entry = get_entry(self.key)
+        self.assertEqual(entry.etag, f'"{self.server.catalog.seed}-{album_id(0)}"')
+        self.assertGreater(entry.fresh_until, time.time())
+
+
+class CoalesceTests(SimpleTestCase):
+    """Single-flight of identical Spotify GETs within a worker, and across workers through the cache."""
+
+    key = "v1/albums/test"
+
+    def setUp(self):
+        self.calls = 0
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def slow(self, result=None, error=None):
+        def fetch():
+            self.calls += 1
+            self.entered.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return fetch
+
+    def run_callers(self, fetch, count=5):
+        """coalesce() from `count` threads, the first one leading; returns each result or exception."""
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(coalesce(self.key, fetch))
+            except Exception as exc:
+                outcomes.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        threads[0].start()
+        self.assertTrue(self.entered.wait(5))
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)  # let the followers find the leader's call
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return outcomes
+
+    def test_concurrent_callers_share_one_fetch(self):
+        before = get_coalesce_stats()
+        payload = {"id": "shared"}
+        outcomes = self.run_callers(self.slow(result=payload))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(outcomes), 5)
+        self.assertTrue(all(outcome is payload for outcome in outcomes))
+        stats = get_coalesce_stats()
+        self.assertEqual(stats["upstream"] - before["upstream"], 1)
+        self.assertEqual(stats["coalesced"] - before["coalesced"], 4)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_followers_get_the_leaders_error_and_the_key_is_released(self):
+        error = ValueError("upstream failed")
+        outcomes = self.run_callers(self.slow(error=error))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(outcomes, [error] * 5)
+        self.assertEqual(coalesce(self.key, lambda: "again"), "again")
+
+    @override_settings(SPOTIFY_COALESCE_ACROSS_WORKERS=True)
+    def test_waits_for_another_worker_holding_the_lock(self):
+        cache = caches[settings.SPOTIFY_CACHE_ALIAS]
+        cache.add(LOCK_PREFIX + self.key, 1, 5)
+        self.addCleanup(cache.delete, LOCK_PREFIX + self.key)
+        lookups = iter([None, None, "from the other worker"])
+        self.assertEqual(coalesce(self.key, self.slow(result="ours"), lookup=lambda: next(lookups)),
+                         "from the other worker")
+        self.assertEqual(self.calls, 0)
+
+
+@override_settings(
+    SPOTIFY_BREAKER_FAILURE_THRESHOLD=3,
+    SPOTIFY_BREAKER_SLOW_CALL_SECONDS=5,
+    SPOTIFY_BREAKER_SLOW_CALL_THRESHOLD=2,
+    SPOTIFY_BREAKER_RESET_TIMEOUT=30,
+)
+class CircuitBreakerTests(SimpleTestCase):
+    """CircuitBreaker state changes, on a clock the tests move by hand."""
+
+    def setUp(self):
+        clock = mock.patch("albums.spotify_breaker.time")
+        self.time = clock.start()
+        self.addCleanup(clock.stop)
+        self.time.monotonic.return_value = 1000.0
+        self.breaker = CircuitBreaker()
+
+    def advance(self, seconds):
+        self.time.monotonic.return_value += seconds
+
+    def trip(self):
+        for _ in range(3):
+            self.assertEqual(self.breaker.allow(), breakers.CALL)
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success(0.1)  # a success in between starts the count again
+        self.trip()
+        self.assertEqual(self.breaker.state, breakers.OPEN)
+        self.assertEqual(self.breaker.allow(), breakers.REJECT)
+        self.assertEqual(self.breaker.stats()["times_opened"], 1)
+
+    def test_opens_after_consecutive_slow_calls(self):
+        self.breaker.record_success(6)
+        self.breaker.record_success(6)
+        self.assertEqual(self.breaker.allow(), breakers.REJECT)
+
+    def test_lets_one_probe_through_after_the_timeout(self):
+        self.trip()
+        self.advance(29)
+        self.assertEqual(self.breaker.allow(), breakers.REJECT)
+        self.advance(1)
+        self.assertEqual(self.breaker.allow(), breakers.PROBE)
+        self.assertEqual(self.breaker.allow(), breakers.REJECT)
+        self.assertEqual(self.breaker.state, breakers.HALF_OPEN)
+
+    def test_a_successful_probe_closes_the_circuit(self):
+        self.trip()
+        self.advance(30)
+        self.assertEqual(self.breaker.allow(), breakers.PROBE)
+        self.breaker.record_success(0.1)
+        self.assertEqual(self.breaker.state, breakers.CLOSED)
+        self.assertEqual(self.breaker.allow(), breakers.CALL)
+
+    def test_a_failed_or_slow_probe_reopens_it(self):
+        self.trip()
+        for record in (self.breaker.record_failure, lambda: self.breaker.record_success(6)):
+            self.advance(30)
+            self.assertEqual(self.breaker.allow(), breakers.PROBE)
+            record()
+            self.assertEqual(self.breaker.state, breakers.OPEN)
+            self.assertEqual(self.breaker.allow(), breakers.REJECT)
+        self.assertEqual(self.breaker.stats()["times_opened"], 3)
+
+    def test_a_probe_without_a_verdict_lets_another_through(self):
+        self.trip()
+        self.advance(30)
+        self.assertEqual(self.breaker.allow(), breakers.PROBE)
+        self.breaker.release_probe()
+        self.assertEqual(self.breaker.allow(), breakers.PROBE)
+
+
+@override_settings(
+    SPOTIFY_RATE_LIMIT_ENABLED=True,
+    SPOTIFY_RATE_LIMIT_BURST=2,
+    SPOTIFY_RATE_LIMIT_PER_SECOND=0.01,
+    SPOTIFY_RATE_LIMIT_BACKGROUND_RESERVE=0.5,
+    SPOTIFY_RATE_LIMIT_MAX_WAIT=0,
+    SPOTIFY_RATE_LIMIT_BACKGROUND_MAX_WAIT=0,
+)
+class GovernorTests(TestCase):
+    """The shared token bucket, with a burst of two and next to no refill."""
+
+    def setUp(self):
+        governor._blocked_until = 0.0
+        self.addCleanup(setattr, governor, "_blocked_until", 0.0)
+
+    def bucket(self):
+        return RateLimitBucket.objects.get(name=governor.BUCKET_NAME)
+
+    def test_grants_the_burst_then_sheds(self):
+        shed = governor.get_governor_stats()["worker"]["shed"]
+        governor.acquire()  # creates the bucket
+        with self.assertNumQueries(1):
+            governor.acquire()
+        with self.assertRaises(governor.SpotifyRateLimited) as raised:
+            governor.acquire()
+        self.assertGreater(raised.exception.retry_after, 60)
+        self.assertLess(self.bucket().tokens, 1)
+        self.assertEqual(governor.get_governor_stats()["worker"]["shed"], shed + 1)
+
+    def test_background_leaves_the_reserve_to_users(self):
+        governor.acquire(governor.BACKGROUND)
+        with self.assertRaises(governor.SpotifyRateLimited):
+            governor.acquire(governor.BACKGROUND)
+        governor.acquire(governor.INTERACTIVE)
+
+    def test_throttle_blocks_every_worker(self):
+        governor.acquire()
+        governor.record_throttle(30)
+        governor._blocked_until = 0.0  # as seen from another worker
+        with self.assertRaises(governor.SpotifyRateLimited) as raised:
+            governor.acquire()
+        self.assertGreaterEqual(raised.exception.retry_after, 29)
+        self.assertEqual(self.bucket().throttle_events, 1)
+        self.assertGreaterEqual(self.bucket().tokens, 1)
+
+
+@override_settings(BACKGROUND_RESULT_TIMEOUT=0.01)
+class SearchTests(APITestCase):
+    """Searching several types at once."""
+
+    def setUp(self):
+        self.client.force_authenticate(User.objects.create_user("searcher", password="x"))
+
+    def test_a_search_that_never_returns_is_a_503(self):
+        with mock.patch("albums.search.fan_out", return_value=Future()):
+            response = self.client.get("/api/spotify/search/?q=midnight&type=album,artist")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {"error": "Timed out waiting for Spotify."})
+
+
+@override_settings(
+    SPOTIFY_RATE_LIMIT_ENABLED=False,
+    SPOTIFY_LEDGER_SAMPLE_RATE=0,
+    SPOTIFY_SEARCH_PREFETCH=0,
+    SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE=False,
+)
+class AsyncSpotifyTests(TestCase):
+    """The async client and proxy views (ASYNC_SPOTIFY_VIEWS) answer like the sync ones."""
+
+    def setUp(self):
+        self.server = start_fake_spotify(self.addCleanup, Faults("0"))
+        point_spotify_at(self, self.server)
+        get_response_cache().clear()
+        caches["default"].clear()
+        spotify._app_token = None
+        user = User.objects.create_user("listener", password="x")
+        self.auth = {"Authorization": f"Bearer {AccessToken.for_user(user)}"}
+        self.factory = AsyncRequestFactory()
+
+    def get(self, path, use_async):
+        """GET `path` through the sync or the async views, with nothing cached or stored."""
+        get_response_cache().clear()
+        AlbumSnapshot.objects.all().delete()
+        with spotify_proxy_views(use_async):
+            response = self.client.get(path, headers=self.auth)
+            self.assertEqual(asyncio.iscoroutinefunction(response.resolver_match.func), use_async)
+        return response
+
+    def test_routes_answer_like_the_sync_views(self):
+        paths = [
+            "/api/spotify/browse/new-releases/?limit=5",
+            "/api/spotify/search/?q=midnight&type=album",
+            "/api/spotify/search/?q=midnight&type=album,artist,track",
+            f"/api/spotify/albums/{album_id(1)}/",
+            f"/api/spotify/albums/{album_id(2)}/?view=full",
+        ]
+        for path in paths:
+            with self.subTest(path):
+                expected = self.get(path, use_async=False)
+                upstream = self.server.statuses[200]
+                response = self.get(path, use_async=True)
+                self.assertEqual(response.status_code, 200)
+                self.assertGreater(self.server.statuses[200], upstream)
+                self.assertEqual(response.json(), expected.json())
+
+    def test_each_event_loop_has_its_own_http_client(self):
+        endpoint = f"/v1/albums/{album_id(0)}"
+
+        async def fetch():
+            get_response_cache().clear()
+            data = await spotify_async.amake_spotify_request(None, endpoint)
+            return spotify_async.get_async_client(), spotify_async.get_async_client(), data
+
+        first, same, data = asyncio.run(fetch())
+        second, _, again = asyncio.run(fetch())
+        self.assertIs(first, same)
+        self.assertIsNot(first, second)
+        self.assertEqual(data, again)
+        self.assertEqual(self.server.statuses[200], 3)  # the app token, then the album from each loop
+
+    async def test_unauthenticated_requests_are_refused(self):
+        response = await async_views.spotify_album_details(self.factory.get("/"), album_id(0))
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response.has_header("WWW-Authenticate"))
+
+    async def test_only_get_is_allowed(self):
+        response = await async_views.spotify_album_details(self.factory.post("/", headers=self.auth), album_id(0))
+        self.assertEqual(response.status_code, 405)
+
+    async def test_errors_are_mapped_like_the_sync_views(self):
+        for exc in (SpotifyRateLimited(7), SpotifyUnavailable("Spotify is down."), TimeoutError(), ValueError("boom")):
+            with self.subTest(exc=exc), mock.patch.object(async_views, "aget_album_payload", side_effect=exc):
+                response = await async_views.spotify_album_details(self.factory.get("/", headers=self.auth),
+                                                                   album_id(0))
+            body, status, headers = spotify_error(exc)
+            self.assertEqual((response.status_code, json.loads(response.content)), (status, body))
+            for name, value in headers.items():
+                self.assertEqual(response[name], value)
+
+
+class ReviewApiTests(APITestCase):
+    """Writing reviews through the API, for albums stored locally."""
+
+    def setUp(self):
+        self.user = User.objects.create_user("reviewer", password="x")
+        self.client.force_authenticate(self.user)
+        artist = Artist.objects.create(name="Artist", spotify_id=artist_id(0))
+        self.album = Album.objects.create(title="Album", artist=artist, release_year=2001, spotify_id=album_id(0))
+
+    def test_create_returns_the_new_rating(self):
+        response = self.client.post("/api/reviews/", {"spotify_album_id": self.album.spotify_id, "rating": 4},
+                                    format="json")
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.data["album"]["average_rating"], 4.0)
+        self.assertEqual(response.data["album"]["review_count"], 1)
+
+    def test_another_edition_is_reviewed_as_the_stored_album(self):
+        edition = album_id(1)
+        AlbumSnapshot.objects.create(
+            spotify_id=edition, fetched_at=timezone.now(),
+            payload={"id": edition, "name": "Album", "release_date": "2011", "images": [],
+                     "artists": [{"id": artist_id(0), "name": "Artist"}]},
+        )
+        response = self.client.post("/api/reviews/", {"spotify_album_id": edition, "rating": 3}, format="json")
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.data["album"]["id"], self.album.pk)
+        self.assertFalse(Album.objects.filter(spotify_id=edition).exists())
+
+    def test_update_returns_the_new_rating(self):
+        review = Review.objects.create(album=self.album, user=self.user, rating=2)
+        response = self.client.patch(f"/api/reviews/{review.pk}/", {"rating": 5}, format="json")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["album"]["average_rating"], 5.0)
+        self.assertEqual(response.data["album"]["review_count"], 1)
+
+
+class LeaderboardTests(TestCase):
+    """Bayesian ranking, and the background refreshes reviews trigger."""
+
+    def album(self, n, ratings):
+        artist = Artist.objects.create(name=f"Artist {n}")
+        return Album.objects.create(title=f"Album {n}", artist=artist, release_year=2001, genre="rock",
+                                    rating_sum=sum(ratings), review_count=len(ratings),
+                                    avg_rating=sum(ratings) / len(ratings))
+
+    def test_one_top_rating_does_not_outrank_many_high_ones(self):
+        lucky = self.album(1, [5])
+        loved = self.album(2, [4] * 40)
+        self.album(3, [2] * 20)
+        board = leaderboards.refresh_leaderboard(leaderboards.GLOBAL)
+        ranking = list(board.entries.order_by("rank").values_list("album_id", flat=True))
+        self.assertLess(ranking.index(loved.pk), ranking.index(lucky.pk))
+
+    @override_settings(LEADERBOARD_REFRESH_ON_REVIEW=True, BACKGROUND_WORKERS=4)
+    def test_rankings_already_being_refreshed_are_not_queued_again(self):
+        background._reset_executor()
+        self.addCleanup(background._reset_executor)
+        release = threading.Event()
+        refreshed = []
+
+        def refresh(scope, key=""):
+            refreshed.append((scope, key))
+            release.wait(5)
+
+        slices = {1: [(GLOBAL, ""), (YEAR, "2001")], 2: [(GLOBAL, ""), (YEAR, "2002")]}
+        with mock.patch.object(leaderboards, "refresh_leaderboard", refresh), \
+                mock.patch.object(leaderboards, "album_slices", slices.get):
+            with self.captureOnCommitCallbacks(execute=True):
+                for album_ids in ([1], [1], [2], [1]):
+                    leaderboards.schedule_refresh(album_ids)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and (
+                    len(refreshed) < 3 or any(key[0] == "leaderboard-albums" for key in background._pending)):
+                time.sleep(0.01)
+            release.set()
+            while time.monotonic() < deadline and background._pending:
+                time.sleep(0.01)
+        self.assertCountEqual(refreshed, [(GLOBAL, ""), (YEAR, "2001"), (YEAR, "2002")])
+
+
+@override_settings(
+    SPOTIFY_CLIENT_ID="client-id",
+    SPOTIFY_CLIENT_SECRET="client-secret",
+    SPOTIFY_REDIRECT_URI="http://testserver/api/spotify/callback/",
+    # the governor's one UPDATE per upstream call is covered by GovernorTests
+    SPOTIFY_RATE_LIMIT_ENABLED=False,
+    SPOTIFY_LEDGER_SAMPLE_RATE=0,
+    SPOTIFY_SEARCH_PREFETCH=0,
+    SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE=False,
+    LEADERBOARD_REFRESH_ON_REVIEW=False,
+)
+class QueryBudgetTests(APITestCase):
+    catalog_size = 1000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = start_fake_spotify(cls.addClassCleanup, Faults("0"), cls.catalog_size)
+        cls.catalog = cls.server.catalog
+
+    def setUp(self):
+        point_spotify_at(self, self.server)
+        self.user = User.objects.create_user("budget", password="x", is_staff=True)
+        SpotifyToken.objects.create(user=self.user, access_token="a", refresh_token="r",
+                                    expires_at=timezone.now() + timedelta(hours=1))
+        self.client.force_authenticate(self.user)
+
+    def reset_spotify_state(self):
+        get_response_cache().clear()
+        caches["default"].clear()
+        spotify._app_token = None
+        governor._blocked_until = 0.0
+        ledger._pending.clear()  # rows sampled by earlier tests, which would be flushed in here
+        spotify.forget_token(self.user.pk)
+
+    def seed(self, size):
+        """`size` users, artists and albums, and about size * size / 2 reviews."""
+        now = timezone.now()
+        users = User.objects.bulk_create([User(username=f"reviewer{i}") for i in range(size)])
+        artists = Artist.objects.bulk_create([
+            Artist(name=f"Artist {i}", spotify_id=artist_id(i), discography_synced_at=now) for i in range(size)
+        ])
+        albums = Album.objects.bulk_create([
+            Album(title=self.catalog.simple_album(i)["name"] + f" {i}", artist=artists[i], spotify_id=album_id(i),
+                  release_year=2000 + i % 4, genre=("rock", "jazz", "pop")[i % 3])
+            for i in range(size)
+        ])
+        Album.artists.through.objects.bulk_create([
+            Album.artists.through(album=album, artist_id=album.artist_id) for album in albums
+        ])
+        Review.objects.bulk_create([
+            Review(album=album, user=user, rating=1 + (i + j) % 5)
+            for i, album in enumerate(albums) for j, user in enumerate(users) if (i + j) % 2 == 0
+        ])
+        reconcile_ratings()
+        NewRelease.objects.bulk_create([NewRelease(album=album, position=i) for i, album in enumerate(albums)])
+        CatalogSync.objects.create(name=NEW_RELEASES_SYNC, synced_at=now, item_count=size)
+        AlbumSnapshot.objects.bulk_create([
+            AlbumSnapshot(spotify_id=album_id(i), payload=project("album", self.catalog.album(i), SNAPSHOT_VIEW),
+                          fetched_at=now)
+            for i in range(size)
+        ])
+        own_review = Review.objects.create(album=albums[-1], user=self.user, rating=3)
+        rebuild_leaderboards()
+        return albums, own_review
+
+    def calls(self, albums, own_review, size):
+        """(route name, method, path, data) of the calls to measure, in order."""
+        state = signing.dumps({"user_id": self.user.pk, "ts": timezone.now().timestamp()}, salt=SIGNING_SALT)
+        unknown = album_id(self.catalog_size - 1)
+        return [
+            ("api-root", "get", "/api/", None),
+            ("artist-list", "get", "/api/artists/", None),
+            ("artist-detail", "get", f"/api/artists/{albums[0].artist_id}/", None),
+            ("album-list", "get", "/api/albums/", None),
+            ("album-detail", "get", f"/api/albums/{albums[0].pk}/", None),
+            ("album-top-rated", "get", "/api/albums/top_rated/?limit=50", None),
+            ("review-list", "get", "/api/reviews/", None),
+            ("review-detail", "get", f"/api/reviews/{own_review.pk}/", None),
+            ("review-create", "post", "/api/reviews/", {"spotify_album_id": albums[0].spotify_id, "rating": 4}),
+            ("review-update", "patch", f"/api/reviews/{own_review.pk}/", {"rating": 5}),
+            ("review-delete", "delete", f"/api/reviews/{own_review.pk}/", None),
+            ("spotify-connect", "get", "/api/spotify/connect/", None),
+            ("spotify-callback", "get", f"/api/spotify/callback/?code=abc&state={state}", None),
+            ("spotify-refresh", "post", "/api/spotify/refresh/", None),
+            ("spotify-search", "get", "/api/spotify/search/?q=midnight&type=album,artist,track", None),
+            ("spotify-albums-resolve", "post", "/api/spotify/albums/resolve/",
+             {"ids": [album.spotify_id for album in albums] + [album_id(size + i) for i in range(size)]}),
+            ("spotify-album-details", "get", f"/api/spotify/albums/{albums[1].spotify_id}/", None),
+            ("spotify-new-releases", "get", "/api/spotify/browse/new-releases/?limit=50", None),
+            ("combined-album-details", "get", f"/api/album-details/{albums[0].spotify_id}/", None),
+            ("spotify-artist-albums", "get", f"/api/spotify/artists/{artist_id(0)}/albums/", None),
+            ("spotify-stats", "get", "/api/spotify/stats/", None),
+            ("spotify-album-details-upstream", "get", f"/api/spotify/albums/{unknown}/?view=full", None),
+        ]
+
+    def measure(self, size, use_async=False):
+        """
+        {route name: QueryLog} for one pass over the routes against `size` rows; with
+        `use_async`, over the Spotify proxy routes served by the async views.
+        """
+        logs = {}
+        with transaction.atomic():
+            albums, own_review = self.seed(size)
+            self.reset_spotify_state()
+            calls = self.calls(albums, own_review, size)
+            if use_async:
+                calls = [call for call in calls if call[0] in ASYNC_BUDGETS]
+                self.client.force_authenticate(None)
+                self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}")
+            with inline_background(), spotify_proxy_views(use_async):
+                for name, method, path, data in calls:
+                    log = QueryLog()
+                    with connection.execute_wrapper(log):
+                        response = getattr(self.client, method)(path, data, format="json")
+                    self.assertLess(response.status_code, 400, f"{name} {path}: {response.content[:500]!r}")
+                    logs[name] = log
+            transaction.set_rollback(True)
+        return logs
+
+    def test_every_route_is_budgeted(self):
+        routes = route_names(urls.urlpatterns)
+        self.assertFalse(routes - set(BUDGETS), "routes without a query budget")
+
+    def test_query_budgets(self):
+        self.assert_within_budgets(BUDGETS, {size: self.measure(size) for size in SIZES})
+
+    def test_async_query_budgets(self):
+        self.assert_within_budgets(ASYNC_BUDGETS, {size: self.measure(size, use_async=True) for size in SIZES})
+
+    def assert_within_budgets(self, budgets, runs):
+        failures = []
+        for name, budget in budgets.items():
+            counts = {size: len(runs[size][name]) for size in SIZES if name in runs[size]}
+            if not counts:
+                failures.append(f"{name}: not exercised")
+                continue
+            worst = max(counts, key=counts.get)
+            if counts[worst] > budget or len(set(counts.values())) > 1:
+                failures.append(
+                    f"{name}: budget {budget}, ran "
+                    + ", ".join(f"{count} with {size} rows" for size, count in counts.items())
+                    + f"\n queries with {worst} rows:\n{runs[worst][name].report()}"
+                )
+        if failures:
+            self.fail("query budgets exceeded:\n\n" + "\n\n".join(failures))
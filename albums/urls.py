@@ -1,8 +1,17 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import ArtistViewSet, AlbumViewSet, ReviewViewSet
-from .views import spotify_callback, spotify_connect, spotify_refresh, spotify_search
-from .views import spotify_album_details, spotify_new_releases, get_combined_album_details, get_artist_albums
+from .views import spotify_callback, spotify_connect, spotify_refresh
+from .views import spotify_stats, resolve_spotify_albums
+
+# The Spotify proxy views come in a sync and an async flavour; the async ones are meant for ASGI
+if settings.ASYNC_SPOTIFY_VIEWS:
+    from .async_views import spotify_search, spotify_album_details, spotify_new_releases
+    from .async_views import get_combined_album_details, get_artist_albums
+else:
+    from .views import spotify_search, spotify_album_details, spotify_new_releases
+    from .views import get_combined_album_details, get_artist_albums
 
 router = DefaultRouter()
 router.register(r'artists', ArtistViewSet)
@@ -15,8 +24,10 @@ urlpatterns = [
     path("spotify/refresh/", spotify_refresh, name="spotify-refresh"),
     path("spotify/connect/", spotify_connect, name="spotify-connect"),
     path("spotify/search/", spotify_search, name="spotify-search"),
+    path("spotify/albums/resolve/", resolve_spotify_albums, name="spotify-albums-resolve"),
     path("spotify/albums/<str:spotify_id>/", spotify_album_details, name="spotify-album-details"),
     path("spotify/browse/new-releases/", spotify_new_releases, name="spotify-new-releases"),
     path("album-details/<str:spotify_id>/", get_combined_album_details, name="combined-album-details"),
     path("spotify/artists/<str:artist_id>/albums/", get_artist_albums, name="spotify-artist-albums"),
+    path("spotify/stats/", spotify_stats, name="spotify-stats"),
 ]
@@ -1,29 +1,45 @@
 from rest_framework import viewsets, permissions, filters
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.pagination import PageNumberPagination
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django_filters.rest_framework import DjangoFilterBackend
 
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from django.core import signing
 from django.utils import timezone
+from django.conf import settings
+from datetime import timedelta
 from rest_framework import status
 from rest_framework.response import Response
 
-from django.db.models import Avg, Count, FloatField, IntegerField
-from django.db.models.functions import Coalesce
-
-from .models import Artist, Album, Review
+from .models import Artist, Album, Review, Leaderboard
 from .serializers import ArtistSerializer, AlbumSerializer, ReviewSerializer
+from .serializers import AlbumSummarySerializer, AlbumReviewSerializer, ResolveAlbumsSerializer
+from .serializers import CatalogAlbumSerializer
 from .permissions import IsOwnerOrReadOnly, IsAdminOrReadOnly
 
 from django.shortcuts import redirect
 from django.http import JsonResponse
 from .spotify import get_spotify_auth_url, get_tokens
-from .spotify import build_auth_url, exchange_code_for_token, tokens_response_to_saved_fields, refresh_access_token, make_spotify_request
-from .models import SpotifyToken
+from .spotify import build_auth_url, exchange_code_for_token, tokens_response_to_saved_fields, make_spotify_request
+from .spotify import get_pool_stats, apply_token_fields, refresh_user_token, SpotifyRateLimited
+from .spotify_governor import get_governor_stats
+from .spotify_coalesce import get_coalesce_stats
+from .spotify_ledger import get_ledger_stats
+from .spotify_cache import get_cache_stats
+from .spotify_breaker import breaker, SpotifyUnavailable
+from .background import fan_out, submit
+from .projections import DEFAULT_VIEW, VIEWS
+from .search import search_spotify, search_many, normalize_query, normalize_types, has_next_page
+from .search import SEARCH_TYPES, SEARCH_PAGE_SIZE, SEARCH_MAX_LIMIT, SEARCH_MAX_OFFSET
+from .catalog import resolve_albums, NEW_RELEASES_SYNC, crawl_discography, schedule_discography_crawl
+from .catalog import get_album_payload, prefetch_album_snapshots
+from .leaderboards import get_leaderboard, leaderboard_page, normalize_genre
+from .models import SpotifyToken, CatalogSync
 
 
 class ArtistViewSet(viewsets.ModelViewSet):
@@ -38,6 +54,24 @@ class ArtistViewSet(viewsets.ModelViewSet):
     ordering = ['name']  # Default ordering
 
 
+def top_rated_params(request):
+    """(scope, key, limit, offset) of a top_rated request; raises ValueError on bad input."""
+    genre = normalize_genre(request.query_params.get('genre'))
+    year = request.query_params.get('year')
+    if genre and year:
+        raise ValueError("Filter by genre or year, not both.")
+    try:
+        limit = min(max(int(request.query_params.get('limit', 10)), 1), settings.LEADERBOARD_SIZE)
+        offset = max(int(request.query_params.get('offset', 0)), 0)
+        if year:
+            return Leaderboard.YEAR, str(int(year)), limit, offset
+    except ValueError:
+        raise ValueError("year, limit and offset must be integers.")
+    if genre:
+        return Leaderboard.GENRE, genre, limit, offset
+    return Leaderboard.GLOBAL, "", limit, offset
+
+
 class AlbumViewSet(viewsets.ModelViewSet):
     queryset = Album.objects.all()
     serializer_class = AlbumSerializer
@@ -47,21 +81,34 @@ class AlbumViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
     filterset_fields = ['artist__name', 'release_year']  # Filtering by artist name or release year
     search_fields = ['title', 'artist__name']  # Search album title or artist name
-    ordering_fields = ['release_year', 'title']
+    ordering_fields = ['release_year', 'title', 'avg_rating', 'review_count']
     ordering = ['title']  # Default ordering
 
     def get_queryset(self):
-        return Album.objects.annotate(
-        avg_rating=Avg('reviews__rating', output_field=FloatField()),
-        review_count=Count('reviews', output_field=IntegerField())
-    )
+        # ratings are stored on the album (see ratings.py), so no aggregation here
+        return Album.objects.select_related('artist')
 
     @action(detail=False, methods=['get'])
     def top_rated(self, request):
-        # Annotate avg_rating on queryset to use in ordering
-        top_albums = self.get_queryset().order_by('-avg_rating')[:10]
-        serializer = self.get_serializer(top_albums, many=True)
-        return Response(serializer.data)
+        """
+        The best rated albums, read from the precomputed leaderboards (see leaderboards.py).
+        ?genre= or ?year= picks that genre's or release year's ranking;
+        ?limit= (default 10) and ?offset= page through it.
+        """
+        try:
+            scope, key, limit, offset = top_rated_params(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
+
+        board = get_leaderboard(scope, key)
+        if board is None:
+            return Response([])
+        entries = leaderboard_page(board, offset, limit)
+        data = self.get_serializer([entry.album for entry in entries], many=True).data
+        for item, entry in zip(data, entries):
+            item['rank'] = entry.rank
+            item['score'] = round(entry.score, 3)
+        return Response(data, headers={"X-Leaderboard-Refreshed-At": board.refreshed_at.isoformat()})
 
 
 class ReviewViewSet(viewsets.ModelViewSet):
@@ -81,14 +128,116 @@ class ReviewViewSet(viewsets.ModelViewSet):
         If a 'user' query param is set to 'me', filter reviews
         for the currently authenticated user.
         """
-        queryset = Review.objects.all().order_by('-created_at') # Add default ordering here
+        queryset = Review.objects.select_related('album__artist', 'user').order_by('-created_at') # Add default ordering here
         user_filter = self.request.query_params.get('user')
         
         if user_filter == 'me' and self.request.user.is_authenticated:
             queryset = queryset.filter(user=self.request.user)
             
         return queryset
+
+    # the album instance was loaded before the save moved its rating
+    RATING_FIELDS = ['rating_sum', 'review_count', 'avg_rating']
+
+    def perform_create(self, serializer):
+        review = serializer.save()
+        review.album.refresh_from_db(fields=self.RATING_FIELDS)
+
+    def perform_update(self, serializer):
+        review = serializer.save()
+        review.album.refresh_from_db(fields=self.RATING_FIELDS)
     
+def spotify_error(exc):
+    """(body, status, headers) for an exception from the Spotify client."""
+    if isinstance(exc, SpotifyRateLimited):
+        return {"error": str(exc)}, status.HTTP_429_TOO_MANY_REQUESTS, {"Retry-After": str(exc.retry_after)}
+    if isinstance(exc, SpotifyUnavailable):
+        return {"error": str(exc)}, status.HTTP_503_SERVICE_UNAVAILABLE, {}
+    if isinstance(exc, TimeoutError):
+        return {"error": "Timed out waiting for Spotify."}, status.HTTP_503_SERVICE_UNAVAILABLE, {}
+    return {"error": str(exc)}, 500, {}
+
+
+def spotify_error_response(exc):
+    """Turn an exception from the Spotify client into an API response."""
+    body, status_code, headers = spotify_error(exc)
+    return Response(body, status=status_code, headers=headers)
+
+
+def requested_view(request):
+    """The payload projection asked for with ?view= (see projections.py), or None if unknown."""
+    view = request.GET.get("view", DEFAULT_VIEW)
+    return view if view in VIEWS else None
+
+
+INVALID_VIEW = f"view must be one of: {', '.join(VIEWS)}."
+
+
+def invalid_view_response():
+    return Response({"error": INVALID_VIEW}, status=400)
+
+
+def stale_headers(payload):
+    """Headers flagging payloads served from the stale cache during an outage."""
+    if getattr(payload, "stale", False):
+        return {"Warning": '110 - "Response is Stale"', "X-Spotify-Stale": "true"}
+    return {}
+
+
+def spotify_response(payload, data=None):
+    """
+    Response for data built from a Spotify payload (`data` defaults to the payload).
+    Payloads served from the stale cache during an outage are flagged in the headers.
+    """
+    return Response(payload if data is None else data, headers=stale_headers(payload))
+
+
+def search_params(request):
+    """
+    Validated (query, types, limit, offset, view) for a search request, or a
+    ValueError with the message for a 400 response.
+    """
+    query = normalize_query(request.GET.get("q"))
+    # Get the search type from the request, default to 'artist'
+    search_type = normalize_types(request.GET.get("type", "artist"))
+    view = requested_view(request)
+
+    if not query:
+        raise ValueError("Query parameter 'q' is required.")
+    if not search_type or not set(search_type.split(",")) <= set(SEARCH_TYPES):
+        raise ValueError(f"type must be a comma-separated list of: {', '.join(SEARCH_TYPES)}.")
+    if view is None:
+        raise ValueError(INVALID_VIEW)
+    try:
+        limit = min(max(int(request.GET.get("limit", SEARCH_PAGE_SIZE)), 1), SEARCH_MAX_LIMIT)
+        offset = min(max(int(request.GET.get("offset", 0)), 0), SEARCH_MAX_OFFSET - limit)
+    except ValueError:
+        raise ValueError("limit and offset must be integers.")
+    return query, search_type, limit, offset, view
+
+
+def search_response_data(request, results, ranked, limit, offset):
+    """The search response body: Spotify's per-type pages plus our own paging links."""
+    # The key in the response will change based on the type
+    # e.g., 'artists' or 'albums'
+    url = request.build_absolute_uri()
+    data = dict(results)
+    if ranked is not None:
+        data["results"] = ranked
+    data["next"] = (replace_query_param(url, "offset", offset + limit)
+                    if has_next_page(results) and offset + limit < SEARCH_MAX_OFFSET else None)
+    data["previous"] = replace_query_param(url, "offset", max(offset - limit, 0)) if offset else None
+    return data
+
+
+def prefetch_top_albums(user, results):
+    if settings.SPOTIFY_SEARCH_PREFETCH:
+        # users usually open one of the top albums next; warm their details meanwhile
+        top = [a["id"] for a in (results.get("albums") or {}).get("items", []) if a]
+        if top:
+            submit(prefetch_album_snapshots, user.id, top[:settings.SPOTIFY_SEARCH_PREFETCH])
+
+
 SIGNING_SALT = "spotify-auth-salt"  # change to project-unique string
 
 
@@ -154,14 +303,10 @@ def spotify_callback(request):
         return Response({"error": "User not found"}, status=status.HTTP_400_BAD_REQUEST)
 
     spotify_obj, created = SpotifyToken.objects.get_or_create(user=user)
-    spotify_obj.access_token = fields["access_token"]
-    # only update refresh_token if present (Spotify may omit on refresh)
-    if fields.get("refresh_token"):
-        spotify_obj.refresh_token = fields["refresh_token"]
-    spotify_obj.scope = fields["scope"]
-    spotify_obj.token_type = fields["token_type"]
-    spotify_obj.expires_at = fields["expires_at"]
-    spotify_obj.save()
+    # only fields present in the response are updated (Spotify may omit refresh_token)
+    changed = apply_token_fields(spotify_obj, fields)
+    if changed:
+        spotify_obj.save(update_fields=changed)
 
     # For development, return JSON. In production you may redirect to frontend.
     return Response({
@@ -178,47 +323,43 @@ def spotify_callback(request):
 @authentication_classes([JWTAuthentication])
 def spotify_refresh(request):
     user = request.user
-    try:
-        token_obj = user.spotify_token
-    except SpotifyToken.DoesNotExist:
+    if not SpotifyToken.objects.filter(user=user).exists():
         return Response({"error": "No Spotify tokens for user"}, status=status.HTTP_400_BAD_REQUEST)
 
+    # goes through the same per-user lock as automatic refreshes
     try:
-        token_resp = refresh_access_token(token_obj.refresh_token)
+        token_obj = refresh_user_token(user.id, force=True)
     except Exception as exc:
         return Response({"error": "Refresh failed", "details": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
 
-    # update saved fields (note: response may omit refresh_token)
-    fields = tokens_response_to_saved_fields(token_resp)
-    token_obj.access_token = fields["access_token"] or token_obj.access_token
-    if fields.get("refresh_token"):
-        token_obj.refresh_token = fields["refresh_token"]
-    token_obj.token_type = fields.get("token_type", token_obj.token_type)
-    token_obj.scope = fields.get("scope", token_obj.scope)
-    token_obj.expires_at = fields.get("expires_at", token_obj.expires_at)
-    token_obj.save()
-
     return Response({"detail": "Spotify token refreshed", "expires_at": token_obj.expires_at})
 
 # search spotify albums
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def spotify_search(request):
-    query = request.GET.get("q")
-    # Get the search type from the request, default to 'artist'
-    search_type = request.GET.get("type", "artist") 
+    """
+    Searches Spotify, one page at a time (?limit=, ?offset=), with links to the
+    next and previous pages. Results are cached per normalized query, type and page.
+    With several types (?type=album,artist,track) the types are searched concurrently
+    and "results" holds them merged with matching local albums, in one ranked list.
+    """
+    try:
+        query, search_type, limit, offset, view = search_params(request)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
 
-    if not query:
-        return Response({"error": "Query parameter 'q' is required."}, status=400)
-    
-    endpoint = f"/v1/search?q={query}&type={search_type}&limit=10"
+    types = search_type.split(",")
     try:
-        results = make_spotify_request(request.user, endpoint)
-        # The key in the response will change based on the type
-        # e.g., 'artists' or 'albums'
-        return Response(results)
+        if len(types) == 1:
+            results, ranked = search_spotify(request.user, query, search_type, limit, offset, view), None
+        else:
+            results, ranked = search_many(request.user, query, types, limit, offset, view)
     except Exception as e:
-        return Response({"error": str(e)}, status=500)
+        return spotify_error_response(e)
+
+    prefetch_top_albums(request.user, results)
+    return spotify_response(results, search_response_data(request, results, ranked, limit, offset))
     
 # get spotify album details
 @api_view(["GET"])
@@ -226,29 +367,83 @@ def spotify_search(request):
 def spotify_album_details(request, spotify_id):
     """
     Gets detailed information for a single Spotify album.
+    Served from the stored album snapshot when there is one.
+    ?view= picks the projection: slim (default), card or full.
     """
-    endpoint = f"/v1/albums/{spotify_id}"
+    view = requested_view(request)
+    if view is None:
+        return invalid_view_response()
     try:
-        results = make_spotify_request(request.user, endpoint)
-        return Response(results)
+        results = get_album_payload(spotify_id, view)
+        return spotify_response(results)
     except Exception as e:
-        return Response({"error": str(e)}, status=500)
+        return spotify_error_response(e)
+
+def new_release_albums(limit):
+    return (Album.objects.filter(new_release__isnull=False).select_related('artist')
+            .order_by('new_release__position')[:limit])
+
+
+def new_releases_endpoint(limit):
+    return f"/v1/browse/new-releases?limit={limit}"
+
 
 # browse new spotify releases
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def spotify_new_releases(request):
     """
-    Gets a list of new album releases from Spotify.
+    Gets a list of new album releases.
+    Served from the local mirror kept by `manage.py sync_new_releases`, with local
+    ratings; until the first sync has run it proxies Spotify directly.
     """
+    try:
+        limit = min(max(int(request.GET.get("limit", 20)), 1), 50)
+    except ValueError:
+        return Response({"error": "limit must be an integer."}, status=400)
+    view = requested_view(request)
+    if view is None:
+        return invalid_view_response()
+
+    sync = CatalogSync.objects.filter(name=NEW_RELEASES_SYNC).first()
+    if sync is not None:
+        albums = new_release_albums(limit)
+        response = Response(CatalogAlbumSerializer(albums, many=True).data)
+        response["X-Catalog-Synced-At"] = sync.synced_at.isoformat()
+        return response
+
     # The endpoint for new releases in Spotify API
-    endpoint = "/v1/browse/new-releases?limit=20"
+    endpoint = new_releases_endpoint(limit)
     try:
-        results = make_spotify_request(request.user, endpoint)
-        return Response(results.get("albums", {}).get("items", []))
+        results = make_spotify_request(request.user, endpoint, view=view)
+        return spotify_response(results, results.get("albums", {}).get("items", []))
     except Exception as e:
-        return Response({"error": str(e)}, status=500)
+        return spotify_error_response(e)
     
+class AlbumReviewPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def local_album_details(request, spotify_id):
+    """The local half of the combined album details: the album and one page of its reviews."""
+    album = Album.objects.filter(spotify_id=spotify_id).select_related('artist').first()
+    if album is None:
+        return {"album": None, "local_reviews": [], "reviews_count": 0,
+                "reviews_next": None, "reviews_previous": None}
+    paginator = AlbumReviewPagination()
+    reviews = Review.objects.filter(album=album).select_related('user').order_by('-created_at')
+    page = paginator.paginate_queryset(reviews, request)
+    return {
+        "album": AlbumSummarySerializer(album).data,
+        "local_reviews": AlbumReviewSerializer(page, many=True).data,
+        "reviews_count": album.review_count,
+        "reviews_next": paginator.get_next_link(),
+        "reviews_previous": paginator.get_previous_link(),
+    }
+
+
 # get the album data from spotify and the api album data
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
@@ -256,35 +451,83 @@ def get_combined_album_details(request, spotify_id):
     """
     Fetches album details from Spotify and combines them with
     local reviews from this application's database.
+    The Spotify payload (stored snapshot, or an upstream call) is loaded on the
+    fan-out pool while the reviews are queried,
+    and the local album is sent once instead of nested in every review.
+    ?view= picks the projection of spotify_details: slim (default), card or full.
     """
+    view = requested_view(request)
+    if view is None:
+        return invalid_view_response()
     try:
-        # 1. Fetch album metadata from Spotify
-        spotify_data = make_spotify_request(request.user, f"/v1/albums/{spotify_id}")
+        # 1. Start loading the Spotify payload; it runs while we hit the database
+        spotify_future = fan_out(get_album_payload, spotify_id, view)
 
-        # 2. Fetch local reviews for this album
-        local_reviews = Review.objects.filter(album__spotify_id=spotify_id)
-        review_serializer = ReviewSerializer(local_reviews, many=True)
+        # 2. Fetch the local album and one page of its reviews
+        local_data = local_album_details(request, spotify_id)
 
         # 3. Combine the data into a single response
-        combined_data = {
-            "spotify_details": spotify_data,
-            "local_reviews": review_serializer.data
-        }
-        return Response(combined_data)
+        spotify_data = spotify_future.result(timeout=settings.BACKGROUND_RESULT_TIMEOUT)
+        return spotify_response(spotify_data, {"spotify_details": spotify_data, **local_data})
 
     except Exception as e:
-        return Response({"error": str(e)}, status=500)
+        return spotify_error_response(e)
+
+def artist_albums(artist_id):
+    return Album.objects.filter(artists__spotify_id=artist_id).select_related('artist').order_by('-release_year', 'title')
+
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_artist_albums(request, artist_id):
     """
-    Gets a list of albums for a specific artist from Spotify.
+    Gets the full list of albums for a specific artist.
+    The discography is crawled from Spotify into the local catalog and served from
+    there; once older than SPOTIFY_DISCOGRAPHY_TTL it is served as-is while a
+    background crawl refreshes it.
+    """
+    synced_at = Artist.objects.filter(spotify_id=artist_id).values_list('discography_synced_at', flat=True).first()
+    try:
+        if synced_at is None:
+            crawl_discography(request.user, artist_id)
+        elif timezone.now() - synced_at > timedelta(seconds=settings.SPOTIFY_DISCOGRAPHY_TTL):
+            schedule_discography_crawl(request.user, artist_id)
+    except Exception as e:
+        return spotify_error_response(e)
+
+    return Response(CatalogAlbumSerializer(artist_albums(artist_id), many=True).data)
+
+@api_view(["POST"])
+@permission_classes([IsAdminUser])
+def resolve_spotify_albums(request):
+    """
+    Staff-only: make sure the given Spotify album ids exist locally, fetching the
+    unknown ones 20 at a time and upserting them in bulk.
     """
-    endpoint = f"/v1/artists/{artist_id}/albums"
+    serializer = ResolveAlbumsSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    ids = serializer.validated_data["ids"]
     try:
-        results = make_spotify_request(request.user, endpoint)
-        # We return the 'items' array from the Spotify response
-        return Response(results.get("items", []))
+        albums = resolve_albums(request.user, ids)
     except Exception as e:
-        return Response({"error": str(e)}, status=500)
\ No newline at end of file
+        return spotify_error_response(e)
+    return Response({
+        "resolved": AlbumSerializer(albums.values(), many=True, context={"request": request}).data,
+        "missing": [i for i in dict.fromkeys(ids) if i not in albums],
+    })
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def spotify_stats(request):
+    """
+    Staff-only snapshot of this worker's Spotify client internals, used for sizing.
+    """
+    return Response({
+        "http_pool": get_pool_stats(),
+        "response_cache": get_cache_stats(),
+        "circuit_breaker": breaker.stats(),
+        "rate_limit": get_governor_stats(),
+        "coalescing": get_coalesce_stats(),
+        "ledger": get_ledger_stats(),
+    })
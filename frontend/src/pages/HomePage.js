@@ -10,7 +10,7 @@ function HomePage() {
         e.preventDefault();
         try {
             // We will now always search for the 'album' type
-            const response = await apiClient.get(`/spotify/search/?q=${query}&type=album`);
+            const response = await apiClient.get(`/spotify/search/?q=${encodeURIComponent(query)}&type=album`);
             // The response from Spotify for an album search is under the 'albums' key
             setAlbums(response.data.albums.items);
         } catch (error) {
@@ -24,6 +24,101 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 SPOTIFY_CLIENT_ID = os.environ.get('SPOTIFY_CLIENT_ID')
 SPOTIFY_CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
 SPOTIFY_REDIRECT_URI = os.environ.get('SPOTIFY_REDIRECT_URI')
+# Where the Spotify client sends its calls; point these at `manage.py fake_spotify` for load tests
+SPOTIFY_AUTH_URL = os.environ.get('SPOTIFY_AUTH_URL', 'https://accounts.spotify.com/authorize')
+SPOTIFY_TOKEN_URL = os.environ.get('SPOTIFY_TOKEN_URL', 'https://accounts.spotify.com/api/token')
+SPOTIFY_API_BASE_URL = os.environ.get('SPOTIFY_API_BASE_URL', 'https://api.spotify.com/')
+
+# Shared HTTP session used for every call to Spotify (one pool per worker)
+SPOTIFY_HTTP_POOL_SIZE = int(os.environ.get('SPOTIFY_HTTP_POOL_SIZE', 10))
+SPOTIFY_HTTP_CONNECT_TIMEOUT = float(os.environ.get('SPOTIFY_HTTP_CONNECT_TIMEOUT', 3.05))
+SPOTIFY_HTTP_READ_TIMEOUT = float(os.environ.get('SPOTIFY_HTTP_READ_TIMEOUT', 10))
+SPOTIFY_HTTP_MAX_RETRIES = int(os.environ.get('SPOTIFY_HTTP_MAX_RETRIES', 2))
+SPOTIFY_HTTP_BACKOFF_FACTOR = float(os.environ.get('SPOTIFY_HTTP_BACKOFF_FACTOR', 0.3))
+# Connection limit of the async client (albums/spotify_async.py) per process
+SPOTIFY_ASYNC_MAX_CONNECTIONS = int(os.environ.get('SPOTIFY_ASYNC_MAX_CONNECTIONS', 100))
+
+# Shared cache for Spotify catalog responses.
+# Backend is "local" (per-worker LRU), "django" (uses CACHES[SPOTIFY_CACHE_ALIAS]) or a dotted path.
+SPOTIFY_CACHE_BACKEND = os.environ.get('SPOTIFY_CACHE_BACKEND', 'local')
+SPOTIFY_CACHE_ALIAS = os.environ.get('SPOTIFY_CACHE_ALIAS', 'default')
+SPOTIFY_CACHE_MAX_ENTRIES = int(os.environ.get('SPOTIFY_CACHE_MAX_ENTRIES', 2048))
+SPOTIFY_CACHE_MAX_BYTES = int(os.environ.get('SPOTIFY_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+SPOTIFY_CACHE_TTLS = {  # seconds, per endpoint; 0 disables caching
+    'album': 60 * 60,
+    'albums': 60 * 60,
+    'artist': 60 * 60,
+    'artist_albums': 60 * 60,
+    'new_releases': 15 * 60,
+    'search': 10 * 60,  # per normalized query, type and page
+}
+# How long past its TTL a response is kept to serve while Spotify is down (seconds)
+SPOTIFY_STALE_TTL = int(os.environ.get('SPOTIFY_STALE_TTL', 24 * 60 * 60))
+
+# Circuit breaker around Spotify: open after consecutive failures or slow calls, retry after the timeout
+SPOTIFY_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('SPOTIFY_BREAKER_FAILURE_THRESHOLD', 5))
+SPOTIFY_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('SPOTIFY_BREAKER_SLOW_CALL_SECONDS', 5))
+SPOTIFY_BREAKER_SLOW_CALL_THRESHOLD = int(os.environ.get('SPOTIFY_BREAKER_SLOW_CALL_THRESHOLD', 5))
+SPOTIFY_BREAKER_RESET_TIMEOUT = float(os.environ.get('SPOTIFY_BREAKER_RESET_TIMEOUT', 30))
+
+# Refresh Spotify user tokens in the background once they are this close to expiring (seconds)
+SPOTIFY_TOKEN_REFRESH_WINDOW = int(os.environ.get('SPOTIFY_TOKEN_REFRESH_WINDOW', 300))
+
+# Stored album payloads older than this are served as-is and refreshed in the background (seconds)
+SPOTIFY_SNAPSHOT_TTL = int(os.environ.get('SPOTIFY_SNAPSHOT_TTL', 6 * 60 * 60))
+
+# Warm album snapshots for the top N album search results in the background (0 disables),
+# at most SPOTIFY_SEARCH_PREFETCH_BUDGET albums per user every SPOTIFY_SEARCH_PREFETCH_WINDOW seconds
+SPOTIFY_SEARCH_PREFETCH = int(os.environ.get('SPOTIFY_SEARCH_PREFETCH', 0))
+SPOTIFY_SEARCH_PREFETCH_BUDGET = int(os.environ.get('SPOTIFY_SEARCH_PREFETCH_BUDGET', 30))
+SPOTIFY_SEARCH_PREFETCH_WINDOW = int(os.environ.get('SPOTIFY_SEARCH_PREFETCH_WINDOW', 60))
+# Fetch the next page of search results into the cache in the background
+SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE = os.environ.get('SPOTIFY_SEARCH_PREFETCH_NEXT_PAGE', 'False') == 'True'
+
+# Artist discographies are crawled into the local catalog and served from it for this long (seconds)
+SPOTIFY_DISCOGRAPHY_TTL = int(os.environ.get('SPOTIFY_DISCOGRAPHY_TTL', 24 * 60 * 60))
+SPOTIFY_DISCOGRAPHY_CONCURRENCY = int(os.environ.get('SPOTIFY_DISCOGRAPHY_CONCURRENCY', 4))
+
+# Cluster-wide pacing of Spotify API calls (token bucket stored in the database). Each
+# upstream call costs one UPDATE of the same RateLimitBucket row, plus a SELECT when it
+# has to queue; disable it where Spotify's own 429s are pacing enough
+SPOTIFY_RATE_LIMIT_ENABLED = os.environ.get('SPOTIFY_RATE_LIMIT_ENABLED', 'True') == 'True'
+SPOTIFY_RATE_LIMIT_PER_SECOND = float(os.environ.get('SPOTIFY_RATE_LIMIT_PER_SECOND', 10))
+SPOTIFY_RATE_LIMIT_BURST = float(os.environ.get('SPOTIFY_RATE_LIMIT_BURST', 30))
+# share of the burst that background jobs may not touch, kept for user traffic
+SPOTIFY_RATE_LIMIT_BACKGROUND_RESERVE = float(os.environ.get('SPOTIFY_RATE_LIMIT_BACKGROUND_RESERVE', 0.5))
+# how long a request may queue for budget before it is shed (seconds)
+SPOTIFY_RATE_LIMIT_MAX_WAIT = float(os.environ.get('SPOTIFY_RATE_LIMIT_MAX_WAIT', 1))
+SPOTIFY_RATE_LIMIT_BACKGROUND_MAX_WAIT = float(os.environ.get('SPOTIFY_RATE_LIMIT_BACKGROUND_MAX_WAIT', 60))
+
+# Identical concurrent catalog GETs share one upstream call; across workers needs a shared cache
+SPOTIFY_COALESCE_TIMEOUT = float(os.environ.get('SPOTIFY_COALESCE_TIMEOUT', 15))
+SPOTIFY_COALESCE_ACROSS_WORKERS = os.environ.get('SPOTIFY_COALESCE_ACROSS_WORKERS', 'False') == 'True'
+
+# Ledger of Spotify client calls (albums/spotify_ledger.py): records kept in memory per
+# worker, and the share of them written (in batches) to SpotifyCallRecord for reports
+SPOTIFY_LEDGER_SIZE = int(os.environ.get('SPOTIFY_LEDGER_SIZE', 1000))
+SPOTIFY_LEDGER_SAMPLE_RATE = float(os.environ.get('SPOTIFY_LEDGER_SAMPLE_RATE', 0.05))
+SPOTIFY_LEDGER_FLUSH_SIZE = int(os.environ.get('SPOTIFY_LEDGER_FLUSH_SIZE', 50))
+SPOTIFY_LEDGER_FLUSH_INTERVAL = float(os.environ.get('SPOTIFY_LEDGER_FLUSH_INTERVAL', 10))
+
+# Thread pools (per worker): one for background work, and one for the concurrent
+# upstream calls a request waits on, so queued background jobs can't starve requests
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 8))
+FAN_OUT_WORKERS = int(os.environ.get('FAN_OUT_WORKERS', 16))
+# longest a request waits on work it handed to the pool before answering 503 (seconds)
+BACKGROUND_RESULT_TIMEOUT = float(os.environ.get('BACKGROUND_RESULT_TIMEOUT', 30))
+
+# Route the Spotify proxy endpoints to the async views (albums/async_views.py); use with ASGI
+ASYNC_SPOTIFY_VIEWS = os.environ.get('ASYNC_SPOTIFY_VIEWS', 'False') == 'True'
+
+# Top-rated leaderboards (albums/leaderboards.py): albums kept per ranking, how many reviews'
+# worth of weight the mean rating gets in the score, and the reviews an album needs to be ranked
+LEADERBOARD_SIZE = int(os.environ.get('LEADERBOARD_SIZE', 100))
+LEADERBOARD_PRIOR_WEIGHT = float(os.environ.get('LEADERBOARD_PRIOR_WEIGHT', 10))
+LEADERBOARD_MIN_REVIEWS = int(os.environ.get('LEADERBOARD_MIN_REVIEWS', 1))
+# Re-rank an album's leaderboards in the background when it gets a review
+LEADERBOARD_REFRESH_ON_REVIEW = os.environ.get('LEADERBOARD_REFRESH_ON_REVIEW', 'True') == 'True'
 
 
 # Quick-start development settings - unsuitable for production
@@ -87,6 +182,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'albums.spotify_ledger.SpotifyLedgerMiddleware',
 ]
 
 ROOT_URLCONF = 'music_api.urls'